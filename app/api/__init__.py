@@ -14,6 +14,7 @@ from . import favourites
 from . import friends
 from . import lastfm
 from . import leaderboards
+from . import metrics
 from . import ratings
 from . import redis
 from . import registration
@@ -70,6 +71,8 @@ router.add_api_route(
     methods=["POST"],
 )
 
+router.add_api_route("/metrics", metrics.get_metrics)
+
 # TODO: maybe add mark as read and seasonals
 
 """ hidden endpoints which are static/redirects """
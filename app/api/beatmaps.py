@@ -5,6 +5,7 @@ from fastapi import Query
 from pydantic import BaseModel
 
 import app.state
+import app.usecases
 import log
 from app.constants.mode import Mode
 from app.objects.user import User
@@ -36,10 +37,13 @@ async def get_beatmap_info(
     ret = []
 
     for idx, map_filename in enumerate(form_data.Filenames):
-        maps_collection = app.state.services.database.maps
-        document = await maps_collection.find_one({"filename": map_filename})
-        if not document:
-            continue
+        if beatmap := app.usecases.beatmap_index.by_filename(map_filename):
+            document = beatmap.dict()
+        else:
+            maps_collection = app.state.services.database.maps
+            document = await maps_collection.find_one({"filename": map_filename})
+            if not document:
+                continue
 
         document["status"] = bancho_to_osu_api_status(document["status"])
 
@@ -4,7 +4,6 @@ from typing import Any
 from typing import Optional
 from urllib.parse import unquote_plus
 
-from aiohttp import ClientSession
 from fastapi import Depends
 from fastapi import Path
 from fastapi import Query
@@ -12,6 +11,7 @@ from fastapi import status
 from fastapi.responses import RedirectResponse
 
 import app.config
+import app.state
 import app.usecases
 from app.objects.beatmap import RankedStatus
 from app.objects.user import User
@@ -61,12 +61,11 @@ async def osu_direct(
             status_code=status.HTTP_301_MOVED_PERMANENTLY,
         )
 
-    async with ClientSession() as session:
-        async with session.get(search_url, params=params) as response:
-            if response.status != status.HTTP_200_OK:
-                return b"-1\nFailed to retrieve data from the beatmap mirror."
+    async with app.state.http.get("mirror", search_url, params=params) as response:
+        if response.status != status.HTTP_200_OK:
+            return b"-1\nFailed to retrieve data from the beatmap mirror."
 
-            result = await response.json()
+        result = await response.json()
 
     result_len = len(result)
     ret = [f"{'101' if result_len == 100 else result_len}"]
@@ -14,12 +14,13 @@ from app.constants.mode import Mode
 from app.constants.mods import Mods
 from app.constants.privileges import Privileges
 from app.objects.beatmap import RankedStatus
+from app.objects.leaderboard import Leaderboard
+from app.objects.leaderboard import LeaderboardScore
+from app.objects.leaderboard import SCORES_SHOWN
+from app.objects.leaderboard import UserScore
 from app.objects.user import User
 from app.utils import authenticate_user
 
-unsubmitted: set[str] = set()
-requires_update: set[str] = set()
-
 
 class LeaderboardType(IntEnum):
     LOCAL = 0
@@ -29,6 +30,58 @@ class LeaderboardType(IntEnum):
     COUNTRY = 4
 
 
+def shows_cached_row(user: User, personal_best: UserScore) -> bool:
+    """Whether the user's own row in the top scores looks like everyone else's.
+
+    The cached rows leave out disallowed users and use the name on the score."""
+
+    score = personal_best["score"]
+    return not score.user_priv & Privileges.DISALLOWED and score.username == user.name
+
+
+def filtered_scores(
+    leaderboard: Leaderboard,
+    lb_type: LeaderboardType,
+    user: User,
+    mods: Mods,
+) -> list[LeaderboardScore]:
+    if lb_type == LeaderboardType.MODS:
+        return leaderboard.mods_scores(mods)
+    elif lb_type == LeaderboardType.COUNTRY:
+        return leaderboard.country_scores(user.geolocation.country.acronym)
+    elif lb_type == LeaderboardType.FRIENDS:
+        return leaderboard.user_ids_scores(user.friends)
+    else:
+        return leaderboard.scores
+
+
+def render_rows(
+    leaderboard: Leaderboard,
+    scores: list[LeaderboardScore],
+    user: User,
+) -> bytes:
+    rows: list[bytes] = []
+
+    for score in scores:
+        if len(rows) == SCORES_SHOWN:
+            break
+
+        if score.user_priv & Privileges.DISALLOWED and score.user_id != user.id:
+            continue
+
+        # TODO: username including clan stuff
+        if score.user_id == user.id:
+            displayed_name = user.name
+        else:
+            displayed_name = score.username
+
+        rank = leaderboard.index_of(score) + 1
+        row = score.osu_string(displayed_name, rank, leaderboard.mode)
+        rows.append(row.encode())
+
+    return b"\n".join(rows)
+
+
 async def get_leaderboard(
     user: User = Depends(authenticate_user(Query, "us", "ha")),
     requesting_from_editor_song_select: bool = Query(..., alias="s"),
@@ -44,10 +97,11 @@ async def get_leaderboard(
 ):
     start = time.perf_counter_ns()
 
-    if map_md5 in unsubmitted:
-        return b"-1|false"
-    elif map_md5 in requires_update:
-        return b"1|false"
+    if not app.usecases.beatmap.md5_from_cache(map_md5):
+        missing_status = await app.usecases.missing_beatmap.fetch(map_md5)
+
+        if missing_status is not None:
+            return f"{missing_status.value}|false".encode()
 
     mode = Mode.from_lb(mode_arg, mods_arg)
     mods = Mods(mods_arg)
@@ -71,7 +125,10 @@ async def get_leaderboard(
 
     if not beatmap:
         if has_set_id and map_set_id not in app.usecases.beatmap.set_cache:
-            unsubmitted.add(map_md5)
+            await app.usecases.missing_beatmap.add(
+                map_md5,
+                RankedStatus.NOT_SUBMITTED,
+            )
             return b"-1|false"
 
         filename = unquote_plus(map_filename)
@@ -82,6 +139,8 @@ async def get_leaderboard(
                     break
             else:
                 map_exists = False
+        elif app.usecases.beatmap_index.by_filename(filename):
+            map_exists = True
         else:
             map_collection = app.state.services.database.maps
             map_exists = (
@@ -90,10 +149,16 @@ async def get_leaderboard(
 
         if map_exists:
             # map needs an update
-            requires_update.add(map_md5)
+            await app.usecases.missing_beatmap.add(
+                map_md5,
+                RankedStatus.UPDATE_AVAILABLE,
+            )
             return b"1|false"
         else:
-            unsubmitted.add(map_md5)
+            await app.usecases.missing_beatmap.add(
+                map_md5,
+                RankedStatus.NOT_SUBMITTED,
+            )
             return b"-1|false"
 
     if not beatmap.has_leaderboard:
@@ -101,61 +166,38 @@ async def get_leaderboard(
 
     beatmap_rating = await app.usecases.beatmap.get_rating(beatmap)
 
-    response_lines: list[str] = []
-
-    if not requesting_from_editor_song_select:
+    if requesting_from_editor_song_select:
+        response = beatmap.osu_string(score_count=0, rating=beatmap_rating).encode()
+    else:
         leaderboard = await app.usecases.leaderboard.fetch(beatmap, mode)
-
-        response_lines.append(
-            beatmap.osu_string(
-                score_count=len(leaderboard),
-                rating=beatmap_rating,
-            ),
-        )
+        lb_type = LeaderboardType(leaderboard_type_arg)
 
         personal_best = leaderboard.find_user_score(user.id)
         if personal_best:
-            response_lines.append(
-                personal_best["score"].osu_string(
-                    user.name,
-                    personal_best["rank"],
-                ),
+            personal_best_line = personal_best["score"].osu_string(
+                user.name,
+                personal_best["rank"],
+                mode,
             )
         else:
-            response_lines.append("")
-
-        lb_type = LeaderboardType(leaderboard_type_arg)
-
-        for idx, score in enumerate(leaderboard.scores[:250]):  # TODO: custom limit?
-            if score.user_priv & Privileges.DISALLOWED and score.user_id != user.id:
-                continue
-
-            if lb_type == LeaderboardType.MODS and score.mods != mods:
-                continue
+            personal_best_line = ""
 
-            if (
-                lb_type == LeaderboardType.COUNTRY
-                and score.user_country != user.geolocation.country.acronym
-            ):
-                continue
-
-            if lb_type == LeaderboardType.FRIENDS and score.user_id not in user.friends:
-                continue
-
-            # TODO: username including clan stuff
-            if score.user_id == user.id:
-                displayed_name = user.name
-            else:
-                displayed_name = score.username
-
-            response_lines.append(score.osu_string(displayed_name, rank=idx + 1))
-    else:
-        response_lines.append(
-            beatmap.osu_string(
-                score_count=0,
+        if lb_type in (LeaderboardType.LOCAL, LeaderboardType.TOP) and (
+            not personal_best or shows_cached_row(user, personal_best)
+        ):
+            header, rows = leaderboard.render(beatmap, beatmap_rating)
+        else:
+            header = beatmap.osu_string(
+                score_count=len(leaderboard),
                 rating=beatmap_rating,
-            ),
-        )
+            ).encode()
+            scores = filtered_scores(leaderboard, lb_type, user, mods)
+            rows = render_rows(leaderboard, scores, user)
+
+        if rows:
+            response = b"\n".join((header, personal_best_line.encode(), rows))
+        else:
+            response = b"\n".join((header, personal_best_line.encode()))
 
     end = time.perf_counter_ns()
     formatted_time = log.format_time(end - start)
@@ -163,4 +205,4 @@ async def get_leaderboard(
         f"Served {user.name} leaderboard for {beatmap.full_name} in {formatted_time}",
     )
 
-    return "\n".join(response_lines).encode()
+    return response
@@ -0,0 +1,59 @@
+from __future__ import annotations
+
+import secrets
+
+from fastapi import Query
+from fastapi import Response
+from fastapi import status
+from fastapi.responses import ORJSONResponse
+
+import app.config
+import app.state
+import app.usecases
+
+
+async def get_metrics(key: str = Query(...)):
+    if not secrets.compare_digest(key, str(app.config.API_SECRET)):
+        return Response(status_code=status.HTTP_403_FORBIDDEN)
+
+    executor = app.state.executor
+    deferred_queue = app.state.deferred.queue
+
+    return ORJSONResponse(
+        {
+            "timings": {
+                name: histogram.summary()
+                for name, histogram in sorted(app.state.metrics.histograms.items())
+            },
+            "executor": {
+                "in_flight": executor.in_flight,
+                "queue_depth": executor.queue_depth(),
+                "tasks": {
+                    name: {
+                        "count": timings.count,
+                        "inline": timings.inline,
+                        "average_ms": timings.average_ns / 1e6,
+                        "max_ms": timings.max_ns / 1e6,
+                    }
+                    for name, timings in executor.timings.items()
+                },
+            },
+            "deferred": {
+                "queued": deferred_queue.qsize() if deferred_queue is not None else 0,
+            },
+            "upstreams": app.state.http.stats(),
+            "duplicate_filter": app.usecases.duplicate.stats(),
+            "pp_calculators": {
+                "hits": app.usecases.performance.calculator_hits,
+                "misses": app.usecases.performance.calculator_misses,
+            },
+            "beatmaps": app.usecases.beatmap.stats(),
+            "beatmap_index": app.usecases.beatmap_index.stats(),
+            "leaderboards": app.usecases.leaderboard.stats(),
+            "missing_beatmaps": app.usecases.missing_beatmap.stats(),
+            "osu_files": {
+                "cached": len(app.usecases.beatmap_file.files),
+                "total_size": app.usecases.beatmap_file.total_size,
+            },
+        },
+    )
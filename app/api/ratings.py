@@ -51,4 +51,7 @@ async def osu_rate(
     if beatmap:
         beatmap.rating = avg
 
+        for leaderboard in beatmap.leaderboards.values():
+            leaderboard.invalidate()
+
     return f"alreadyvoted\n{avg}".encode()
@@ -1,6 +1,7 @@
 from __future__ import annotations
 
 import asyncio
+from typing import Any
 from typing import Iterable
 from typing import Iterator
 from typing import TypedDict
@@ -11,10 +12,11 @@ import orjson
 import app.state
 import app.usecases
 import log
-from app.constants.privileges import Privileges
+from app.constants.mode import Mode
 from app.objects.beatmap import Beatmap
 from app.objects.beatmap import RankedStatus
 from app.objects.leaderboard import Leaderboard
+from app.objects.leaderboard import LeaderboardScore
 from app.typing import PubsubHandler
 
 
@@ -40,9 +42,9 @@ async def handle_privileges_change(payload: str) -> None:
     data: PrivilegeUpdate = orjson.loads(payload)
 
     for leaderboard in get_leaderboards(app.usecases.beatmap.md5_cache.values()):
-        for score in leaderboard.scores:
-            if score.user_id == data["id"]:
-                score.user_priv = Privileges(data["privileges"])
+        if score := leaderboard.user_scores.get(data["id"]):
+            score.user_priv = data["privileges"]
+            leaderboard.invalidate()
 
     log.info(f"Updated privileges for user ID {data['id']}")
 
@@ -58,14 +60,58 @@ async def handle_map_status_change(payload: str) -> None:
 
     cached_map = app.usecases.beatmap.md5_from_cache(data["md5"])
     if not cached_map:
+        # keep the on-disk copy from serving the old status until the next build
+        if indexed_map := app.usecases.beatmap_index.by_md5(data["md5"]):
+            indexed_map.status = RankedStatus(data["new_status"])
+            indexed_map.frozen = True
+
+            await app.usecases.beatmap_index.record([indexed_map])
+
         return
 
     cached_map.status = RankedStatus(data["new_status"])
     cached_map.frozen = True
+    app.usecases.beatmap.mark_fresh(cached_map)  # frozen maps don't go stale
+
+    for leaderboard in cached_map.leaderboards.values():
+        leaderboard.invalidate()
 
     await app.usecases.beatmap.save_to_database(cached_map)
 
 
+@register_pubsub("beatmap-found")
+async def handle_beatmap_found(payload: str) -> None:
+    md5s: list[str] = orjson.loads(payload)
+
+    for md5 in md5s:
+        app.usecases.missing_beatmap.discard(md5)
+
+
+class LeaderboardScoreUpdate(TypedDict):
+    md5: str
+    mode: int
+    sequence: int
+    score: dict[str, Any]
+
+
+@register_pubsub("leaderboard-score")
+async def handle_leaderboard_score(payload: str) -> None:
+    data: LeaderboardScoreUpdate = orjson.loads(payload)
+
+    cached_map = app.usecases.beatmap.md5_from_cache(data["md5"])
+    if not cached_map:
+        return
+
+    mode = Mode(data["mode"])
+    if mode in cached_map.leaderboards:
+        app.usecases.leaderboard.receive(
+            cached_map,
+            mode,
+            data["sequence"],
+            LeaderboardScore.from_row(data["score"]),
+        )
+
+
 class RedisMessage(TypedDict):
     channel: bytes
     data: bytes
@@ -74,14 +74,7 @@ async def user_registration(
 
         geolocation = app.usecases.geolocation.from_ip(request.headers)
 
-        users = [user["id"] async for user in users_collection.find({})]
-        user_id = len([user for user in users if user != 1]) + 1
-
-        # math fuckery to deal with the ID 2 skip
-        if user_id == 2:
-            user_id = 3
-        else:
-            user_id = user_id + 2
+        user_id = await app.usecases.counters.next_user_id()
 
         await users_collection.insert_one(
             {
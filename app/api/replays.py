@@ -1,10 +1,16 @@
 from __future__ import annotations
 
+import os
 from pathlib import Path
 
 from fastapi import Depends
 from fastapi import Query
 from fastapi.responses import FileResponse
+from fastapi.responses import Response
+from starlette.concurrency import run_in_threadpool
+from starlette.types import Receive
+from starlette.types import Scope
+from starlette.types import Send
 
 import app.usecases
 from app.objects.user import User
@@ -14,11 +20,63 @@ DATA_PATH = Path.cwd() / "data"
 REPLAYS_PATH = DATA_PATH / "replays"
 
 
+class SegmentResponse(Response):
+    media_type = "application/octet-stream"
+
+    def __init__(self, path: Path, offset: int, length: int) -> None:
+        self.path = path
+        self.offset = offset
+        self.length = length
+
+        self.status_code = 200
+        self.background = None
+        self.init_headers({"content-length": str(length)})
+
+    async def __call__(self, scope: Scope, receive: Receive, send: Send) -> None:
+        # opening can block on a cold dentry cache, keep it off the event loop
+        with await run_in_threadpool(self.path.open, "rb") as segment:
+            await send(
+                {
+                    "type": "http.response.start",
+                    "status": self.status_code,
+                    "headers": self.raw_headers,
+                },
+            )
+
+            if "http.response.zerocopysend" in scope.get("extensions", {}):
+                await send(
+                    {
+                        "type": "http.response.zerocopysend",
+                        "file": segment,
+                        "offset": self.offset,
+                        "count": self.length,
+                    },
+                )
+            else:
+                body = await run_in_threadpool(
+                    os.pread,
+                    segment.fileno(),
+                    self.length,
+                    self.offset,
+                )
+                await send({"type": "http.response.body", "body": body})
+
+
 async def get_replay(
     user: User = Depends(authenticate_user(Query, "u", "h")),
     mode: int = Query(..., alias="m", ge=0, le=3),
     score_id: int = Query(..., alias="c", min=0, max=9_223_372_036_854_775_807),
 ):
+    if location := await app.usecases.replay.locate(score_id):
+        await app.usecases.score.increment_replay_views(score_id)
+
+        return SegmentResponse(
+            app.usecases.replay.segment_path(location.segment),
+            location.offset,
+            location.length,
+        )
+
+    # not yet packed into a segment by tools/pack_replays.py
     replay_file = REPLAYS_PATH / f"{score_id}.osr"
     if not replay_file.exists():
         return
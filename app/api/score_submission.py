@@ -1,23 +1,23 @@
 from __future__ import annotations
 
 import copy
-import time
 from base64 import b64decode
-from pathlib import Path
 from typing import NamedTuple
 from typing import Optional
 from typing import TypeVar
 from typing import Union
 
 import orjson
-from aiohttp import ClientSession
 from fastapi import File
 from fastapi import Form
 from fastapi import Header
 from fastapi import Request
 from fastapi.datastructures import FormData
+from motor.motor_asyncio import AsyncIOMotorClientSession
 from py3rijndael import Pkcs7Padding
 from py3rijndael import RijndaelCbc
+from pymongo import InsertOne
+from pymongo import UpdateMany
 from starlette.datastructures import UploadFile as StarletteUploadFile
 
 import app.config
@@ -27,17 +27,12 @@ import app.utils
 import log
 from app.constants.mode import Mode
 from app.constants.privileges import Privileges
+from app.objects.beatmap import Beatmap
 from app.objects.beatmap import RankedStatus
+from app.objects.leaderboard import LeaderboardScore
 from app.objects.score import Score
 from app.objects.score import ScoreStatus
-
-DATA_PATH = Path.cwd() / "data"
-BEATMAPS_PATH = DATA_PATH / "beatmaps"
-REPLAYS_PATH = DATA_PATH / "replays"
-
-for path in (DATA_PATH, BEATMAPS_PATH, REPLAYS_PATH):
-    if not path.exists():
-        path.mkdir(parents=True)
+from app.objects.stats import Stats
 
 
 class ScoreData(NamedTuple):
@@ -88,23 +83,81 @@ def decrypt_score_data(
     return score_data, client_hash_decoded
 
 
-import hashlib
-from fastapi import status
+async def save_playcount(
+    beatmap: Beatmap,
+    passed: bool,
+) -> None:
+    maps_collection = app.state.services.database.maps
+    await maps_collection.update_one(
+        {"md5": beatmap.md5},
+        {
+            "$inc": {"plays": 1, "passes": int(passed)},
+            # ingested beatmaps are saved in the background, this may get here first
+            "$setOnInsert": app.usecases.beatmap.metadata(beatmap),
+        },
+        upsert=True,
+    )
+
+
+def score_writes(score: Score) -> list[Union[InsertOne, UpdateMany]]:
+    writes: list[Union[InsertOne, UpdateMany]] = []
+
+    if score.status == ScoreStatus.BEST:
+        # demote the user's previous best
+        writes.append(
+            UpdateMany(
+                {
+                    "status": 2,
+                    "map_md5": score.map_md5,
+                    "user_id": score.user_id,
+                    "mode": score.mode.value,
+                },
+                {"$set": {"status": 1}},
+            ),
+        )
+
+    writes.append(InsertOne(score.dict()))
+    return writes
+
 
+async def persist_submission(
+    score: Score,
+    stats: Stats,
+    recalc_stats: bool,
+    stopwatch: app.state.metrics.Stopwatch,
+    session: Optional[AsyncIOMotorClientSession] = None,
+) -> None:
+    """Writes a submission to the database.
 
-async def check_local_file(osu_file_path: Path, map_id: int, map_md5: str) -> bool:
-    if (
-        not osu_file_path.exists()
-        or hashlib.md5(osu_file_path.read_bytes()).hexdigest() != map_md5
-    ):
-        async with ClientSession() as session:
-            async with session.get(f"https://old.ppy.sh/osu/{map_id}") as response:
-                if response.status != status.HTTP_200_OK:
-                    return False
+    Without a session, only the score writes and the stats recalc
+    happen here; saving stats is left to the caller. Playcount is never
+    saved here, every submission on a map increments the same document."""
+
+    scores_collection = app.state.services.database.scores
+    await scores_collection.bulk_write(
+        score_writes(score),
+        ordered=True,
+        session=session,
+    )
 
-                osu_file_path.write_bytes(await response.read())
+    if recalc_stats:
+        with stopwatch.nested("stats_recalc"):
+            await app.usecases.stats.recalc(stats, score.mode, score.user_id, session)
 
-    return True
+    if session is not None:
+        await app.usecases.stats.save(stats, score.mode, score.user_id, session)
+
+
+async def announce(message: str) -> None:
+    await app.state.services.redis.publish(
+        "send-public-message",
+        orjson.dumps(
+            {
+                "channel": "#announcements",
+                "message": message,
+            },
+        ),
+    )
 
 
 T = TypeVar("T", bound=Union[int, float])
@@ -130,243 +183,310 @@ async def submit_score(
     client_hash_b64: bytes = Form(..., alias="s"),
     fl_cheat_screenshot: Optional[bytes] = File(None, alias="i"),
 ):
-    start = time.perf_counter_ns()
-
-    score_params = await parse_form(await request.form())
-    if not score_params:
-        return
-
-    score_data_b64, replay_file = score_params
-    score_data, client_hash_decoded = decrypt_score_data(
-        score_data_b64,
-        client_hash_b64,
-        iv_b64,
-        osu_version,
-    )
+    stopwatch = app.state.metrics.Stopwatch("submission")
 
-    beatmap_md5 = score_data[0]
-    if not (beatmap := await app.usecases.beatmap.fetch_by_md5(beatmap_md5)):
-        return b"error: beatmap"
+    try:
+        score_params = await parse_form(await request.form())
+        if not score_params:
+            return
+
+        stopwatch.lap("form_parse")
+
+        score_data_b64, replay_file = score_params
+        score_data, client_hash_decoded = await app.state.executor.run(
+            "decrypt",
+            decrypt_score_data,
+            score_data_b64,
+            client_hash_b64,
+            iv_b64,
+            osu_version,
+        )
+        stopwatch.lap("decrypt")
 
-    username = score_data[1].rstrip()
-    if not (user := await app.utils.get_user(username, password_md5)):
-        return  # we do not depends here as we want to specifically pass an empty response if not logged in
+        beatmap_md5 = score_data[0]
+        if not (beatmap := await app.usecases.beatmap.fetch_by_md5(beatmap_md5)):
+            return b"error: beatmap"
 
-    score = Score.from_submission(score_data[2:], beatmap_md5, user)
-    leaderboard = await app.usecases.leaderboard.fetch(beatmap, score.mode)
+        stopwatch.lap("beatmap_lookup")
 
-    score.acc = app.usecases.score.calculate_accuracy(score)
+        username = score_data[1].rstrip()
+        if not (user := await app.utils.get_user(username, password_md5)):
+            return  # we do not depends here as we want to specifically pass an empty response if not logged in
 
-    osu_file_path = BEATMAPS_PATH / f"{beatmap.id}.osu"
-    if await check_local_file(osu_file_path, beatmap.id, beatmap.md5):
-        if beatmap.mode.as_vn == score.mode.as_vn:
-            # only get pp if the map is not a convert
-            # convert support will come later
-            app.usecases.performance.calculate_score(score, osu_file_path)
+        stopwatch.lap("auth")
 
-        if score.passed:
-            old_best = leaderboard.find_user_score(user.id)
+        score = Score.from_submission(score_data[2:], beatmap_md5, user)
+        leaderboard = await app.usecases.leaderboard.fetch(beatmap, score.mode)
+        stopwatch.lap("leaderboard_fetch")
 
-            if old_best:
-                score.old_best = old_best["score"]
+        score.acc = app.usecases.score.calculate_accuracy(score)
 
-                if score.old_best:
-                    score.old_best.rank = old_best["rank"]
+        osu_file_path = await app.usecases.beatmap_file.fetch(beatmap)
+        stopwatch.lap("osu_file")
 
-            app.usecases.score.calculate_status(score)
-        else:
-            score.status = ScoreStatus.NOT_SUBMITTED
+        old_best_rank = 0
 
-    await app.usecases.user.update_activity(user)
+        if osu_file_path:
+            if beatmap.mode.as_vn == score.mode.as_vn:
+                # only get pp if the map is not a convert
+                # convert support will come later
+                try:
+                    await app.usecases.performance.calculate_score(score, osu_file_path)
+                except Exception:
+                    # another worker may have evicted it since, fetch it again once
+                    if osu_file_path.exists():
+                        raise
 
-    if score.mode != user.status.mode or score.mods != user.status.mods:
-        user.status.mode = score.mode
-        user.status.mods = score.mods
+                    app.usecases.beatmap_file.discard(beatmap.md5)
+                    if osu_file_path := await app.usecases.beatmap_file.fetch(beatmap):
+                        await app.usecases.performance.calculate_score(
+                            score,
+                            osu_file_path,
+                        )
 
-        await app.usecases.user.update_status(user)
+            if score.passed:
+                if old_best := leaderboard.find_user_score(user.id):
+                    score.old_best = old_best["score"]
+                    old_best_rank = old_best["rank"]
 
-    score_collection = app.state.services.database.scores
-    if await score_collection.find_one({"client_checksum": score.client_checksum}):
-        log.warning(f"{user} submitted a duplicate score")
-        return b"error: no"
+                app.usecases.score.calculate_status(score)
+            else:
+                score.status = ScoreStatus.NOT_SUBMITTED
 
-    score.time_elapsed = score_time if score.passed else fail_time
+        stopwatch.lap("pp")
 
-    # std vn pp cap: 650
-    # std rx pp cap: 1400
-    # rest: None (no pp cap)
+        await app.state.deferred.enqueue(app.usecases.user.update_activity(user))
 
-    if beatmap.gives_pp and not (
-        user.privileges & Privileges.WHITELISTED
-        or user.privileges & Privileges.RESTRICTED
-    ):
-        if score.mode == Mode.STD and score.pp >= 650:
-            await app.usecases.user.restrict(
-                user,
-                f"Surpassing Vanilla pp cap: {score.pp:.2f}",
-            )
-        elif score.mode == Mode.STD_RX and score.pp >= 1400:
-            await app.usecases.user.restrict(
-                user,
-                f"Surpassing Relax pp cap: {score.pp:.2f}",
-            )
+        if score.mode != user.status.mode or score.mods != user.status.mods:
+            user.status.mode = score.mode
+            user.status.mods = score.mods
 
-    scores_collection = app.state.services.database.scores
+            await app.state.deferred.enqueue(app.usecases.user.update_status(user))
 
-    if score.status == ScoreStatus.BEST:
-        await scores_collection.update_many(
-            {
-                "status": 2,
-                "map_md5": beatmap.md5,
-                "user_id": user.id,
-                "mode": score.mode.value,
-            },
-            {"$set": {"status": 1}},
-        )
+        if await app.usecases.duplicate.exists(score.client_checksum):
+            log.warning(f"{user} submitted a duplicate score")
+            return b"error: no"
 
-    score.id = await scores_collection.count_documents({}) + 1
-    await scores_collection.insert_one(score.dict())
+        stopwatch.lap("duplicate_check")
 
-    if score.passed:
-        replay_data = await replay_file.read()
+        score.time_elapsed = score_time if score.passed else fail_time
 
-        if len(replay_data) < 24 and not user.privileges & Privileges.RESTRICTED:
-            log.warning(f"{user} submitted a score without a replay")
-            await app.usecases.user.restrict(user, "Submitted score without a replay")
-        else:
-            replay_file = REPLAYS_PATH / f"{score.id}.osr"
-            replay_file.write_bytes(replay_data)
+        # std vn pp cap: 650
+        # std rx pp cap: 1400
+        # rest: None (no pp cap)
 
-    old_stats = await app.usecases.stats.fetch(
-        user.id,
-        user.geolocation.country.acronym,
-        score.mode,
-    )
-    stats = copy.copy(old_stats)
-
-    stats.playcount += 1
-    stats.total_score += score.score
-    stats.total_hits += score.n300 + score.n100 + score.n50 + score.nmiss
+        if beatmap.gives_pp and not (
+            user.privileges & Privileges.WHITELISTED
+            or user.privileges & Privileges.RESTRICTED
+        ):
+            if score.mode == Mode.STD and score.pp >= 650:
+                await app.usecases.user.restrict(
+                    user,
+                    f"Surpassing Vanilla pp cap: {score.pp:.2f}",
+                )
+            elif score.mode == Mode.STD_RX and score.pp >= 1400:
+                await app.usecases.user.restrict(
+                    user,
+                    f"Surpassing Relax pp cap: {score.pp:.2f}",
+                )
+
+        score.id = await app.usecases.counters.next_score_id()
+        stopwatch.lap("score_id")
+
+        old_stats = await app.usecases.stats.fetch(
+            user.id,
+            user.geolocation.country.acronym,
+            score.mode,
+        )
+        stats = copy.copy(old_stats)
 
-    additive = score.score
-    if score.old_best and score.status == ScoreStatus.BEST:
-        additive -= score.old_best.score
+        stats.playcount += 1
+        stats.total_score += score.score
+        stats.total_hits += score.n300 + score.n100 + score.n50 + score.nmiss
 
-    if score.passed and beatmap.status >= RankedStatus.RANKED:
-        if beatmap.status == RankedStatus.RANKED:
-            stats.ranked_score += additive
+        additive = score.score
+        if score.old_best and score.status == ScoreStatus.BEST:
+            additive -= score.old_best.score
 
-        if score.status == ScoreStatus.BEST and score.pp > 0.0:
-            await app.usecases.stats.recalc(stats, score.mode, user.id)
+        if score.passed and beatmap.status >= RankedStatus.RANKED:
+            if beatmap.status == RankedStatus.RANKED:
+                stats.ranked_score += additive
 
-        if score.max_combo > stats.max_combo:
-            stats.max_combo = score.max_combo
+            if score.max_combo > stats.max_combo:
+                stats.max_combo = score.max_combo
 
-    if score.passed and old_stats.pp != stats.pp:
-        await app.usecases.stats.update_rank(
-            stats,
-            score.mode,
-            user.id,
-            user.geolocation.country.acronym,
+        recalc_stats = (
+            score.passed
+            and beatmap.status >= RankedStatus.RANKED
+            and score.status == ScoreStatus.BEST
+            and score.pp > 0.0
         )
 
-    await app.usecases.stats.save(stats, score.mode, user.id)
-    await app.usecases.stats.refresh_stats(score.mode, user.id)
+        save_plays = not user.privileges & Privileges.RESTRICTED
+        if save_plays:
+            beatmap.plays += 1
+            if score.passed:
+                beatmap.passes += 1
+
+        stopwatch.lap("stats")
+
+        if app.state.services.supports_transactions:
+            async with await app.state.services.client.start_session() as session:
+                await session.with_transaction(
+                    lambda session: persist_submission(
+                        score,
+                        stats,
+                        recalc_stats,
+                        stopwatch,
+                        session,
+                    ),
+                )
+        else:
+            await persist_submission(
+                score,
+                stats,
+                recalc_stats,
+                stopwatch,
+            )
+
+            # the next submission reads these back, so they can't wait
+            await app.usecases.stats.save(stats, score.mode, user.id)
+
+        # kept out of the transaction, concurrent plays on a map would conflict
+        if save_plays:
+            await app.state.deferred.enqueue(save_playcount(beatmap, score.passed))
+
+        await app.usecases.duplicate.add(score.client_checksum)
+        stopwatch.lap("db_writes")
 
-    if not user.privileges & Privileges.RESTRICTED:
-        beatmap.plays += 1
         if score.passed:
-            beatmap.passes += 1
+            replay_data = await replay_file.read()
+
+            if len(replay_data) < 24 and not user.privileges & Privileges.RESTRICTED:
+                log.warning(f"{user} submitted a score without a replay")
+                await app.usecases.user.restrict(
+                    user,
+                    "Submitted score without a replay",
+                )
+            else:
+                await app.state.deferred.enqueue(
+                    app.usecases.replay.save(score.id, replay_data),
+                )
+
+            stopwatch.lap("replay")
+
+        if score.passed and old_stats.pp != stats.pp:
+            await app.usecases.stats.update_rank(
+                stats,
+                score.mode,
+                user.id,
+                user.geolocation.country.acronym,
+            )
+
+            stopwatch.lap("rank_update")
 
-        maps_collection = app.state.services.database.maps
-        await maps_collection.update_one(
-            {"md5": beatmap.md5},
-            {"$set": {"plays": beatmap.plays, "passes": beatmap.passes}},
+        # deferred jobs can start before we return, so the refresh
+        # has to wait until the ranks it tells cho to reload are written
+        await app.state.deferred.enqueue(
+            app.usecases.stats.refresh_stats(score.mode, user.id),
         )
 
-    if score.status == ScoreStatus.BEST:
-        leaderboard.add_score(score)
-        score.rank = leaderboard.find_score_rank(score.id)
+        if score.status == ScoreStatus.BEST:
+            leaderboard_score = LeaderboardScore.from_score(score)
+            app.usecases.leaderboard.add_score(leaderboard, leaderboard_score)
+            score.rank = leaderboard.find_score_rank(score.id)
 
-        if (
-            beatmap.has_leaderboard
-            and score.rank == 1
-            and not user.privileges & Privileges.RESTRICTED
-        ):
-            announce_message = (
-                f"{user.embed} has achieved #1 on {beatmap.embed} "
-                f"with {score.mods!r} ({score.mode!r} | {score.pp:.2f}pp)"
+            await app.state.deferred.enqueue(
+                app.usecases.leaderboard.publish_score(
+                    beatmap,
+                    score.mode,
+                    leaderboard_score,
+                ),
             )
 
-            await app.state.services.redis.publish(
-                "send-public-message",
-                orjson.dumps(
-                    {
-                        "channel": "#announcements",
-                        "message": announce_message,
-                    },
+            if (
+                beatmap.has_leaderboard
+                and score.rank == 1
+                and not user.privileges & Privileges.RESTRICTED
+            ):
+                announce_message = (
+                    f"{user.embed} has achieved #1 on {beatmap.embed} "
+                    f"with {score.mods!r} ({score.mode!r} | {score.pp:.2f}pp)"
+                )
+
+                await app.state.deferred.enqueue(announce(announce_message))
+
+            stopwatch.lap("leaderboard_update")
+
+        if not score.passed:
+            return b"error: no"
+
+        if beatmap.gives_pp and not user.privileges & Privileges.RESTRICTED:
+            achievements_str = ""  # TODO: achievements
+
+        if score.old_best:
+            beatmap_ranking_chart = (
+                chart_entry("rank", old_best_rank, score.rank),
+                chart_entry("rankedScore", score.old_best.score, score.score),
+                chart_entry("totalScore", score.old_best.score, score.score),
+                chart_entry("maxCombo", score.old_best.max_combo, score.max_combo),
+                chart_entry(
+                    "accuracy",
+                    round(score.old_best.acc, 2),
+                    round(score.acc, 2),
                 ),
+                chart_entry("pp", round(score.old_best.pp, 2), round(score.pp, 2)),
+            )
+        else:
+            beatmap_ranking_chart = (
+                chart_entry("rank", None, score.rank),
+                chart_entry("rankedScore", None, score.score),
+                chart_entry("totalScore", None, score.score),
+                chart_entry("maxCombo", None, score.max_combo),
+                chart_entry("accuracy", None, round(score.acc, 2)),
+                chart_entry("pp", None, round(score.pp, 2)),
             )
 
-    if not score.passed:
-        return b"error: no"
-
-    if beatmap.gives_pp and not user.privileges & Privileges.RESTRICTED:
-        achievements_str = ""  # TODO: achievements
-
-    if score.old_best:
-        beatmap_ranking_chart = (
-            chart_entry("rank", score.old_best.rank, score.rank),
-            chart_entry("rankedScore", score.old_best.score, score.score),
-            chart_entry("totalScore", score.old_best.score, score.score),
-            chart_entry("maxCombo", score.old_best.max_combo, score.max_combo),
-            chart_entry("accuracy", round(score.old_best.acc, 2), round(score.acc, 2)),
-            chart_entry("pp", round(score.old_best.pp, 2), round(score.pp, 2)),
-        )
-    else:
-        beatmap_ranking_chart = (
-            chart_entry("rank", None, score.rank),
-            chart_entry("rankedScore", None, score.score),
-            chart_entry("totalScore", None, score.score),
-            chart_entry("maxCombo", None, score.max_combo),
-            chart_entry("accuracy", None, round(score.acc, 2)),
-            chart_entry("pp", None, round(score.pp, 2)),
+        overall_ranking_chart = (
+            chart_entry("rank", old_stats.global_rank, stats.global_rank),
+            chart_entry("rankedScore", old_stats.ranked_score, stats.ranked_score),
+            chart_entry("totalScore", old_stats.total_score, stats.total_score),
+            chart_entry("maxCombo", old_stats.max_combo, stats.max_combo),
+            chart_entry(
+                "accuracy",
+                round(old_stats.accuracy, 2),
+                round(stats.accuracy, 2),
+            ),
+            chart_entry("pp", old_stats.pp, stats.pp),
         )
 
-    overall_ranking_chart = (
-        chart_entry("rank", old_stats.global_rank, stats.global_rank),
-        chart_entry("rankedScore", old_stats.ranked_score, stats.ranked_score),
-        chart_entry("totalScore", old_stats.total_score, stats.total_score),
-        chart_entry("maxCombo", old_stats.max_combo, stats.max_combo),
-        chart_entry("accuracy", round(old_stats.accuracy, 2), round(stats.accuracy, 2)),
-        chart_entry("pp", old_stats.pp, stats.pp),
-    )
-
-    submission_charts = [
-        # beatmap info chart
-        f"beatmapId:{beatmap.id}",
-        f"beatmapSetId:{beatmap.set_id}",
-        f"beatmapPlaycount:{beatmap.plays}",
-        f"beatmapPasscount:{beatmap.passes}",
-        f"approvedDate:{beatmap.last_update.isoformat()}",
-        "\n",
-        "chartId:beatmap",
-        f"chartUrl:{beatmap.set_url}",
-        "chartName:Beatmap Ranking",
-        *beatmap_ranking_chart,
-        f"onlineScoreId:{score.id}",
-        "\n",
-        "chartId:overall",
-        f"chartUrl:https://{app.config.SERVER_DOMAIN}/u/{user.id}",
-        "chartName:Overall Ranking",
-        *overall_ranking_chart,
-        f"achievements-new:{achievements_str}",
-    ]
-
-    end = time.perf_counter_ns()
-    formatted_time = log.format_time(end - start)
-    log.info(
-        f"{user} submitted a {score.pp:.2f}pp {score.mode!r} score on {beatmap.full_name} in {formatted_time}",
-    )
+        submission_charts = [
+            # beatmap info chart
+            f"beatmapId:{beatmap.id}",
+            f"beatmapSetId:{beatmap.set_id}",
+            f"beatmapPlaycount:{beatmap.plays}",
+            f"beatmapPasscount:{beatmap.passes}",
+            f"approvedDate:{beatmap.last_update.isoformat()}",
+            "\n",
+            "chartId:beatmap",
+            f"chartUrl:{beatmap.set_url}",
+            "chartName:Beatmap Ranking",
+            *beatmap_ranking_chart,
+            f"onlineScoreId:{score.id}",
+            "\n",
+            "chartId:overall",
+            f"chartUrl:https://{app.config.SERVER_DOMAIN}/u/{user.id}",
+            "chartName:Overall Ranking",
+            *overall_ranking_chart,
+            f"achievements-new:{achievements_str}",
+        ]
+
+        formatted_time = log.format_time(stopwatch.elapsed())
+        log.info(
+            f"{user} submitted a {score.pp:.2f}pp {score.mode!r} score on {beatmap.full_name} in {formatted_time}",
+        )
 
-    return "|".join(submission_charts).encode()
+        return "|".join(submission_charts).encode()
+    finally:
+        # every way out, including the early returns
+        stopwatch.finish()
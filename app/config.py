@@ -8,6 +8,8 @@ cfg = Config(".env")
 MONGODB_DSN: Secret = cfg("MONGODB_DSN", cast=Secret)
 REDIS_DSN: Secret = cfg("REDIS_DSN", cast=Secret)
 
+MONGODB_TRANSACTIONS: bool = cfg("MONGODB_TRANSACTIONS", cast=bool, default=True)
+
 SERVER_DOMAIN: str = cfg("SERVER_DOMAIN")
 SERVER_PORT: int = cfg("SERVER_PORT", cast=int)
 
@@ -21,5 +23,88 @@ MIRROR_URL: str = cfg("MIRROR_URL")
 
 INGAME_REGISTRATION: bool = cfg("INGAME_REGISTRATION", cast=bool)
 
+SCORE_ID_BLOCK_SIZE: int = cfg("SCORE_ID_BLOCK_SIZE", cast=int, default=64)
+
+REPLAY_SEGMENT_SIZE: int = cfg(
+    "REPLAY_SEGMENT_SIZE",
+    cast=int,
+    default=256 * 1024 * 1024,
+)
+
+OSU_FILE_CACHE_SIZE: int = cfg(
+    "OSU_FILE_CACHE_SIZE",
+    cast=int,
+    default=2 * 1024 * 1024 * 1024,
+)
+
+PP_CALCULATOR_CACHE_SIZE: int = cfg(
+    "PP_CALCULATOR_CACHE_SIZE",
+    cast=int,
+    default=256,
+)
+
+DUPLICATE_FILTER_CAPACITY: int = cfg(
+    "DUPLICATE_FILTER_CAPACITY",
+    cast=int,
+    default=10_000_000,
+)
+DUPLICATE_FILTER_ERROR_RATE: float = cfg(
+    "DUPLICATE_FILTER_ERROR_RATE",
+    cast=float,
+    default=0.001,
+)
+DUPLICATE_FILTER_REFRESH_INTERVAL: float = cfg(
+    "DUPLICATE_FILTER_REFRESH_INTERVAL",
+    cast=float,
+    default=300.0,
+)
+RECENT_CHECKSUM_TTL: int = cfg("RECENT_CHECKSUM_TTL", cast=int, default=86400)
+
+LEADERBOARD_CACHE_SCORES: int = cfg(
+    "LEADERBOARD_CACHE_SCORES",
+    cast=int,
+    default=500_000,
+)
+
+BEATMAP_CACHE_SIZE: int = cfg("BEATMAP_CACHE_SIZE", cast=int, default=100_000)
+UNFROZEN_BEATMAP_TTL: int = cfg("UNFROZEN_BEATMAP_TTL", cast=int, default=1800)
+
+BEATMAP_INDEX: bool = cfg("BEATMAP_INDEX", cast=bool, default=False)
+BEATMAP_INDEX_REFRESH_INTERVAL: float = cfg(
+    "BEATMAP_INDEX_REFRESH_INTERVAL",
+    cast=float,
+    default=30.0,
+)
+BEATMAP_INDEX_REBUILD_INTERVAL: float = cfg(
+    "BEATMAP_INDEX_REBUILD_INTERVAL",
+    cast=float,
+    default=86400.0,
+)
+
+MISSING_BEATMAP_CACHE_SIZE: int = cfg(
+    "MISSING_BEATMAP_CACHE_SIZE",
+    cast=int,
+    default=100_000,
+)
+UNSUBMITTED_BEATMAP_TTL: int = cfg("UNSUBMITTED_BEATMAP_TTL", cast=int, default=600)
+OUTDATED_BEATMAP_TTL: int = cfg("OUTDATED_BEATMAP_TTL", cast=int, default=86400)
+MISSING_BEATMAP_SHARED: bool = cfg("MISSING_BEATMAP_SHARED", cast=bool, default=False)
+
+WARMUP_BEATMAPS: int = cfg("WARMUP_BEATMAPS", cast=int, default=0)
+WARMUP_CONCURRENCY: int = cfg("WARMUP_CONCURRENCY", cast=int, default=8)
+
+HTTP_POOL_SIZE: int = cfg("HTTP_POOL_SIZE", cast=int, default=100)
+HTTP_POOL_SIZE_PER_HOST: int = cfg("HTTP_POOL_SIZE_PER_HOST", cast=int, default=20)
+HTTP_KEEPALIVE_TIMEOUT: float = cfg("HTTP_KEEPALIVE_TIMEOUT", cast=float, default=30.0)
+HTTP_DNS_CACHE_TTL: int = cfg("HTTP_DNS_CACHE_TTL", cast=int, default=300)
+HTTP_TIMEOUT: float = cfg("HTTP_TIMEOUT", cast=float, default=10.0)
+
+CPU_POOL_SIZE: int = cfg("CPU_POOL_SIZE", cast=int, default=2)
+CPU_POOL_MAX_QUEUE: int = cfg("CPU_POOL_MAX_QUEUE", cast=int, default=16)
+
+DEFERRED_WORKERS: int = cfg("DEFERRED_WORKERS", cast=int, default=4)
+DEFERRED_QUEUE_SIZE: int = cfg("DEFERRED_QUEUE_SIZE", cast=int, default=1024)
+DEFERRED_DRAIN_TIMEOUT: float = cfg("DEFERRED_DRAIN_TIMEOUT", cast=float, default=10.0)
+
 # do NOT change
 VERSION = "0.1.0"
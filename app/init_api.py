@@ -15,24 +15,70 @@ from starlette.middleware.base import RequestResponseEndpoint
 import app.api
 import app.config
 import app.state
+import app.usecases
 import log
 
 
+async def connect_services() -> None:
+    app.state.services.client = AsyncIOMotorClient(str(app.config.MONGODB_DSN))
+    app.state.services.database = app.state.services.client.aisuru
+
+    if app.config.MONGODB_TRANSACTIONS:
+        # only replica sets and sharded clusters support transactions
+        hello = await app.state.services.client.admin.command("ismaster")
+        app.state.services.supports_transactions = (
+            "setName" in hello or hello.get("msg") == "isdbgrid"
+        )
+
+    await app.state.services.redis.initialize()
+
+
+async def start_subsystems() -> None:
+    app.state.http.start()
+
+    await app.usecases.counters.seed("scores")
+    await app.usecases.counters.seed("users", minimum=2)  # ID 2 is skipped
+
+    await app.usecases.replay.initialise()
+    await app.usecases.beatmap_file.initialise()
+
+    await app.api.redis.initialise_pubsubs()
+
+    app.usecases.duplicate.initialise()
+
+    if app.config.BEATMAP_INDEX:
+        await app.usecases.beatmap_index.initialise()
+
+    app.state.deferred.start()
+    app.state.executor.start()
+
+
+async def stop_subsystems() -> None:
+    await app.state.deferred.drain()
+    app.state.executor.shutdown()
+    await app.state.cancel_tasks()
+    await app.state.http.shutdown()
+
+
 def init_events(asgi_app: FastAPI) -> None:
     @asgi_app.on_event("startup")
     async def on_startup() -> None:
-        app.state.services.client = AsyncIOMotorClient(str(app.config.MONGODB_DSN))
-        app.state.services.database = app.state.services.client.aisuru
+        await connect_services()
+        await start_subsystems()
 
-        await app.state.services.redis.initialize()
-        await app.api.redis.initialise_pubsubs()
+        # uvicorn doesn't accept connections until startup is done
+        if app.config.WARMUP_BEATMAPS > 0:
+            await app.usecases.leaderboard.warm_up(
+                app.config.WARMUP_BEATMAPS,
+                app.config.WARMUP_CONCURRENCY,
+            )
 
         log.info("Web is running!")
 
     @asgi_app.on_event("shutdown")
     async def on_shutdown() -> None:
+        await stop_subsystems()
         await app.state.services.redis.close()
-        await app.state.cancel_tasks()
 
         log.info("Web has stopped!")
 
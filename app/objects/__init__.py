@@ -1,6 +1,8 @@
 from __future__ import annotations
 
 from . import beatmap
+from . import bloom
+from . import histogram
 from . import leaderboard
 from . import score
 from . import stats
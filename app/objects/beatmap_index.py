@@ -0,0 +1,315 @@
+from __future__ import annotations
+
+import hashlib
+import mmap
+import os
+import struct
+from datetime import datetime
+from datetime import timedelta
+from pathlib import Path
+from typing import Iterable
+from typing import Optional
+
+from app.constants.mode import Mode
+from app.objects.beatmap import Beatmap
+from app.objects.beatmap import RankedStatus
+
+MAGIC = b"AISRBMIX"
+VERSION = 1
+
+# magic, version, beatmap count, generation, newest maps collection _id included
+HEADER = struct.Struct("<8sIIQ12s")
+
+# md5, id, set_id, status, mode, frozen, total_length, plays, passes,
+# cs, od, ar, hp, diff, bpm, last_update, max_combo, offset of its strings
+RECORD = struct.Struct("<16sIIbB?xIIIddddddqII")
+MD5_KEY = struct.Struct("<16s")
+
+# (id or set_id, record number), and (filename hash, record number)
+ID_ENTRY = struct.Struct("<II")
+FILENAME_ENTRY = struct.Struct("<QI")
+
+# every string is prefixed with its length
+STRING_LENGTH = struct.Struct("<H")
+
+EPOCH = datetime(1970, 1, 1)
+
+
+def filename_hash(filename: str) -> int:
+    digest = hashlib.blake2b(filename.encode(), digest_size=8).digest()
+    return int.from_bytes(digest, "little")
+
+
+class BeatmapIndex:
+    """A read-only, memory-mapped snapshot of beatmap metadata.
+
+    Records are sorted by md5, with sorted (key, record number) tables
+    for ids, set ids and filename hashes after them. Everything is
+    binary searched in place, so every process mapping the same file
+    shares one copy in the page cache."""
+
+    def __init__(self, path: Path) -> None:
+        with path.open("rb") as index_file:
+            self.inode = os.fstat(index_file.fileno()).st_ino
+            self.map = mmap.mmap(index_file.fileno(), 0, access=mmap.ACCESS_READ)
+
+        (
+            magic,
+            version,
+            self.count,
+            self.generation,
+            last_object_id,
+        ) = HEADER.unpack_from(self.map, 0)
+        if magic != MAGIC or version != VERSION:
+            raise ValueError(f"{path} is not a version {VERSION} beatmap index")
+
+        self.last_object_id = last_object_id if any(last_object_id) else None
+
+        self.records_offset = HEADER.size
+        self.ids_offset = self.records_offset + self.count * RECORD.size
+        self.sets_offset = self.ids_offset + self.count * ID_ENTRY.size
+        self.filenames_offset = self.sets_offset + self.count * ID_ENTRY.size
+        self.strings_offset = self.filenames_offset + self.count * FILENAME_ENTRY.size
+
+    def __len__(self) -> int:
+        return self.count
+
+    @staticmethod
+    def write(
+        path: Path,
+        beatmaps: Iterable[Beatmap],
+        generation: int,
+        last_object_id: Optional[bytes],
+    ) -> None:
+        """Writes a new index, replacing `path` atomically."""
+
+        by_md5 = {beatmap.md5: beatmap for beatmap in beatmaps}
+        ordered = [by_md5[md5] for md5 in sorted(by_md5)]
+
+        records = bytearray()
+        strings = bytearray()
+        for beatmap in ordered:
+            records += RECORD.pack(
+                bytes.fromhex(beatmap.md5),
+                beatmap.id,
+                beatmap.set_id,
+                beatmap.status.value,
+                beatmap.mode.value,
+                beatmap.frozen,
+                beatmap.total_length,
+                beatmap.plays,
+                beatmap.passes,
+                beatmap.cs,
+                beatmap.od,
+                beatmap.ar,
+                beatmap.hp,
+                beatmap.diff,
+                beatmap.bpm,
+                int((beatmap.last_update - EPOCH).total_seconds()),
+                beatmap.max_combo,
+                len(strings),
+            )
+
+            for string in (
+                beatmap.artist,
+                beatmap.title,
+                beatmap.version,
+                beatmap.creator,
+                beatmap.filename,
+            ):
+                encoded = string.encode()
+                strings += STRING_LENGTH.pack(len(encoded)) + encoded
+
+        ids = sorted((beatmap.id, idx) for idx, beatmap in enumerate(ordered))
+        sets = sorted(
+            (beatmap.set_id, beatmap.id, idx) for idx, beatmap in enumerate(ordered)
+        )
+        filenames = sorted(
+            (filename_hash(beatmap.filename), idx)
+            for idx, beatmap in enumerate(ordered)
+        )
+
+        temp_path = path.with_suffix(f".{os.getpid()}.tmp")
+        with temp_path.open("wb") as index_file:
+            index_file.write(
+                HEADER.pack(
+                    MAGIC,
+                    VERSION,
+                    len(ordered),
+                    generation,
+                    last_object_id or bytes(12),
+                ),
+            )
+            index_file.write(records)
+            index_file.write(b"".join(ID_ENTRY.pack(*entry) for entry in ids))
+            index_file.write(
+                b"".join(ID_ENTRY.pack(set_id, idx) for set_id, _, idx in sets),
+            )
+            index_file.write(
+                b"".join(FILENAME_ENTRY.pack(*entry) for entry in filenames),
+            )
+            index_file.write(strings)
+
+        os.replace(temp_path, path)
+
+    def lower_bound(
+        self,
+        offset: int,
+        entry_size: int,
+        key_struct: struct.Struct,
+        key: object,
+    ) -> int:
+        low, high = 0, self.count
+
+        while low < high:
+            middle = (low + high) // 2
+            # the key is always the first field
+            entry_key = key_struct.unpack_from(
+                self.map,
+                offset + middle * entry_size,
+            )[0]
+
+            if entry_key < key:
+                low = middle + 1
+            else:
+                high = middle
+
+        return low
+
+    def matching(
+        self,
+        offset: int,
+        entry: struct.Struct,
+        key: int,
+    ) -> Iterable[int]:
+        """The record numbers of every entry in a (key, record number) table with `key`."""
+
+        idx = self.lower_bound(offset, entry.size, entry, key)
+
+        while idx < self.count:
+            entry_key, record_number = entry.unpack_from(
+                self.map,
+                offset + idx * entry.size,
+            )
+            if entry_key != key:
+                break
+
+            yield record_number
+            idx += 1
+
+    def record(self, record_number: int) -> Beatmap:
+        (
+            md5,
+            id,
+            set_id,
+            status,
+            mode,
+            frozen,
+            total_length,
+            plays,
+            passes,
+            cs,
+            od,
+            ar,
+            hp,
+            diff,
+            bpm,
+            last_update,
+            max_combo,
+            strings_offset,
+        ) = RECORD.unpack_from(
+            self.map,
+            self.records_offset + record_number * RECORD.size,
+        )
+
+        strings = []
+        position = self.strings_offset + strings_offset
+        for _ in range(5):
+            (length,) = STRING_LENGTH.unpack_from(self.map, position)
+            position += STRING_LENGTH.size
+
+            strings.append(self.map[position : position + length].decode())
+            position += length
+
+        artist, title, version, creator, filename = strings
+
+        return Beatmap(
+            md5.hex(),
+            id,
+            set_id,
+            artist,
+            title,
+            version,
+            creator,
+            total_length,
+            RankedStatus(status),
+            plays,
+            passes,
+            Mode(mode),
+            cs,
+            od,
+            ar,
+            hp,
+            diff,
+            EPOCH + timedelta(seconds=last_update),
+            max_combo,
+            bpm,
+            filename,
+            frozen,
+        )
+
+    def md5_record(self, md5: str) -> Optional[int]:
+        try:
+            key = bytes.fromhex(md5)
+        except ValueError:
+            return None
+
+        # only exact matches, like the maps collection
+        if len(key) != MD5_KEY.size or key.hex() != md5:
+            return None
+
+        idx = self.lower_bound(self.records_offset, RECORD.size, MD5_KEY, key)
+        if idx == self.count:
+            return None
+
+        (found,) = MD5_KEY.unpack_from(
+            self.map,
+            self.records_offset + idx * RECORD.size,
+        )
+        if found != key:
+            return None
+
+        return idx
+
+    def __contains__(self, md5: str) -> bool:
+        return self.md5_record(md5) is not None
+
+    def find_md5(self, md5: str) -> Optional[Beatmap]:
+        if (record_number := self.md5_record(md5)) is None:
+            return None
+
+        return self.record(record_number)
+
+    def find_id(self, id: int) -> Optional[Beatmap]:
+        for record_number in self.matching(self.ids_offset, ID_ENTRY, id):
+            return self.record(record_number)
+
+        return None
+
+    def find_set(self, set_id: int) -> list[Beatmap]:
+        return [
+            self.record(record_number)
+            for record_number in self.matching(self.sets_offset, ID_ENTRY, set_id)
+        ]
+
+    def find_filename(self, filename: str) -> Optional[Beatmap]:
+        for record_number in self.matching(
+            self.filenames_offset,
+            FILENAME_ENTRY,
+            filename_hash(filename),
+        ):
+            beatmap = self.record(record_number)
+            if beatmap.filename == filename:
+                return beatmap
+
+        return None
@@ -0,0 +1,72 @@
+from __future__ import annotations
+
+from bisect import bisect_left
+from typing import Any
+
+# upper bounds of each bucket, doubling from 10µs up to ~84s
+BUCKET_BOUNDS_NS = tuple(10_000 * 2**idx for idx in range(24))
+
+
+class Histogram:
+    """A fixed-bucket latency histogram, cheap enough to update per request."""
+
+    __slots__ = ("buckets", "count", "total_ns", "max_ns")
+
+    def __init__(self) -> None:
+        # the last bucket catches everything over the largest bound
+        self.buckets = [0] * (len(BUCKET_BOUNDS_NS) + 1)
+        self.count = 0
+        self.total_ns = 0
+        self.max_ns = 0
+
+    def observe(self, elapsed_ns: int) -> None:
+        self.buckets[bisect_left(BUCKET_BOUNDS_NS, elapsed_ns)] += 1
+        self.count += 1
+        self.total_ns += elapsed_ns
+
+        if elapsed_ns > self.max_ns:
+            self.max_ns = elapsed_ns
+
+    def quantile(self, quantile: float) -> int:
+        """An upper bound for the `quantile`th observation, in nanoseconds."""
+
+        if not self.count:
+            return 0
+
+        target = quantile * self.count
+        seen = 0
+
+        for idx, bucket_count in enumerate(self.buckets):
+            seen += bucket_count
+
+            if seen >= target:
+                if idx == len(BUCKET_BOUNDS_NS):
+                    return self.max_ns
+
+                return min(BUCKET_BOUNDS_NS[idx], self.max_ns)
+
+        return self.max_ns
+
+    @property
+    def average_ns(self) -> float:
+        return self.total_ns / self.count if self.count else 0.0
+
+    def summary(self) -> dict[str, Any]:
+        # cumulative, like prometheus' le buckets
+        buckets = {}
+        seen = 0
+        for bound, bucket_count in zip(BUCKET_BOUNDS_NS, self.buckets):
+            seen += bucket_count
+            buckets[f"{bound / 1e6:g}"] = seen
+
+        buckets["+Inf"] = self.count
+
+        return {
+            "count": self.count,
+            "average_ms": self.average_ns / 1e6,
+            "p50_ms": self.quantile(0.5) / 1e6,
+            "p95_ms": self.quantile(0.95) / 1e6,
+            "p99_ms": self.quantile(0.99) / 1e6,
+            "max_ms": self.max_ns / 1e6,
+            "buckets_ms": buckets,
+        }
@@ -1,64 +1,396 @@
 from __future__ import annotations
 
+import sys
+from bisect import bisect_left
+from collections import defaultdict
 from dataclasses import dataclass
 from dataclasses import field
+from datetime import datetime
+from typing import Any
+from typing import Iterable
 from typing import Optional
 from typing import TYPE_CHECKING
 from typing import TypedDict
 
 from app.constants.mode import Mode
+from app.constants.privileges import Privileges
 
 if TYPE_CHECKING:
+    from app.objects.beatmap import Beatmap
     from app.objects.score import Score
 
 
+# the fields `LeaderboardScore.from_row` needs from a score document,
+# besides the owner's name, privileges and country
+LEADERBOARD_PROJECTION = {
+    "_id": 0,
+    "id": 1,
+    "user_id": 1,
+    "mods": 1,
+    "pp": 1,
+    "score": 1,
+    "max_combo": 1,
+    "acc": 1,
+    "n300": 1,
+    "n100": 1,
+    "n50": 1,
+    "nmiss": 1,
+    "ngeki": 1,
+    "nkatu": 1,
+    "perfect": 1,
+    "time": 1,
+}
+
+
+@dataclass
+class LeaderboardScore:
+    """A personal best, as little of it as a leaderboard needs.
+
+    Enums are kept as plain ints, the time as a unix timestamp, and
+    usernames and countries are interned across all leaderboards."""
+
+    __slots__ = (
+        "id",
+        "user_id",
+        "username",
+        "user_priv",
+        "user_country",
+        "mods",
+        "pp",
+        "score",
+        "max_combo",
+        "acc",
+        "n300",
+        "n100",
+        "n50",
+        "nmiss",
+        "ngeki",
+        "nkatu",
+        "perfect",
+        "timestamp",
+    )
+
+    id: int
+    user_id: int
+    username: str
+    user_priv: int
+    user_country: str
+    mods: int
+    pp: float
+    score: int
+    max_combo: int
+    acc: float
+    n300: int
+    n100: int
+    n50: int
+    nmiss: int
+    ngeki: int
+    nkatu: int
+    perfect: bool
+    timestamp: int
+
+    def osu_string(self, username: str, rank: int, mode: Mode) -> str:
+        if mode > Mode.MANIA:
+            score = int(self.pp)
+        else:
+            score = self.score
+
+        return (
+            f"{self.id}|{username}|{score}|{self.max_combo}|{self.n50}|{self.n100}|{self.n300}|{self.nmiss}|"
+            f"{self.nkatu}|{self.ngeki}|{int(self.perfect)}|{self.mods}|{self.user_id}|{rank}|{self.timestamp}|"
+            "1"  # has replay
+        )
+
+    @classmethod
+    def from_row(cls, row: dict[str, Any]) -> LeaderboardScore:
+        return cls(
+            id=row["id"],
+            user_id=row["user_id"],
+            username=sys.intern(row["username"]),
+            user_priv=row["user_priv"],
+            user_country=sys.intern(row["user_country"]),
+            mods=row["mods"],
+            pp=row["pp"],
+            score=row["score"],
+            max_combo=row["max_combo"],
+            acc=row["acc"],
+            n300=row["n300"],
+            n100=row["n100"],
+            n50=row["n50"],
+            nmiss=row["nmiss"],
+            ngeki=row["ngeki"],
+            nkatu=row["nkatu"],
+            perfect=row["perfect"],
+            timestamp=int(datetime.fromisoformat(row["time"]).timestamp()),
+        )
+
+    @classmethod
+    def from_score(cls, score: Score) -> LeaderboardScore:
+        return cls(
+            id=score.id,
+            user_id=score.user_id,
+            username=sys.intern(score.username),
+            user_priv=score.user_priv.value,
+            user_country=sys.intern(score.user_country),
+            mods=score.mods.value,
+            pp=score.pp,
+            score=score.score,
+            max_combo=score.max_combo,
+            acc=score.acc,
+            n300=score.n300,
+            n100=score.n100,
+            n50=score.n50,
+            nmiss=score.nmiss,
+            ngeki=score.ngeki,
+            nkatu=score.nkatu,
+            perfect=score.perfect,
+            timestamp=int(score.time.timestamp()),
+        )
+
+    def row(self) -> dict[str, Any]:
+        """The inverse of `LeaderboardScore.from_row`."""
+
+        return {
+            "id": self.id,
+            "user_id": self.user_id,
+            "username": self.username,
+            "user_priv": self.user_priv,
+            "user_country": self.user_country,
+            "mods": self.mods,
+            "pp": self.pp,
+            "score": self.score,
+            "max_combo": self.max_combo,
+            "acc": self.acc,
+            "n300": self.n300,
+            "n100": self.n100,
+            "n50": self.n50,
+            "nmiss": self.nmiss,
+            "ngeki": self.ngeki,
+            "nkatu": self.nkatu,
+            "perfect": self.perfect,
+            "time": datetime.fromtimestamp(self.timestamp).isoformat(),
+        }
+
+
 class UserScore(TypedDict):
-    score: Score
+    score: LeaderboardScore
     rank: int
 
 
+# best first, ties go to whoever set it first
+SortKey = tuple[float, int, int]
+
+SCORES_SHOWN = 250  # TODO: custom limit?
+
+
+@dataclass
+class SortedScores:
+    # `keys[i]` is always the sort key of `scores[i]`
+    scores: list[LeaderboardScore] = field(default_factory=list)
+    keys: list[SortKey] = field(default_factory=list, repr=False)
+
+    def __len__(self) -> int:
+        return len(self.scores)
+
+    def index(self, key: SortKey) -> int:
+        return bisect_left(self.keys, key)
+
+    def insert(self, key: SortKey, score: LeaderboardScore) -> None:
+        index = bisect_left(self.keys, key)
+
+        self.scores.insert(index, score)
+        self.keys.insert(index, key)
+
+    def remove(self, key: SortKey) -> None:
+        index = bisect_left(self.keys, key)
+
+        del self.scores[index]
+        del self.keys[index]
+
+
 @dataclass
 class Leaderboard:
     mode: Mode
-    scores: list[Score] = field(default_factory=list)
+
+    ranking: SortedScores = field(default_factory=SortedScores, repr=False)
+
+    user_scores: dict[int, LeaderboardScore] = field(default_factory=dict, repr=False)
+    score_ids: dict[int, LeaderboardScore] = field(default_factory=dict, repr=False)
+
+    # secondary views for the country and mods tabs
+    countries: defaultdict[str, SortedScores] = field(
+        default_factory=lambda: defaultdict(SortedScores),
+        repr=False,
+    )
+    mods: defaultdict[int, SortedScores] = field(
+        default_factory=lambda: defaultdict(SortedScores),
+        repr=False,
+    )
+
+    # bumped on every change to what the leaderboard would show
+    version: int = 0
+
+    # whether its scores count towards `app.usecases.leaderboard.total_scores`
+    resident: bool = field(default=False, repr=False)
+
+    # the last replicated update applied, see `app.usecases.leaderboard.receive`
+    sequence: int = 0
+
+    # replicated updates that arrived before an earlier one,
+    # {sequence: score, or None if it was published from here}
+    pending: dict[int, Optional[LeaderboardScore]] = field(
+        default_factory=dict,
+        repr=False,
+    )
+    pending_since: float = field(default=0.0, repr=False)
+
+    rendered_version: int = field(default=-1, repr=False)
+    rendered_header: bytes = field(default=b"", repr=False)
+    rendered_rows: bytes = field(default=b"", repr=False)
 
     def __len__(self) -> int:
-        return len(self.scores)
+        return len(self.ranking)
+
+    @property
+    def scores(self) -> list[LeaderboardScore]:
+        return self.ranking.scores
+
+    def invalidate(self) -> None:
+        self.version += 1
+
+    def render(self, beatmap: Beatmap, rating: float) -> tuple[bytes, bytes]:
+        """The beatmap header and the visible top scores, as the client expects them.
+
+        Rows are rendered with the username on the score, and scores
+        from disallowed users are left out."""
+
+        if self.rendered_version != self.version:
+            self.rendered_header = beatmap.osu_string(
+                score_count=len(self),
+                rating=rating,
+            ).encode()
+
+            rows: list[bytes] = []
+            for idx, score in enumerate(self.scores):
+                if len(rows) == SCORES_SHOWN:
+                    break
+
+                if not score.user_priv & Privileges.DISALLOWED:
+                    row = score.osu_string(score.username, idx + 1, self.mode)
+                    rows.append(row.encode())
+
+            self.rendered_rows = b"\n".join(rows)
+
+            self.rendered_version = self.version
+
+        return self.rendered_header, self.rendered_rows
+
+    def sort_key(self, score: LeaderboardScore) -> SortKey:
+        # ids come from per-worker blocks, so they don't follow submission
+        # order. they only break ties between scores set in the same second
+        if self.mode > Mode.MANIA:
+            return (-score.pp, score.timestamp, score.id)
+        else:
+            return (-score.score, score.timestamp, score.id)
+
+    def index_of(self, score: LeaderboardScore) -> int:
+        return self.ranking.index(self.sort_key(score))
+
+    def load(self, scores: Iterable[LeaderboardScore]) -> None:
+        """Replaces the leaderboard's contents, sorting only once."""
+
+        self.ranking = SortedScores()
+        self.user_scores = {}
+        self.score_ids = {}
+        self.countries.clear()
+        self.mods.clear()
+
+        for score in sorted(scores, key=self.sort_key):
+            # only ever one best per user, even if the database disagrees
+            if score.user_id in self.user_scores:
+                continue
+
+            key = self.sort_key(score)
 
-    def remove_score_index(self, index: int) -> None:
-        self.scores.pop(index)
+            # already in order, so appending keeps every view sorted
+            for view in (
+                self.ranking,
+                self.countries[score.user_country],
+                self.mods[score.mods],
+            ):
+                view.scores.append(score)
+                view.keys.append(key)
+
+            self.user_scores[score.user_id] = score
+            self.score_ids[score.id] = score
+
+        self.invalidate()
 
     def find_user_score(self, user_id: int) -> Optional[UserScore]:
-        for idx, score in enumerate(self.scores):
-            if score.user_id == user_id:
-                return {
-                    "score": score,
-                    "rank": idx + 1,
-                }
+        if score := self.user_scores.get(user_id):
+            return {
+                "score": score,
+                "rank": self.index_of(score) + 1,
+            }
 
     def find_score_rank(self, score_id: int) -> int:
-        for idx, score in enumerate(self.scores):
-            if score.id == score_id:
-                return idx + 1
+        if score := self.score_ids.get(score_id):
+            return self.index_of(score) + 1
 
         return 0
 
-    def remove_user(self, user_id: int) -> None:
-        result = self.find_user_score(user_id)
+    def country_scores(self, country: str) -> list[LeaderboardScore]:
+        if view := self.countries.get(country):
+            return view.scores
 
-        if result is not None:
-            self.remove_score_index(result["rank"] - 1)
+        return []
 
-    def sort(self) -> None:
-        if self.mode > Mode.MANIA:
-            sort = lambda score: score.pp
-        else:
-            sort = lambda score: score.score
+    def mods_scores(self, mods: int) -> list[LeaderboardScore]:
+        if view := self.mods.get(mods):
+            return view.scores
+
+        return []
+
+    def user_ids_scores(self, user_ids: Iterable[int]) -> list[LeaderboardScore]:
+        scores = [
+            score for user_id in user_ids if (score := self.user_scores.get(user_id))
+        ]
+
+        return sorted(scores, key=self.sort_key)
+
+    def remove_score(self, score: LeaderboardScore) -> None:
+        key = self.sort_key(score)
 
-        self.scores = sorted(self.scores, key=sort, reverse=True)
+        self.ranking.remove(key)
+        self.countries[score.user_country].remove(key)
+        self.mods[score.mods].remove(key)
 
-    def add_score(self, score: Score) -> None:
+        # don't keep empty views around
+        if not self.countries[score.user_country]:
+            del self.countries[score.user_country]
+
+        if not self.mods[score.mods]:
+            del self.mods[score.mods]
+
+        del self.user_scores[score.user_id]
+        del self.score_ids[score.id]
+
+        self.invalidate()
+
+    def remove_user(self, user_id: int) -> None:
+        if score := self.user_scores.get(user_id):
+            self.remove_score(score)
+
+    def add_score(self, score: LeaderboardScore) -> None:
         self.remove_user(score.user_id)
 
-        self.scores.append(score)
-        self.sort()
+        key = self.sort_key(score)
+
+        self.ranking.insert(key, score)
+        self.countries[score.user_country].insert(key, score)
+        self.mods[score.mods].insert(key, score)
+
+        self.user_scores[score.user_id] = score
+        self.score_ids[score.id] = score
+
+        self.invalidate()
@@ -0,0 +1,111 @@
+from __future__ import annotations
+
+import mmap
+import os
+import struct
+from array import array
+from pathlib import Path
+from typing import NamedTuple
+from typing import Optional
+
+# score_id, segment, offset, length
+RECORD = struct.Struct("<QIQI")
+SCORE_ID_KEY = struct.Struct("<Q")
+
+
+class ReplayLocation(NamedTuple):
+    segment: int
+    offset: int
+    length: int
+
+
+class ReplayIndex:
+    """A memory-mapped view of the replay index file.
+
+    Records stay in the order they were appended, shared by every
+    process through the page cache. Each process only keeps the record
+    numbers sorted by score id (4 bytes a replay) to binary search them."""
+
+    def __init__(
+        self,
+        index_map: Optional[mmap.mmap] = None,
+        order: Optional[array[int]] = None,
+    ) -> None:
+        self.map = index_map
+        self.count = len(index_map) // RECORD.size if index_map is not None else 0
+        self.order = order if order is not None else array("I")
+
+    def __len__(self) -> int:
+        return len(self.order)
+
+    def score_id(self, record_number: int) -> int:
+        (score_id,) = SCORE_ID_KEY.unpack_from(self.map, record_number * RECORD.size)
+        return score_id
+
+    def lower_bound(self, score_id: int) -> int:
+        low, high = 0, len(self.order)
+
+        while low < high:
+            middle = (low + high) // 2
+
+            if self.score_id(self.order[middle]) < score_id:
+                low = middle + 1
+            else:
+                high = middle
+
+        return low
+
+    def add(self, record_number: int) -> None:
+        score_id = self.score_id(record_number)
+
+        # ids are handed out in blocks per worker, so appends are mostly in order
+        if not self.order or self.score_id(self.order[-1]) <= score_id:
+            self.order.append(record_number)
+        else:
+            self.order.insert(self.lower_bound(score_id), record_number)
+
+    def find(self, score_id: int) -> Optional[ReplayLocation]:
+        idx = self.lower_bound(score_id)
+        if idx == len(self.order):
+            return None
+
+        found, *location = RECORD.unpack_from(
+            self.map,
+            self.order[idx] * RECORD.size,
+        )
+        if found != score_id:
+            return None
+
+        return ReplayLocation(*location)
+
+    def __contains__(self, score_id: int) -> bool:
+        return self.find(score_id) is not None
+
+    def extended(self, path: Path) -> ReplayIndex:
+        """Maps `path` again, adding the records appended since this view.
+
+        Returns this view if nothing new has been appended."""
+
+        if not path.exists():
+            return self
+
+        with path.open("rb") as index_file:
+            size = os.fstat(index_file.fileno()).st_size
+
+            # a record may still be mid-write by another worker
+            count = size // RECORD.size
+            if count <= self.count:
+                return self
+
+            index_map = mmap.mmap(
+                index_file.fileno(),
+                count * RECORD.size,
+                access=mmap.ACCESS_READ,
+            )
+
+        # readers may still be searching this view, so work on a copy
+        index = ReplayIndex(index_map, array("I", self.order))
+        for record_number in range(self.count, count):
+            index.add(record_number)
+
+        return index
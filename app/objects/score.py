@@ -6,6 +6,7 @@ from datetime import datetime
 from enum import IntEnum
 from typing import Any
 from typing import Optional
+from typing import TYPE_CHECKING
 
 from app.constants.flags import ClientFlags
 from app.constants.mode import Mode
@@ -13,6 +14,9 @@ from app.constants.mods import Mods
 from app.constants.privileges import Privileges
 from app.objects.user import User
 
+if TYPE_CHECKING:
+    from app.objects.leaderboard import LeaderboardScore
+
 
 class Grade(IntEnum):
     N = 0
@@ -91,7 +95,7 @@ class Score:
     replay_views: int
 
     rank: int = 0
-    old_best: Optional[Score] = None
+    old_best: Optional[LeaderboardScore] = None
 
     def osu_string(self, username: str, rank: int) -> str:
         if self.mode > Mode.MANIA:
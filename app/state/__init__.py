@@ -4,6 +4,10 @@ import asyncio
 
 import log
 from . import cache
+from . import deferred
+from . import executor
+from . import http
+from . import metrics
 from . import services
 from app.typing import PubsubHandler
 
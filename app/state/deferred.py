@@ -0,0 +1,69 @@
+from __future__ import annotations
+
+import asyncio
+from typing import Awaitable
+from typing import Optional
+
+import app.config
+import app.state
+import log
+
+queue: Optional[asyncio.Queue[Awaitable[None]]] = None
+
+
+async def worker() -> None:
+    while True:
+        job = await queue.get()
+
+        try:
+            await job
+        except Exception as exc:
+            log.error(f"Deferred job failed: {exc!r}")
+        finally:
+            queue.task_done()
+
+
+def start() -> None:
+    global queue
+    queue = asyncio.Queue(maxsize=app.config.DEFERRED_QUEUE_SIZE)
+
+    for _ in range(app.config.DEFERRED_WORKERS):
+        worker_task = asyncio.create_task(worker())
+        app.state.tasks.add(worker_task)
+
+
+async def enqueue(job: Awaitable[None]) -> None:
+    """Runs `job` on one of the deferred workers, which may pick it
+    up before the handler that enqueued it has returned.
+
+    Falls back to awaiting the job inline if the pool
+    hasn't been started or its queue is full."""
+
+    if queue is None:
+        await job
+        return
+
+    try:
+        queue.put_nowait(job)
+    except asyncio.QueueFull:
+        log.warning("Deferred queue is full, running job inline")
+        await job
+
+
+async def drain() -> None:
+    if queue is None:
+        return
+
+    log.info(f"Draining {queue.qsize()} deferred jobs.")
+
+    try:
+        await asyncio.wait_for(queue.join(), app.config.DEFERRED_DRAIN_TIMEOUT)
+    except asyncio.TimeoutError:
+        log.warning(f"Gave up draining, {queue.qsize()} deferred jobs were dropped")
+
+        while not queue.empty():
+            job = queue.get_nowait()
+            if asyncio.iscoroutine(job):
+                job.close()
+
+            queue.task_done()
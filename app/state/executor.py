@@ -0,0 +1,119 @@
+from __future__ import annotations
+
+import asyncio
+import multiprocessing
+import time
+from concurrent.futures import ProcessPoolExecutor
+from concurrent.futures.process import BrokenProcessPool
+from dataclasses import dataclass
+from typing import Any
+from typing import Callable
+from typing import Optional
+from typing import TypeVar
+
+import app.config
+import log
+
+T = TypeVar("T")
+
+pool: Optional[ProcessPoolExecutor] = None
+in_flight = 0
+
+
+@dataclass
+class TaskTimings:
+    count: int = 0
+    inline: int = 0
+    total_ns: int = 0
+    max_ns: int = 0
+
+    @property
+    def average_ns(self) -> float:
+        return self.total_ns / self.count if self.count else 0.0
+
+
+timings: dict[str, TaskTimings] = {}  # {task name: TaskTimings}
+
+
+def start() -> None:
+    global pool
+
+    if app.config.CPU_POOL_SIZE > 0:
+        pool = ProcessPoolExecutor(
+            max_workers=app.config.CPU_POOL_SIZE,
+            # forking a process with a running event loop is unsafe
+            mp_context=multiprocessing.get_context("spawn"),
+        )
+
+
+def shutdown() -> None:
+    global pool
+
+    if pool is not None:
+        pool.shutdown(wait=True, cancel_futures=True)
+        pool = None
+
+
+def restart(broken_pool: ProcessPoolExecutor) -> None:
+    global pool
+
+    # another task from the same pool may have restarted it already
+    if pool is not broken_pool:
+        return
+
+    log.error("CPU pool broke, restarting it")
+
+    # its processes are already gone, don't block the event loop on them
+    broken_pool.shutdown(wait=False, cancel_futures=True)
+    pool = None
+    start()
+
+
+def queue_depth() -> int:
+    return max(in_flight - app.config.CPU_POOL_SIZE, 0)
+
+
+def saturated() -> bool:
+    return in_flight >= app.config.CPU_POOL_SIZE + app.config.CPU_POOL_MAX_QUEUE
+
+
+async def run(name: str, func: Callable[..., T], *args: Any) -> T:
+    """Runs `func(*args)` in the CPU pool.
+
+    `func` and its arguments must be picklable. When the pool is
+    disabled or saturated, `func` is run inline on the event loop.
+
+    If the pool breaks, it's restarted and BrokenProcessPool is raised.
+    `func` isn't retried, inline or in the new pool, since it may well
+    be what crashed it."""
+
+    global in_flight
+
+    if not (task_timings := timings.get(name)):
+        task_timings = timings[name] = TaskTimings()
+
+    start_time = time.perf_counter_ns()
+
+    if pool is None or saturated():
+        result = func(*args)
+        task_timings.inline += 1
+    else:
+        in_flight += 1
+        task_pool = pool
+
+        try:
+            loop = asyncio.get_running_loop()
+            result = await loop.run_in_executor(task_pool, func, *args)
+        except BrokenProcessPool:
+            restart(task_pool)
+            raise
+        finally:
+            in_flight -= 1
+
+    elapsed = time.perf_counter_ns() - start_time
+
+    task_timings.count += 1
+    task_timings.total_ns += elapsed
+    task_timings.max_ns = max(task_timings.max_ns, elapsed)
+
+    return result
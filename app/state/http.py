@@ -0,0 +1,120 @@
+from __future__ import annotations
+
+import asyncio
+import time
+from contextlib import asynccontextmanager
+from dataclasses import dataclass
+from typing import Any
+from typing import AsyncContextManager
+from typing import AsyncIterator
+from typing import Optional
+
+from aiohttp import ClientError
+from aiohttp import ClientResponse
+from aiohttp import ClientSession
+from aiohttp import ClientTimeout
+from aiohttp import TCPConnector
+
+import app.config
+
+session: Optional[ClientSession] = None
+
+
+@dataclass
+class UpstreamStats:
+    requests: int = 0
+    errors: int = 0  # connection errors and timeouts
+    error_statuses: int = 0  # responses other than 2xx
+    total_ns: int = 0
+    max_ns: int = 0
+
+    @property
+    def average_ns(self) -> float:
+        return self.total_ns / self.requests if self.requests else 0.0
+
+
+upstreams: dict[str, UpstreamStats] = {}  # {upstream name: UpstreamStats}
+
+
+def create_session() -> ClientSession:
+    return ClientSession(
+        connector=TCPConnector(
+            limit=app.config.HTTP_POOL_SIZE,
+            limit_per_host=app.config.HTTP_POOL_SIZE_PER_HOST,
+            ttl_dns_cache=app.config.HTTP_DNS_CACHE_TTL,
+            keepalive_timeout=app.config.HTTP_KEEPALIVE_TIMEOUT,
+        ),
+        timeout=ClientTimeout(total=app.config.HTTP_TIMEOUT),
+    )
+
+
+def start() -> None:
+    global session
+    session = create_session()
+
+
+async def shutdown() -> None:
+    global session
+
+    if session is not None:
+        await session.close()
+        session = None
+
+
+@asynccontextmanager
+async def request(
+    upstream: str,
+    method: str,
+    url: str,
+    **kwargs: Any,
+) -> AsyncIterator[ClientResponse]:
+    """Makes a request through the shared connection pool.
+
+    Latency (including reading the body inside the block) and errors
+    are counted under `upstream`. Before `start`, a one-off session
+    is used instead."""
+
+    if not (upstream_stats := upstreams.get(upstream)):
+        upstream_stats = upstreams[upstream] = UpstreamStats()
+
+    one_off_session = None
+    if (request_session := session) is None:
+        request_session = one_off_session = create_session()
+
+    start_time = time.perf_counter_ns()
+
+    try:
+        async with request_session.request(method, url, **kwargs) as response:
+            if not 200 <= response.status < 300:
+                upstream_stats.error_statuses += 1
+
+            yield response
+    except (ClientError, asyncio.TimeoutError):
+        upstream_stats.errors += 1
+        raise
+    finally:
+        elapsed = time.perf_counter_ns() - start_time
+
+        upstream_stats.requests += 1
+        upstream_stats.total_ns += elapsed
+        upstream_stats.max_ns = max(upstream_stats.max_ns, elapsed)
+
+        if one_off_session is not None:
+            await one_off_session.close()
+
+
+def get(upstream: str, url: str, **kwargs: Any) -> AsyncContextManager[ClientResponse]:
+    return request(upstream, "GET", url, **kwargs)
+
+
+def stats() -> dict[str, Any]:
+    return {
+        name: {
+            "requests": upstream_stats.requests,
+            "errors": upstream_stats.errors,
+            "error_statuses": upstream_stats.error_statuses,
+            "average_ms": upstream_stats.average_ns / 1e6,
+            "max_ms": upstream_stats.max_ns / 1e6,
+        }
+        for name, upstream_stats in upstreams.items()
+    }
@@ -0,0 +1,66 @@
+from __future__ import annotations
+
+import time
+from contextlib import contextmanager
+from typing import Iterator
+
+from app.objects.histogram import Histogram
+
+histograms: dict[str, Histogram] = {}  # {metric name: Histogram}
+
+
+def observe(name: str, elapsed_ns: int) -> None:
+    if not (histogram := histograms.get(name)):
+        histogram = histograms[name] = Histogram()
+
+    histogram.observe(elapsed_ns)
+
+
+@contextmanager
+def timed(name: str) -> Iterator[None]:
+    start = time.perf_counter_ns()
+
+    try:
+        yield
+    finally:
+        observe(name, time.perf_counter_ns() - start)
+
+
+class Stopwatch:
+    """Times consecutive stages of a request, each into its own histogram."""
+
+    def __init__(self, prefix: str) -> None:
+        self.prefix = prefix
+        self.start = self.last = time.perf_counter_ns()
+
+        self.nested_ns = 0  # timed separately, so left out of the current lap
+
+    def lap(self, stage: str) -> None:
+        now = time.perf_counter_ns()
+        observe(f"{self.prefix}.{stage}", now - self.last - self.nested_ns)
+
+        self.last = now
+        self.nested_ns = 0
+
+    @contextmanager
+    def nested(self, stage: str) -> Iterator[None]:
+        """Times a stage inside the current lap, without counting it twice."""
+
+        start = time.perf_counter_ns()
+
+        try:
+            yield
+        finally:
+            elapsed = time.perf_counter_ns() - start
+            observe(f"{self.prefix}.{stage}", elapsed)
+
+            self.nested_ns += elapsed
+
+    def elapsed(self) -> int:
+        return time.perf_counter_ns() - self.start
+
+    def finish(self) -> int:
+        elapsed = self.elapsed()
+        observe(f"{self.prefix}.total", elapsed)
+
+        return elapsed
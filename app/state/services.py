@@ -9,6 +9,7 @@ import app.state
 
 client: AsyncIOMotorClient = None
 database = None
+supports_transactions = False
 
 redis: aioredis.Redis = aioredis.from_url(str(app.config.REDIS_DSN))
 geoloc = geoloc_database.Reader("ext/geoloc.mmdb")
@@ -1,10 +1,16 @@
 from __future__ import annotations
 
 from . import beatmap
+from . import beatmap_file
+from . import beatmap_index
+from . import counters
+from . import duplicate
 from . import geolocation
 from . import leaderboard
+from . import missing_beatmap
 from . import password
 from . import performance
+from . import replay
 from . import score
 from . import stats
 from . import user
@@ -1,88 +1,302 @@
 from __future__ import annotations
 
+import asyncio
+import time
+from collections import OrderedDict
 from datetime import datetime
 from typing import Any
+from typing import Awaitable
+from typing import Callable
 from typing import Optional
+from typing import TypeVar
 
-from aiohttp import ClientSession
 from fastapi import status
+from pymongo import UpdateOne
 
 import app.config
 import app.state
+import app.usecases
+import log
 from app.constants.mode import Mode
 from app.objects.beatmap import Beatmap
 from app.objects.beatmap import RankedStatus
 
-md5_cache: dict[str, Beatmap] = {}  # {md5: Beatmap}
+# every beatmap in id_cache and set_cache is also in here.
+# evicting a beatmap drops its whole set from set_cache, so
+# a cached set always has all of its beatmaps.
+md5_cache: OrderedDict[str, Beatmap] = OrderedDict()  # {md5: Beatmap}, LRU first
 id_cache: dict[int, Beatmap] = {}  # {map_id: Beatmap}
 set_cache: dict[int, list[Beatmap]] = {}  # {set_id: list[Beatmap]}
 
+# when each unfrozen beatmap should next be checked with the osu! api,
+# frozen beatmaps never change so never go stale
+stale_at: dict[str, float] = {}  # {md5: time.monotonic()}
+refreshing: dict[str, asyncio.Task[None]] = {}  # {md5: Task}
 
-async def fetch_by_md5(md5: str) -> Optional[Beatmap]:
-    if beatmap := md5_from_cache(md5):
-        return beatmap
+hits = 0
+misses = 0
+evictions = 0
+refreshes = 0
 
-    if beatmap := await md5_from_database(md5):
-        md5_cache[md5] = beatmap
-        id_cache[beatmap.id] = beatmap
+T = TypeVar("T")
 
-        return beatmap
+# lookups currently going to the database or osu! api, {kind: {key: Task}}
+in_flight: dict[str, dict[Any, asyncio.Task[Any]]] = {
+    "md5": {},
+    "id": {},
+    "set": {},
+}
+loads = dict.fromkeys(in_flight, 0)  # lookups actually made
+coalesced = dict.fromkeys(in_flight, 0)  # callers that waited on someone else's
 
-    if beatmap := await md5_from_api(md5):
-        md5_cache[md5] = beatmap
-        id_cache[beatmap.id] = beatmap
 
+async def fetch_by_md5(md5: str) -> Optional[Beatmap]:
+    if beatmap := md5_from_cache(md5):
+        use(beatmap)
         return beatmap
 
+    return await single_flight("md5", md5, lambda: load_by_md5(md5))
+
 
 async def fetch_by_id(id: int) -> Optional[Beatmap]:
     if beatmap := id_from_cache(id):
+        use(beatmap)
         return beatmap
 
-    if beatmap := await id_from_database(id):
-        md5_cache[beatmap.md5] = beatmap
-        id_cache[beatmap.id] = beatmap
-
-        return beatmap
-
-    if beatmap := await id_from_api(id):
-        md5_cache[beatmap.md5] = beatmap
-        id_cache[beatmap.id] = beatmap
-
-        return beatmap
+    return await single_flight("id", id, lambda: load_by_id(id))
 
 
 async def fetch_by_set_id(set_id: int) -> Optional[list[Beatmap]]:
     if beatmaps := set_from_cache(set_id):
+        for beatmap in beatmaps:
+            use(beatmap)
+
         return beatmaps
 
+    return await single_flight("set", set_id, lambda: load_by_set_id(set_id))
+
+
+async def single_flight(
+    kind: str,
+    key: Any,
+    load: Callable[[], Awaitable[T]],
+) -> T:
+    """Has everyone missing the cache for the same beatmap(s) wait on one lookup."""
+
+    global misses
+
+    misses += 1
+    lookups = in_flight[kind]
+
+    if task := lookups.get(key):
+        coalesced[kind] += 1
+    else:
+        task = lookups[key] = asyncio.create_task(load())
+        task.add_done_callback(lambda _: lookups.pop(key, None))
+        loads[kind] += 1
+
+    # shielded so one cancelled request doesn't fail everyone else waiting
+    return await asyncio.shield(task)
+
+
+async def load_by_md5(md5: str) -> Optional[Beatmap]:
+    if beatmap := await md5_from_database(md5):
+        return add_to_cache(beatmap)
+
+    if beatmap := await md5_from_api(md5):
+        return add_to_cache(beatmap)
+
+
+async def load_by_id(id: int) -> Optional[Beatmap]:
+    if beatmap := await id_from_database(id):
+        return add_to_cache(beatmap)
+
+    if beatmap := await id_from_api(id):
+        return add_to_cache(beatmap)
+
+
+async def load_by_set_id(set_id: int) -> Optional[list[Beatmap]]:
     if beatmaps := await set_from_database(set_id):
+        beatmaps = [add_to_cache(beatmap) for beatmap in beatmaps]
         for beatmap in beatmaps:
-            md5_cache[beatmap.md5] = beatmap
-            id_cache[beatmap.id] = beatmap
-
             add_to_set_cache(beatmap)
 
         return beatmaps
 
     if beatmaps := await set_from_api(set_id):
+        beatmaps = [add_to_cache(beatmap) for beatmap in beatmaps]
         for beatmap in beatmaps:
-            md5_cache[beatmap.md5] = beatmap
-            id_cache[beatmap.id] = beatmap
-
             add_to_set_cache(beatmap)
 
         return beatmaps
 
 
+async def fetch_most_played(count: int) -> list[Beatmap]:
+    """Caches and returns the `count` most played beatmaps that have leaderboards."""
+
+    map_collection = app.state.services.database.maps
+    map_documents = (
+        map_collection.find({"status": {"$gte": RankedStatus.RANKED.value}})
+        .sort("plays", -1)
+        .limit(count)
+    )
+
+    beatmaps = []
+    async for map_document in map_documents:
+        beatmaps.append(add_to_cache(parse_from_database(map_document)))
+
+    return beatmaps
+
+
+def add_to_cache(beatmap: Beatmap) -> Beatmap:
+    """Caches a beatmap, returning the copy to use from now on.
+
+    An already cached copy (which might be holding leaderboards) is kept."""
+
+    if cached_beatmap := md5_cache.get(beatmap.md5):
+        md5_cache.move_to_end(beatmap.md5)
+        return cached_beatmap
+
+    md5_cache[beatmap.md5] = beatmap
+    id_cache[beatmap.id] = beatmap
+    mark_fresh(beatmap)
+
+    app.usecases.missing_beatmap.discard(beatmap.md5)
+
+    evict()
+    return beatmap
+
+
 def add_to_set_cache(beatmap: Beatmap) -> None:
     if set_list := set_cache.get(beatmap.set_id):
-        if beatmap not in set_list:
+        if all(other.md5 != beatmap.md5 for other in set_list):
             set_list.append(beatmap)
     else:
         set_cache[beatmap.set_id] = [beatmap]
 
 
+def evict() -> None:
+    global evictions
+
+    # always keep the most recently used one
+    while len(md5_cache) > app.config.BEATMAP_CACHE_SIZE and len(md5_cache) > 1:
+        md5, beatmap = md5_cache.popitem(last=False)
+
+        if id_cache.get(beatmap.id) is beatmap:
+            del id_cache[beatmap.id]
+
+        set_cache.pop(beatmap.set_id, None)
+        stale_at.pop(md5, None)
+
+        # nothing will find them anymore, so don't count them against the budget
+        for mode in list(beatmap.leaderboards):
+            app.usecases.leaderboard.drop(beatmap, mode)
+
+        evictions += 1
+
+
+def mark_fresh(beatmap: Beatmap) -> None:
+    if beatmap.frozen:
+        stale_at.pop(beatmap.md5, None)
+    else:
+        stale_at[beatmap.md5] = time.monotonic() + app.config.UNFROZEN_BEATMAP_TTL
+
+
+def use(beatmap: Beatmap) -> None:
+    """Counts a cache hit, refreshing the beatmap in the background if it's stale."""
+
+    global hits
+
+    hits += 1
+    md5_cache.move_to_end(beatmap.md5)
+
+    expiry = stale_at.get(beatmap.md5)
+    if expiry is None or expiry > time.monotonic() or beatmap.md5 in refreshing:
+        return
+
+    task = refreshing[beatmap.md5] = asyncio.create_task(refresh(beatmap))
+    task.add_done_callback(lambda _: refreshing.pop(beatmap.md5, None))
+
+    app.state.tasks.add(task)
+    task.add_done_callback(app.state.tasks.discard)
+
+
+# what the osu! api is the source of truth for
+UPSTREAM_FIELDS = (
+    "artist",
+    "title",
+    "version",
+    "creator",
+    "total_length",
+    "status",
+    "mode",
+    "cs",
+    "od",
+    "ar",
+    "hp",
+    "diff",
+    "last_update",
+    "max_combo",
+    "bpm",
+    "filename",
+    "frozen",
+)
+
+# what Beatmap.osu_string puts in the leaderboard header
+HEADER_FIELDS = ("id", "set_id", "status", "artist", "title", "version")
+
+
+def update_from(
+    beatmap: Beatmap,
+    fresh_beatmap: Beatmap,
+    field_names: tuple[str, ...],
+) -> None:
+    header_changed = any(
+        getattr(fresh_beatmap, field_name) != getattr(beatmap, field_name)
+        for field_name in field_names
+        if field_name in HEADER_FIELDS
+    )
+    for field_name in field_names:
+        setattr(beatmap, field_name, getattr(fresh_beatmap, field_name))
+
+    # the rendered headers are cached along with the scores
+    if header_changed:
+        for leaderboard in beatmap.leaderboards.values():
+            leaderboard.invalidate()
+
+
+def update_cached(fresh_beatmap: Beatmap) -> None:
+    """Brings a cached beatmap in line with its copy in the maps collection."""
+
+    if beatmap := md5_from_cache(fresh_beatmap.md5):
+        update_from(beatmap, fresh_beatmap, UPSTREAM_FIELDS + ("plays", "passes"))
+        mark_fresh(beatmap)
+
+
+async def refresh(beatmap: Beatmap) -> None:
+    """Updates a cached unfrozen beatmap from the osu! api, in place.
+
+    The stale copy keeps being served until this is done. If the api
+    doesn't have it anymore, it's kept as is and checked again later."""
+
+    global refreshes
+
+    try:
+        for fresh_beatmap in await request_from_api({"h": beatmap.md5}):
+            if fresh_beatmap.md5 != beatmap.md5:
+                continue
+
+            update_from(beatmap, fresh_beatmap, UPSTREAM_FIELDS)
+
+            await save_to_database(beatmap)
+            refreshes += 1
+    except Exception as exc:
+        log.warning(f"Failed to refresh {beatmap.full_name}: {exc!r}")
+    finally:
+        # now frozen, or not to be checked again for a while
+        mark_fresh(beatmap)
+
+
 def set_from_cache(set_id: int) -> Optional[list[Beatmap]]:
     return set_cache.get(set_id)
 
@@ -95,140 +309,148 @@ def id_from_cache(id: int) -> Optional[Beatmap]:
     return id_cache.get(id)
 
 
+def parse_from_database(map_document: dict[str, Any]) -> Beatmap:
+    map_document["status"] = RankedStatus(int(map_document["status"]))
+    map_document["mode"] = Mode(int(map_document["mode"]))
+    map_document["last_update"] = datetime.fromisoformat(map_document["last_update"])
+    map_document.pop("_id", None)
+
+    return Beatmap(**map_document)
+
+
 async def md5_from_database(md5: str) -> Optional[Beatmap]:
+    if beatmap := app.usecases.beatmap_index.by_md5(md5):
+        app.usecases.beatmap_index.revalidate([beatmap])
+        return beatmap
+
     map_collection = app.state.services.database.maps
     map_document = await map_collection.find_one({"md5": md5})
 
     if not map_document:
         return None
 
-    # move into parse function perhaps?
-    map_document["status"] = RankedStatus(int(map_document["status"]))
-    map_document["mode"] = Mode(int(map_document["mode"]))
-    map_document["last_update"] = datetime.fromisoformat(map_document["last_update"])
-    map_document.pop("_id")
-
-    return Beatmap(**map_document)
+    return parse_from_database(map_document)
 
 
 async def id_from_database(id: int) -> Optional[Beatmap]:
+    if beatmap := app.usecases.beatmap_index.by_id(id):
+        app.usecases.beatmap_index.revalidate([beatmap])
+        return beatmap
+
     map_collection = app.state.services.database.maps
     map_document = await map_collection.find_one({"id": id})
 
     if not map_document:
         return None
 
-    # move into parse function perhaps?
-    map_document["status"] = RankedStatus(int(map_document["status"]))
-    map_document["mode"] = Mode(int(map_document["mode"]))
-    map_document["last_update"] = datetime.fromisoformat(map_document["last_update"])
-    map_document.pop("_id")
-
-    return Beatmap(**map_document)
+    return parse_from_database(map_document)
 
 
 async def set_from_database(set_id: int) -> Optional[list[Beatmap]]:
+    if beatmaps := app.usecases.beatmap_index.by_set_id(set_id):
+        app.usecases.beatmap_index.revalidate(beatmaps)
+        return beatmaps
+
     map_collection = app.state.services.database.maps
     map_documents = map_collection.find({"set_id": set_id})
 
     if not map_documents:
         return None
 
-    maps = []
-    async for map_document in map_documents:
-        # move into parse function perhaps?
-        map_document["status"] = RankedStatus(int(map_document["status"]))
-        map_document["mode"] = Mode(int(map_document["mode"]))
-        map_document["last_update"] = datetime.fromisoformat(
-            map_document["last_update"],
-        )
-        map_document.pop("_id")
+    return [parse_from_database(map_document) async for map_document in map_documents]
 
-        maps.append(Beatmap(**map_document))
 
-    return maps
+GET_BEATMAP_URL = "https://old.ppy.sh/api/get_beatmaps"
 
 
-GET_BEATMAP_URL = "https://old.ppy.sh/api/get_beatmaps"
+def metadata(beatmap: Beatmap) -> dict[str, Any]:
+    """A beatmap's map document, without its play counts.
+
+    Plays and passes are only ever $inc'd by score submission, from 0
+    when the map is first saved, so out of date copies can't undo them."""
+
+    map_document = beatmap.dict()
+    del map_document["plays"], map_document["passes"]
+
+    return map_document
+
+
+def upsert(beatmap: Beatmap) -> dict[str, Any]:
+    return {"$set": metadata(beatmap), "$setOnInsert": {"plays": 0, "passes": 0}}
 
 
 async def save_to_database(beatmap: Beatmap) -> None:
     map_collection = app.state.services.database.maps
     await map_collection.update_one(
         {"md5": beatmap.md5},
-        {"$set": beatmap.dict()},
+        upsert(beatmap),
         upsert=True,
     )
 
+    await app.usecases.missing_beatmap.forget([beatmap.md5])
+    await app.usecases.beatmap_index.record([beatmap])
 
-async def md5_from_api(md5: str) -> Optional[Beatmap]:
-    async with ClientSession() as session:
-        async with session.get(
-            GET_BEATMAP_URL,
-            params={"k": str(app.config.OSU_API_KEY), "h": md5},
-        ) as response:
-            if not response or response.status != status.HTTP_200_OK:
-                return None
 
-            response_json = await response.json()
-            if not response_json:
-                return None
+async def save_many_to_database(beatmaps: list[Beatmap]) -> None:
+    map_collection = app.state.services.database.maps
+    await map_collection.bulk_write(
+        [
+            UpdateOne({"md5": beatmap.md5}, upsert(beatmap), upsert=True)
+            for beatmap in beatmaps
+        ],
+        ordered=False,
+    )
+
+    await app.usecases.missing_beatmap.forget([beatmap.md5 for beatmap in beatmaps])
+    await app.usecases.beatmap_index.record(beatmaps)
 
-    beatmaps = parse_from_osu_api(response_json)
 
-    for beatmap in beatmaps:
-        await save_to_database(beatmap)
-        add_to_set_cache(beatmap)
+async def request_from_api(params: dict[str, Any]) -> list[Beatmap]:
+    async with app.state.http.get(
+        "osu_api",
+        GET_BEATMAP_URL,
+        params={"k": str(app.config.OSU_API_KEY), **params},
+    ) as response:
+        if not response or response.status != status.HTTP_200_OK:
+            return []
 
-    for beatmap in beatmaps:
-        if beatmap.md5 == md5:
-            return beatmap
+        response_json = await response.json()
+        if not response_json:
+            return []
 
+    return parse_from_osu_api(response_json)
 
-async def id_from_api(id: int) -> Optional[Beatmap]:
-    async with ClientSession() as session:
-        async with session.get(
-            GET_BEATMAP_URL,
-            params={"k": str(app.config.OSU_API_KEY), "b": id},
-        ) as response:
-            if not response or response.status != status.HTTP_200_OK:
-                return None
 
-            response_json = await response.json()
-            if not response_json:
-                return None
+async def ingest_from_api(params: dict[str, Any]) -> list[Beatmap]:
+    """Caches every beatmap the osu! api returns, saving them all in one write.
 
-    beatmaps = parse_from_osu_api(response_json)
+    The write is deferred, callers get the cached copies."""
+
+    beatmaps = [add_to_cache(beatmap) for beatmap in await request_from_api(params)]
 
     for beatmap in beatmaps:
-        await save_to_database(beatmap)
         add_to_set_cache(beatmap)
 
-    for beatmap in beatmaps:
-        if beatmap.id == id:
-            return beatmap
+    if beatmaps:
+        await app.state.deferred.enqueue(save_many_to_database(beatmaps))
 
+    return beatmaps
 
-async def set_from_api(set_id: int) -> Optional[list[Beatmap]]:
-    async with ClientSession() as session:
-        async with session.get(
-            GET_BEATMAP_URL,
-            params={"k": str(app.config.OSU_API_KEY), "s": set_id},
-        ) as response:
-            if not response or response.status != status.HTTP_200_OK:
-                return None
 
-            response_json = await response.json()
-            if not response_json:
-                return None
+async def md5_from_api(md5: str) -> Optional[Beatmap]:
+    for beatmap in await ingest_from_api({"h": md5}):
+        if beatmap.md5 == md5:
+            return beatmap
 
-    beatmaps = parse_from_osu_api(response_json)
 
-    for beatmap in beatmaps:
-        await save_to_database(beatmap)
-        add_to_set_cache(beatmap)
+async def id_from_api(id: int) -> Optional[Beatmap]:
+    for beatmap in await ingest_from_api({"b": id}):
+        if beatmap.id == id:
+            return beatmap
 
-    return beatmaps
+
+async def set_from_api(set_id: int) -> Optional[list[Beatmap]]:
+    return await ingest_from_api({"s": set_id})
 
 
 IGNORED_BEATMAP_CHARS = dict.fromkeys(map(ord, r':\/*<>?"|'), None)
@@ -341,3 +563,22 @@ async def get_rating(beatmap: Beatmap) -> float:
 
     beatmap.rating = rating
     return rating
+
+
+def stats() -> dict[str, Any]:
+    now = time.monotonic()
+
+    return {
+        "cached": len(md5_cache),
+        "cached_sets": len(set_cache),
+        "max_cached": app.config.BEATMAP_CACHE_SIZE,
+        "stale": sum(1 for expiry in stale_at.values() if expiry <= now),
+        "hits": hits,
+        "misses": misses,
+        "evictions": evictions,
+        "refreshes": refreshes,
+        "refreshing": len(refreshing),
+        "in_flight": {kind: len(lookups) for kind, lookups in in_flight.items()},
+        "loads": loads,
+        "coalesced": coalesced,
+    }
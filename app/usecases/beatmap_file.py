@@ -0,0 +1,188 @@
+from __future__ import annotations
+
+import asyncio
+import hashlib
+import os
+from collections import OrderedDict
+from dataclasses import dataclass
+from pathlib import Path
+from typing import Optional
+
+from fastapi import status
+
+import app.config
+import app.state
+import log
+from app.objects.beatmap import Beatmap
+
+DATA_PATH = Path.cwd() / "data"
+BEATMAPS_PATH = DATA_PATH / "beatmaps"
+
+for path in (DATA_PATH, BEATMAPS_PATH):
+    if not path.exists():
+        path.mkdir(parents=True)
+
+
+OSU_FILE_URL = "https://old.ppy.sh/osu/{}"
+
+
+@dataclass
+class CachedFile:
+    size: int
+    evictable: bool
+
+
+# every file in here has been verified against its md5
+files: OrderedDict[str, CachedFile] = OrderedDict()  # {md5: CachedFile}, LRU first
+total_size = 0
+
+downloads: dict[str, asyncio.Task[bool]] = {}  # {md5: Task}
+
+
+def file_path(md5: str) -> Path:
+    return BEATMAPS_PATH / f"{md5}.osu"
+
+
+def legacy_file_path(map_id: int) -> Path:
+    return BEATMAPS_PATH / f"{map_id}.osu"
+
+
+def scan() -> None:
+    global total_size
+
+    scanned = []
+    for entry in os.scandir(BEATMAPS_PATH):
+        md5, _, extension = entry.name.partition(".")
+
+        # content addressed files are only ever written once verified
+        if extension == "osu" and len(md5) == 32 and md5 not in files:
+            scanned.append((entry.stat(), md5))
+
+    # least recently written first. we don't know their maps' statuses
+    # yet, so they can all go until they're used again
+    for stat, md5 in sorted(scanned, key=lambda scanned_file: scanned_file[0].st_mtime):
+        files[md5] = CachedFile(stat.st_size, evictable=True)
+        total_size += stat.st_size
+
+
+def write_atomic(osu_file_path: Path, data: bytes) -> None:
+    temp_path = osu_file_path.with_suffix(f".{os.getpid()}.tmp")
+    temp_path.write_bytes(data)
+    os.replace(temp_path, osu_file_path)
+
+
+def adopt_legacy_file(map_id: int, md5: str) -> Optional[int]:
+    """Moves a verified data/beatmaps/{id}.osu file to its content address."""
+
+    legacy_path = legacy_file_path(map_id)
+    if not legacy_path.exists():
+        return None
+
+    data = legacy_path.read_bytes()
+    if hashlib.md5(data).hexdigest() != md5:
+        return None
+
+    os.replace(legacy_path, file_path(md5))
+    return len(data)
+
+
+async def download(map_id: int) -> Optional[bytes]:
+    async with app.state.http.get("osu_files", OSU_FILE_URL.format(map_id)) as response:
+        if response.status != status.HTTP_200_OK:
+            return None
+
+        return await response.read()
+
+
+def add_to_index(md5: str, size: int, evictable: bool) -> None:
+    global total_size
+
+    files[md5] = CachedFile(size, evictable)
+    total_size += size
+
+
+async def evict() -> None:
+    global total_size
+
+    if total_size <= app.config.OSU_FILE_CACHE_SIZE:
+        return
+
+    evicted: list[str] = []
+    for md5, cached_file in files.items():
+        if total_size <= app.config.OSU_FILE_CACHE_SIZE:
+            break
+
+        if cached_file.evictable:
+            evicted.append(md5)
+            total_size -= cached_file.size
+
+    loop = asyncio.get_running_loop()
+    for md5 in evicted:
+        del files[md5]
+        await loop.run_in_executor(None, file_path(md5).unlink, True)
+
+
+async def load(beatmap: Beatmap) -> bool:
+    loop = asyncio.get_running_loop()
+    evictable = not beatmap.has_leaderboard
+
+    size = await loop.run_in_executor(
+        None,
+        adopt_legacy_file,
+        beatmap.id,
+        beatmap.md5,
+    )
+    if size is not None:
+        add_to_index(beatmap.md5, size, evictable)
+        return True
+
+    data = await download(beatmap.id)
+    if data is None:
+        return False
+
+    if hashlib.md5(data).hexdigest() != beatmap.md5:
+        log.warning(f"Downloaded .osu file for {beatmap.full_name} is outdated")
+        return False
+
+    await loop.run_in_executor(None, write_atomic, file_path(beatmap.md5), data)
+    add_to_index(beatmap.md5, len(data), evictable)
+
+    await evict()
+    return True
+
+
+async def initialise() -> None:
+    loop = asyncio.get_running_loop()
+    await loop.run_in_executor(None, scan)
+
+    await evict()
+
+
+def discard(md5: str) -> None:
+    global total_size
+
+    if cached_file := files.pop(md5, None):
+        total_size -= cached_file.size
+
+
+async def fetch(beatmap: Beatmap) -> Optional[Path]:
+    """The path of the beatmap's .osu file, downloading it if it isn't cached.
+
+    A hit doesn't touch the disk, so another worker may have evicted the
+    file since. Callers that find it missing `discard` it and fetch again."""
+
+    if cached_file := files.get(beatmap.md5):
+        files.move_to_end(beatmap.md5)
+        cached_file.evictable = not beatmap.has_leaderboard
+
+        return file_path(beatmap.md5)
+
+    if not (task := downloads.get(beatmap.md5)):
+        task = downloads[beatmap.md5] = asyncio.create_task(load(beatmap))
+        task.add_done_callback(lambda _: downloads.pop(beatmap.md5, None))
+
+    # shielded so one cancelled request doesn't fail everyone else waiting
+    if await asyncio.shield(task):
+        return file_path(beatmap.md5)
+
+    return None
@@ -0,0 +1,502 @@
+from __future__ import annotations
+
+import asyncio
+import fcntl
+import os
+import struct
+import time
+from collections import defaultdict
+from pathlib import Path
+from typing import Any
+from typing import BinaryIO
+from typing import Optional
+
+import orjson
+from bson import ObjectId
+
+import app.config
+import app.state
+import app.usecases
+import log
+from app.objects.beatmap import Beatmap
+from app.objects.beatmap_index import BeatmapIndex
+
+DATA_PATH = Path.cwd() / "data"
+INDEX_PATH = DATA_PATH / "beatmap_index"
+
+SNAPSHOT_FILE = INDEX_PATH / "snapshot.bin"
+JOURNAL_FILE = INDEX_PATH / "journal.bin"
+LOCK_FILE = INDEX_PATH / "journal.lock"
+BUILD_LOCK_FILE = INDEX_PATH / "build.lock"
+
+for path in (DATA_PATH, INDEX_PATH):
+    if not path.exists():
+        path.mkdir(parents=True)
+
+# the generation of the snapshot the journal follows
+JOURNAL_HEADER = struct.Struct("<Q")
+# each entry is a map document, prefixed with its length
+JOURNAL_ENTRY = struct.Struct("<I")
+
+# every beatmap in the maps collection as of the last build, shared by
+# every worker. beatmaps saved since then (by any worker) are appended
+# to the journal, which each worker keeps loaded in here.
+snapshot: Optional[BeatmapIndex] = None
+journal_position = 0  # how much of JOURNAL_FILE has been loaded
+
+journal: dict[str, dict[str, Any]] = {}  # {md5: map document}
+journal_ids: dict[int, str] = {}  # {map_id: md5}
+journal_sets: defaultdict[int, set[str]] = defaultdict(set)  # {set_id: {md5}}
+journal_filenames: dict[str, str] = {}  # {filename: md5}
+
+# newest maps collection _id looked at, to pick up maps saved without the journal
+caught_up_to: Optional[ObjectId] = None
+
+# how far JOURNAL_FILE is known to hold only complete entries, (inode, offset)
+verified: tuple[int, int] = (0, 0)
+
+hits = 0
+misses = 0
+builds = 0
+stale = 0  # served beatmaps the maps collection had since changed
+
+
+def remember(map_document: dict[str, Any]) -> None:
+    md5 = map_document["md5"]
+
+    if previous := journal.get(md5):
+        journal_sets[previous["set_id"]].discard(md5)
+
+    journal[md5] = map_document
+    journal_ids[map_document["id"]] = md5
+    journal_sets[map_document["set_id"]].add(md5)
+    journal_filenames[map_document["filename"]] = md5
+
+
+def from_journal(md5: str) -> Beatmap:
+    # parsing replaces fields in place
+    return app.usecases.beatmap.parse_from_database(dict(journal[md5]))
+
+
+def read_changes(
+    current: Optional[BeatmapIndex],
+    position: int,
+) -> tuple[Optional[BeatmapIndex], list[dict[str, Any]], int]:
+    """Reads anything written since `position`, by any worker.
+
+    Returns the snapshot if it has been rebuilt since `current` (the
+    journal is then read from its start), the new journal entries and
+    the position after them. Blocking."""
+
+    with LOCK_FILE.open("ab") as lock_file:
+        fcntl.flock(lock_file, fcntl.LOCK_SH)
+
+        try:
+            if not SNAPSHOT_FILE.exists():
+                return None, [], position
+
+            rebuilt = None
+            if current is None or current.inode != SNAPSHOT_FILE.stat().st_ino:
+                rebuilt = current = BeatmapIndex(SNAPSHOT_FILE)
+                position = 0
+
+            with JOURNAL_FILE.open("rb") as journal_file:
+                if position == 0:
+                    (generation,) = JOURNAL_HEADER.unpack(
+                        journal_file.read(JOURNAL_HEADER.size),
+                    )
+                    if generation != current.generation:
+                        raise ValueError("beatmap index journal doesn't match snapshot")
+
+                    position = JOURNAL_HEADER.size
+
+                journal_file.seek(position)
+                data = journal_file.read()
+        finally:
+            fcntl.flock(lock_file, fcntl.LOCK_UN)
+
+    map_documents = []
+    offset = 0
+
+    # an entry may have been left torn by a crash mid-write,
+    # the next append cuts it off
+    while offset + JOURNAL_ENTRY.size <= len(data):
+        (length,) = JOURNAL_ENTRY.unpack_from(data, offset)
+
+        end = offset + JOURNAL_ENTRY.size + length
+        if end > len(data):
+            break
+
+        map_documents.append(orjson.loads(data[offset + JOURNAL_ENTRY.size : end]))
+        offset = end
+
+    return rebuilt, map_documents, position + offset
+
+
+def complete_length(journal_file: BinaryIO, position: int) -> int:
+    """Where the last complete entry from `position` onwards ends."""
+
+    size = os.fstat(journal_file.fileno()).st_size
+
+    while position + JOURNAL_ENTRY.size <= size:
+        journal_file.seek(position)
+        (length,) = JOURNAL_ENTRY.unpack(journal_file.read(JOURNAL_ENTRY.size))
+
+        if position + JOURNAL_ENTRY.size + length > size:
+            break
+
+        position += JOURNAL_ENTRY.size + length
+
+    return position
+
+
+def append(map_documents: list[dict[str, Any]]) -> None:
+    """Appends map documents to the journal. Blocking."""
+
+    global verified
+
+    data = bytearray()
+    for map_document in map_documents:
+        encoded = orjson.dumps(map_document)
+        data += JOURNAL_ENTRY.pack(len(encoded)) + encoded
+
+    with LOCK_FILE.open("ab") as lock_file:
+        fcntl.flock(lock_file, fcntl.LOCK_EX)
+
+        try:
+            # before the first build, it'll all be in the snapshot anyway
+            if not JOURNAL_FILE.exists():
+                return
+
+            with JOURNAL_FILE.open("r+b") as journal_file:
+                inode = os.fstat(journal_file.fileno()).st_ino
+
+                # only what's been appended since we last looked needs checking
+                verified_inode, verified_end = verified
+                if verified_inode != inode:
+                    verified_end = JOURNAL_HEADER.size
+
+                # drop an entry left torn by a crash mid-write
+                end = complete_length(journal_file, verified_end)
+                journal_file.truncate(end)
+
+                journal_file.seek(end)
+                journal_file.write(data)
+
+            verified = (inode, end + len(data))
+        finally:
+            fcntl.flock(lock_file, fcntl.LOCK_UN)
+
+
+def journal_size() -> int:
+    try:
+        return JOURNAL_FILE.stat().st_size
+    except FileNotFoundError:
+        return 0
+
+
+def install(
+    beatmaps: list[Beatmap],
+    generation: int,
+    last_object_id: Optional[ObjectId],
+    journal_start: int,
+) -> None:
+    """Writes a new snapshot, carrying over journal entries written since
+    `journal_start`, and swaps both in for every worker. Blocking."""
+
+    BeatmapIndex.write(
+        SNAPSHOT_FILE.with_suffix(".new"),
+        beatmaps,
+        generation,
+        last_object_id.binary if last_object_id is not None else None,
+    )
+
+    with LOCK_FILE.open("ab") as lock_file:
+        fcntl.flock(lock_file, fcntl.LOCK_EX)
+
+        try:
+            carried_over = b""
+            if journal_start and JOURNAL_FILE.exists():
+                with JOURNAL_FILE.open("rb") as journal_file:
+                    journal_file.seek(journal_start)
+                    carried_over = journal_file.read()
+
+            new_journal_file = JOURNAL_FILE.with_suffix(".new")
+            new_journal_file.write_bytes(JOURNAL_HEADER.pack(generation) + carried_over)
+
+            os.replace(new_journal_file, JOURNAL_FILE)
+            os.replace(SNAPSHOT_FILE.with_suffix(".new"), SNAPSHOT_FILE)
+        finally:
+            fcntl.flock(lock_file, fcntl.LOCK_UN)
+
+
+async def build() -> None:
+    """Rebuilds the snapshot from the maps collection, unless another worker is."""
+
+    global builds
+
+    with BUILD_LOCK_FILE.open("ab") as build_lock_file:
+        try:
+            fcntl.flock(build_lock_file, fcntl.LOCK_EX | fcntl.LOCK_NB)
+        except BlockingIOError:
+            return
+
+        try:
+            start = time.perf_counter_ns()
+            loop = asyncio.get_running_loop()
+
+            # anything saved after this point may have been missed by the scan
+            journal_start = await loop.run_in_executor(None, journal_size)
+
+            beatmaps = []
+            last_object_id = None
+
+            map_collection = app.state.services.database.maps
+            async for map_document in map_collection.find({}):
+                if last_object_id is None or map_document["_id"] > last_object_id:
+                    last_object_id = map_document["_id"]
+
+                beatmaps.append(app.usecases.beatmap.parse_from_database(map_document))
+
+            await loop.run_in_executor(
+                None,
+                install,
+                beatmaps,
+                time.time_ns(),
+                last_object_id,
+                journal_start,
+            )
+            builds += 1
+
+            formatted_time = log.format_time(time.perf_counter_ns() - start)
+            log.info(
+                f"Built beatmap index of {len(beatmaps)} beatmaps in {formatted_time}",
+            )
+        finally:
+            fcntl.flock(build_lock_file, fcntl.LOCK_UN)
+
+
+async def refresh() -> None:
+    """Loads a rebuilt snapshot and anything new in the journal."""
+
+    global snapshot, journal_position
+
+    loop = asyncio.get_running_loop()
+    rebuilt, map_documents, position = await loop.run_in_executor(
+        None,
+        read_changes,
+        snapshot,
+        journal_position,
+    )
+
+    if rebuilt is not None:
+        # anything still reading the old one keeps it mapped until it's done
+        snapshot = rebuilt
+
+        journal.clear()
+        journal_ids.clear()
+        journal_sets.clear()
+        journal_filenames.clear()
+
+    for map_document in map_documents:
+        remember(map_document)
+
+    journal_position = position
+
+
+async def catch_up() -> None:
+    """Journals maps added to the collection by anything but us since the build."""
+
+    global caught_up_to
+
+    if snapshot is None:
+        return
+
+    if caught_up_to is None and snapshot.last_object_id is not None:
+        caught_up_to = ObjectId(snapshot.last_object_id)
+
+    query = {}
+    if caught_up_to is not None:
+        query["_id"] = {"$gt": caught_up_to}
+
+    map_documents = []
+
+    map_collection = app.state.services.database.maps
+    async for map_document in map_collection.find(query).sort("_id", 1):
+        caught_up_to = map_document.pop("_id")
+
+        md5 = map_document["md5"]
+        if md5 not in journal and md5 not in snapshot:
+            map_documents.append(map_document)
+
+    if map_documents:
+        loop = asyncio.get_running_loop()
+        await loop.run_in_executor(None, append, map_documents)
+
+
+def rebuild_due() -> bool:
+    if snapshot is None:
+        return True
+
+    age = time.time() - snapshot.generation / 1e9
+    return age > app.config.BEATMAP_INDEX_REBUILD_INTERVAL
+
+
+async def maintain() -> None:
+    while True:
+        try:
+            if rebuild_due():
+                await build()
+
+            await refresh()
+            await catch_up()
+        except Exception as exc:
+            log.error(f"Failed to update the beatmap index: {exc!r}")
+
+        await asyncio.sleep(app.config.BEATMAP_INDEX_REFRESH_INTERVAL)
+
+
+async def initialise() -> None:
+    # loading an existing snapshot is just mapping it, so
+    # beatmaps can be served from it from the first request
+    try:
+        await refresh()
+    except Exception as exc:
+        log.error(f"Failed to load the beatmap index: {exc!r}")
+
+    maintain_task = asyncio.create_task(maintain())
+    app.state.tasks.add(maintain_task)
+
+
+async def record(beatmaps: list[Beatmap]) -> None:
+    """Journals beatmaps just saved to the maps collection."""
+
+    if not app.config.BEATMAP_INDEX:
+        return
+
+    loop = asyncio.get_running_loop()
+    await loop.run_in_executor(
+        None,
+        append,
+        [beatmap.dict() for beatmap in beatmaps],
+    )
+
+
+async def revalidate_beatmaps(beatmaps: list[Beatmap]) -> None:
+    global stale
+
+    indexed = {beatmap.md5: beatmap for beatmap in beatmaps}
+    changed = []
+
+    try:
+        map_collection = app.state.services.database.maps
+        async for map_document in map_collection.find(
+            {"md5": {"$in": list(indexed)}},
+        ):
+            map_document.pop("_id")
+
+            fresh_beatmap = app.usecases.beatmap.parse_from_database(
+                dict(map_document),
+            )
+            if fresh_beatmap.dict() != indexed[fresh_beatmap.md5].dict():
+                app.usecases.beatmap.update_cached(fresh_beatmap)
+                changed.append(map_document)
+
+        if changed:
+            stale += len(changed)
+
+            loop = asyncio.get_running_loop()
+            await loop.run_in_executor(None, append, changed)
+    except Exception as exc:
+        log.warning(f"Failed to revalidate indexed beatmaps: {exc!r}")
+
+
+def revalidate(beatmaps: list[Beatmap]) -> None:
+    """Checks beatmaps just served from the index against the maps collection.
+
+    Anything else writing to the maps collection (status changes, plays)
+    doesn't go through the journal, so cached copies are corrected in
+    the background and the change is journaled for every worker."""
+
+    task = asyncio.create_task(revalidate_beatmaps(beatmaps))
+
+    app.state.tasks.add(task)
+    task.add_done_callback(app.state.tasks.discard)
+
+
+def counted(beatmap: Optional[Beatmap]) -> Optional[Beatmap]:
+    global hits, misses
+
+    if beatmap is not None:
+        hits += 1
+    else:
+        misses += 1
+
+    return beatmap
+
+
+def by_md5(md5: str) -> Optional[Beatmap]:
+    if md5 in journal:
+        return counted(from_journal(md5))
+
+    if snapshot is not None:
+        return counted(snapshot.find_md5(md5))
+
+    return counted(None)
+
+
+def by_id(id: int) -> Optional[Beatmap]:
+    if md5 := journal_ids.get(id):
+        return counted(from_journal(md5))
+
+    if snapshot is not None and (beatmap := snapshot.find_id(id)):
+        # updated since the build
+        if beatmap.md5 in journal:
+            return counted(from_journal(beatmap.md5))
+
+        return counted(beatmap)
+
+    return counted(None)
+
+
+def by_set_id(set_id: int) -> list[Beatmap]:
+    beatmaps: dict[int, Beatmap] = {}  # {map_id: Beatmap}
+
+    if snapshot is not None:
+        for beatmap in snapshot.find_set(set_id):
+            if beatmap.md5 not in journal:
+                beatmaps[beatmap.id] = beatmap
+
+    # journaled copies win, including over an older version of the same map
+    for md5 in journal_sets.get(set_id, ()):
+        beatmap = from_journal(md5)
+        beatmaps[beatmap.id] = beatmap
+
+    counted(next(iter(beatmaps.values()), None))
+    return list(beatmaps.values())
+
+
+def by_filename(filename: str) -> Optional[Beatmap]:
+    if md5 := journal_filenames.get(filename):
+        return counted(from_journal(md5))
+
+    if snapshot is not None and (beatmap := snapshot.find_filename(filename)):
+        if beatmap.md5 in journal:
+            return counted(from_journal(beatmap.md5))
+
+        return counted(beatmap)
+
+    return counted(None)
+
+
+def stats() -> dict[str, Any]:
+    return {
+        "enabled": app.config.BEATMAP_INDEX,
+        "beatmaps": len(snapshot) if snapshot is not None else 0,
+        "journaled": len(journal),
+        "built_at": snapshot.generation // 1_000_000_000 if snapshot else None,
+        "builds": builds,
+        "hits": hits,
+        "misses": misses,
+        "stale": stale,
+    }
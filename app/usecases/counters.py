@@ -0,0 +1,70 @@
+from __future__ import annotations
+
+import asyncio
+
+import pymongo
+from pymongo import ReturnDocument
+
+import app.config
+import app.state
+
+blocks: dict[str, tuple[int, int]] = {}  # {counter: (next_id, last_id)}
+locks: dict[str, asyncio.Lock] = {}  # {counter: Lock}
+
+
+async def seed(counter: str, minimum: int = 0) -> None:
+    """Makes sure `counter` starts above every id already in its collection.
+
+    `$max` keeps this safe to run from every worker on startup."""
+
+    collection = app.state.services.database[counter]
+    await collection.create_index("id")
+
+    document = await collection.find_one(
+        {},
+        {"id": 1},
+        sort=[("id", pymongo.DESCENDING)],
+    )
+    highest_id = max(document["id"] if document else 0, minimum)
+
+    counters_collection = app.state.services.database.counters
+    await counters_collection.update_one(
+        {"_id": counter},
+        {"$max": {"seq": highest_id}},
+        upsert=True,
+    )
+
+
+async def allocate_block(counter: str, block_size: int) -> tuple[int, int]:
+    counters_collection = app.state.services.database.counters
+    document = await counters_collection.find_one_and_update(
+        {"_id": counter},
+        {"$inc": {"seq": block_size}},
+        upsert=True,
+        return_document=ReturnDocument.AFTER,
+    )
+
+    last_id = document["seq"]
+    return last_id - block_size + 1, last_id
+
+
+async def next_id(counter: str, block_size: int = 1) -> int:
+    if not (lock := locks.get(counter)):
+        lock = locks[counter] = asyncio.Lock()
+
+    async with lock:
+        next_id, last_id = blocks.get(counter, (1, 0))
+        if next_id > last_id:
+            next_id, last_id = await allocate_block(counter, block_size)
+
+        blocks[counter] = (next_id + 1, last_id)
+        return next_id
+
+
+async def next_score_id() -> int:
+    return await next_id("scores", app.config.SCORE_ID_BLOCK_SIZE)
+
+
+async def next_user_id() -> int:
+    # user ids are handed out one at a time so they stay contiguous
+    return await next_id("users")
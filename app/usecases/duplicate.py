@@ -0,0 +1,148 @@
+from __future__ import annotations
+
+import asyncio
+from datetime import datetime
+from datetime import timedelta
+from typing import Any
+from typing import Optional
+
+from bson import ObjectId
+
+import app.config
+import app.state
+import log
+from app.objects.bloom import BloomFilter
+
+# every checksum in the scores collection as of the last refresh.
+# checksums inserted since then (by any worker) are kept in redis.
+bloom: Optional[BloomFilter] = None
+refreshed_at: Optional[datetime] = None
+
+# inserts can land slightly out of order, so refreshes overlap a little
+REFRESH_OVERLAP = timedelta(minutes=5)
+
+filtered = 0  # lookups the bloom filter answered on its own
+false_positives = 0  # "maybe" answers that mongo said weren't duplicates
+
+
+def recent_key(checksum: str) -> str:
+    return f"aisuru:checksums:{checksum}"
+
+
+async def load_checksums(new_bloom: BloomFilter, since: Optional[datetime]) -> None:
+    query = {}
+    if since is not None:
+        query["_id"] = {"$gte": ObjectId.from_datetime(since - REFRESH_OVERLAP)}
+
+    scores_collection = app.state.services.database.scores
+    async for document in scores_collection.find(
+        query,
+        {"_id": 0, "client_checksum": 1},
+    ):
+        new_bloom.add(document["client_checksum"])
+
+
+async def build() -> None:
+    global bloom, refreshed_at
+
+    started_at = datetime.utcnow()
+
+    new_bloom = BloomFilter(
+        app.config.DUPLICATE_FILTER_CAPACITY,
+        app.config.DUPLICATE_FILTER_ERROR_RATE,
+    )
+    await load_checksums(new_bloom, since=None)
+
+    bloom = new_bloom
+    refreshed_at = started_at
+
+    log.info(
+        f"Built duplicate score filter from {len(bloom)} checksums "
+        f"(expected false positive rate: {bloom.false_positive_rate:.4%})",
+    )
+
+
+async def refresh() -> None:
+    global refreshed_at
+
+    started_at = datetime.utcnow()
+    await load_checksums(bloom, since=refreshed_at)
+    refreshed_at = started_at
+
+    if len(bloom) > bloom.capacity:
+        log.warning(
+            f"Duplicate score filter is over capacity ({len(bloom)} checksums), "
+            "consider raising DUPLICATE_FILTER_CAPACITY",
+        )
+
+
+async def maintain() -> None:
+    while True:
+        try:
+            if bloom is None:
+                await build()
+            else:
+                await refresh()
+        except Exception as exc:
+            log.error(f"Failed to update the duplicate score filter: {exc!r}")
+
+        await asyncio.sleep(app.config.DUPLICATE_FILTER_REFRESH_INTERVAL)
+
+
+def initialise() -> None:
+    # building reads every checksum, so don't hold up startup for it
+    maintain_task = asyncio.create_task(maintain())
+    app.state.tasks.add(maintain_task)
+
+
+async def exists(checksum: str) -> bool:
+    global filtered, false_positives
+
+    if await app.state.services.redis.exists(recent_key(checksum)):
+        return True
+
+    if bloom is not None and checksum not in bloom:
+        filtered += 1
+        return False
+
+    scores_collection = app.state.services.database.scores
+    found = (
+        await scores_collection.find_one(
+            {"client_checksum": checksum},
+            {"_id": 1},
+        )
+        is not None
+    )
+
+    if bloom is not None and not found:
+        false_positives += 1
+
+    return found
+
+
+async def add(checksum: str) -> None:
+    if bloom is not None:
+        bloom.add(checksum)
+
+    await app.state.services.redis.set(
+        recent_key(checksum),
+        1,
+        ex=app.config.RECENT_CHECKSUM_TTL,
+    )
+
+
+def stats() -> dict[str, Any]:
+    negatives = filtered + false_positives
+
+    return {
+        "ready": bloom is not None,
+        "checksums": len(bloom) if bloom is not None else 0,
+        "filtered": filtered,
+        "false_positives": false_positives,
+        "expected_false_positive_rate": (
+            bloom.false_positive_rate if bloom is not None else 0.0
+        ),
+        "observed_false_positive_rate": (
+            false_positives / negatives if negatives else 0.0
+        ),
+    }
@@ -1,54 +1,310 @@
 from __future__ import annotations
 
+import asyncio
+import time
+from collections import OrderedDict
+from typing import Any
+from typing import Optional
+
+import orjson
+
+import app.config
 import app.state
+import app.usecases
+import log
 from app.constants.mode import Mode
 from app.objects.beatmap import Beatmap
 from app.objects.leaderboard import Leaderboard
-from app.objects.score import Score
+from app.objects.leaderboard import LEADERBOARD_PROJECTION
+from app.objects.leaderboard import LeaderboardScore
 
+# every leaderboard held by a cached beatmap, least recently used first
+resident: OrderedDict[tuple[str, Mode], Beatmap] = OrderedDict()
+total_scores = 0  # on every resident leaderboard
+evictions = 0
 
-async def create(beatmap: Beatmap, mode: Mode) -> Leaderboard:
-    leaderboard = Leaderboard(mode)
+# after this many, a leaderboard that keeps changing while loading is loaded
+# anyway and the next update it gets will notice the gap and drop it
+LOAD_ATTEMPTS = 3
+
+reloads = 0  # leaderboards dropped after missing an update
+
+# how long replicated updates wait on an earlier one before the
+# leaderboard is given up on and reloaded
+REORDER_WINDOW = 5.0
 
+# takes the next sequence number and publishes the update with it in one
+# step, so updates are published in sequence order. the sequence is
+# spliced into the start of the (json object) update.
+PUBLISH_SCORE_SCRIPT = """
+local sequence = redis.call("INCR", KEYS[1])
+redis.call(
+    "PUBLISH",
+    ARGV[1],
+    '{"sequence":' .. sequence .. ',' .. string.sub(ARGV[2], 2)
+)
+return sequence
+"""
+
+
+async def load_rows(beatmap: Beatmap, mode: Mode) -> list[dict[str, Any]]:
     scores_collection = app.state.services.database.scores
-    scores = [
-        score
-        async for score in scores_collection.find(
+    return await scores_collection.aggregate(
+        [
             {
-                "map_md5": beatmap.md5,
-                "status": 2,
-                "mode": mode.value,
+                "$match": {
+                    "map_md5": beatmap.md5,
+                    "status": 2,
+                    "mode": mode.value,
+                },
             },
-        )
-    ]
-
-    users_collection = app.state.services.database.users
-    users = {
-        user["id"]: user
-        async for user in users_collection.find(
-            {"id": {"$in": [score["user_id"] for score in scores]}},
-        )
-    }
+            {"$project": LEADERBOARD_PROJECTION},
+            {
+                "$lookup": {
+                    "from": "users",
+                    "localField": "user_id",
+                    "foreignField": "id",
+                    "as": "user",
+                },
+            },
+            {"$unwind": "$user"},
+            {
+                "$project": LEADERBOARD_PROJECTION
+                | {
+                    "username": "$user.name",
+                    "user_priv": "$user.privileges",
+                    "user_country": "$user.country",
+                },
+            },
+        ],
+    ).to_list(length=None)
+
+
+def sequence_key(beatmap: Beatmap, mode: Mode) -> str:
+    return f"aisuru:leaderboards:{beatmap.md5}:{mode.value}:sequence"
 
-    for score in scores:
-        user = users[score["user_id"]]
 
-        score["user_priv"] = user["privileges"]
-        score["user_country"] = user["country"]
-        score["username"] = user["name"]
+async def current_sequence(beatmap: Beatmap, mode: Mode) -> int:
+    return int(await app.state.services.redis.get(sequence_key(beatmap, mode)) or 0)
 
-        score_obj = await Score.from_row(score)
-        leaderboard.scores.append(score_obj)
 
-    leaderboard.sort()
+async def create(beatmap: Beatmap, mode: Mode) -> Leaderboard:
+    # updates are only published once their score is in the database,
+    # so the rows have every update up to the sequence read beforehand.
+    # if more came in while loading, we can't tell if they made it.
+    for _ in range(LOAD_ATTEMPTS):
+        sequence = await current_sequence(beatmap, mode)
+        rows = await load_rows(beatmap, mode)
+
+        if await current_sequence(beatmap, mode) == sequence:
+            break
+
+    leaderboard = Leaderboard(mode, sequence=sequence)
+    leaderboard.load(
+        [LeaderboardScore.from_row(row) for row in rows],
+    )
+
     return leaderboard
 
 
+def release(beatmap: Beatmap, mode: Mode) -> None:
+    global total_scores
+
+    # anything still holding it can keep using it, it just won't be found again
+    leaderboard = beatmap.leaderboards.pop(mode, None)
+
+    if leaderboard is not None and leaderboard.resident:
+        leaderboard.resident = False
+        total_scores -= len(leaderboard)
+
+
+def evict() -> None:
+    global evictions
+
+    # always keep the most recently used one, however big it is
+    while total_scores > app.config.LEADERBOARD_CACHE_SCORES and len(resident) > 1:
+        (_, mode), beatmap = resident.popitem(last=False)
+        release(beatmap, mode)
+
+        evictions += 1
+
+
+def drop(beatmap: Beatmap, mode: Mode) -> None:
+    release(beatmap, mode)
+
+    key = (beatmap.md5, mode)
+    if resident.get(key) is beatmap:
+        del resident[key]
+
+
+def add_score(leaderboard: Leaderboard, score: LeaderboardScore) -> None:
+    """Adds a score to a leaderboard, keeping count of the resident scores."""
+
+    global total_scores
+
+    count = len(leaderboard)
+    leaderboard.add_score(score)
+
+    if leaderboard.resident:
+        total_scores += len(leaderboard) - count
+        evict()
+
+
 async def fetch(beatmap: Beatmap, mode: Mode) -> Leaderboard:
-    if leaderboard := beatmap.leaderboards.get(mode):
-        return leaderboard
+    global reloads, total_scores
+
+    key = (beatmap.md5, mode)
+
+    # empty leaderboards are falsy, but still worth keeping
+    if (leaderboard := beatmap.leaderboards.get(mode)) is not None:
+        if not expired(leaderboard):
+            if key in resident:
+                resident.move_to_end(key)
+
+            return leaderboard
+
+        # an update it was waiting on never turned up
+        drop(beatmap, mode)
+        reloads += 1
 
     leaderboard = await create(beatmap, mode)
+
+    # another copy of the beatmap (or another load of this one) may hold it
+    if (previous := resident.pop(key, None)) is not None:
+        release(previous, mode)
+
     beatmap.leaderboards[mode] = leaderboard
+    leaderboard.resident = True
+    total_scores += len(leaderboard)
+
+    resident[key] = beatmap
+    evict()
 
     return leaderboard
+
+
+def expired(leaderboard: Leaderboard) -> bool:
+    return (
+        bool(leaderboard.pending)
+        and time.monotonic() - leaderboard.pending_since > REORDER_WINDOW
+    )
+
+
+def apply(leaderboard: Leaderboard, score: LeaderboardScore) -> None:
+    # a later best from the same user may have been published from here first
+    existing = leaderboard.user_scores.get(score.user_id)
+    if existing is None or existing.timestamp <= score.timestamp:
+        add_score(leaderboard, score)
+
+
+def receive(
+    beatmap: Beatmap,
+    mode: Mode,
+    sequence: int,
+    score: Optional[LeaderboardScore],
+) -> None:
+    """Applies replicated updates to a cached leaderboard in sequence order.
+
+    `score` is None for an update published from here, which is already
+    applied. Updates that arrive before an earlier one wait for it; if
+    it hasn't turned up within REORDER_WINDOW, the leaderboard is
+    dropped to be reloaded on its next fetch."""
+
+    global reloads
+
+    if (leaderboard := beatmap.leaderboards.get(mode)) is None:
+        return
+
+    if sequence <= leaderboard.sequence:
+        return  # already in there
+
+    if not leaderboard.pending:
+        leaderboard.pending_since = time.monotonic()
+
+    leaderboard.pending.setdefault(sequence, score)
+
+    applied = False
+    while leaderboard.sequence + 1 in leaderboard.pending:
+        leaderboard.sequence += 1
+        applied = True
+
+        if (update := leaderboard.pending.pop(leaderboard.sequence)) is not None:
+            apply(leaderboard, update)
+
+    if applied:
+        # anything left is now waiting on a newer gap
+        leaderboard.pending_since = time.monotonic()
+    elif expired(leaderboard):
+        drop(beatmap, mode)
+        reloads += 1
+
+
+async def publish_score(
+    beatmap: Beatmap,
+    mode: Mode,
+    score: LeaderboardScore,
+) -> None:
+    """Sends a new personal best, already added locally, to every other worker.
+
+    Must only be called once the score is in the database."""
+
+    sequence = await app.state.services.redis.eval(
+        PUBLISH_SCORE_SCRIPT,
+        1,
+        sequence_key(beatmap, mode),
+        "leaderboard-score",
+        orjson.dumps(
+            {
+                "md5": beatmap.md5,
+                "mode": mode.value,
+                "score": score.row(),
+            },
+        ),
+    )
+
+    # it's already applied here, this just keeps the sequence in step
+    receive(beatmap, mode, sequence, None)
+
+
+async def warm_up(count: int, concurrency: int) -> None:
+    """Loads the leaderboards of the `count` most played beatmaps."""
+
+    start = time.perf_counter_ns()
+
+    beatmaps = await app.usecases.beatmap.fetch_most_played(count)
+    semaphore = asyncio.Semaphore(concurrency)
+
+    loaded = 0
+    report_every = max(len(beatmaps) // 10, 1)
+
+    async def warm_up_beatmap(beatmap: Beatmap) -> None:
+        nonlocal loaded
+
+        async with semaphore:
+            try:
+                await app.usecases.beatmap.get_rating(beatmap)
+                await fetch(beatmap, beatmap.mode)
+            except Exception as exc:
+                log.error(f"Failed to warm up {beatmap.full_name}: {exc!r}")
+
+        loaded += 1
+        if loaded % report_every == 0:
+            log.info(f"Warmed up {loaded}/{len(beatmaps)} leaderboards")
+
+    await asyncio.gather(*(warm_up_beatmap(beatmap) for beatmap in beatmaps))
+
+    formatted_time = log.format_time(time.perf_counter_ns() - start)
+    log.info(
+        f"Warmed up {len(beatmaps)} leaderboards ({total_scores} scores) "
+        f"in {formatted_time}",
+    )
+
+
+def stats() -> dict[str, Any]:
+    return {
+        "leaderboards": len(resident),
+        "scores": total_scores,
+        "max_scores": app.config.LEADERBOARD_CACHE_SCORES,
+        "evictions": evictions,
+        "reloads": reloads,
+    }
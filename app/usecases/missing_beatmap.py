@@ -0,0 +1,110 @@
+from __future__ import annotations
+
+import time
+from collections import OrderedDict
+from typing import Any
+from typing import Optional
+
+import orjson
+
+import app.config
+import app.state
+from app.objects.beatmap import RankedStatus
+
+# beatmaps clients asked for that we couldn't find (or only found an older
+# version of), so browsing song select doesn't look them up again every time.
+# {md5: (status, expires at)}, least recently used first
+entries: OrderedDict[str, tuple[RankedStatus, float]] = OrderedDict()
+
+hits = 0
+misses = 0
+evictions = 0
+
+
+def missing_key(md5: str) -> str:
+    return f"aisuru:missing_beatmaps:{md5}"
+
+
+def ttl(status: RankedStatus) -> int:
+    if status == RankedStatus.UPDATE_AVAILABLE:
+        return app.config.OUTDATED_BEATMAP_TTL
+
+    # unsubmitted maps can be submitted at any time, so recheck them sooner
+    return app.config.UNSUBMITTED_BEATMAP_TTL
+
+
+def remember(md5: str, status: RankedStatus) -> None:
+    global evictions
+
+    entries[md5] = (status, time.monotonic() + ttl(status))
+    entries.move_to_end(md5)
+
+    while len(entries) > app.config.MISSING_BEATMAP_CACHE_SIZE:
+        entries.popitem(last=False)
+        evictions += 1
+
+
+async def fetch(md5: str) -> Optional[RankedStatus]:
+    """The status to report for a beatmap we know we don't have, if any."""
+
+    global hits, misses
+
+    if entry := entries.get(md5):
+        status, expires_at = entry
+
+        if expires_at > time.monotonic():
+            entries.move_to_end(md5)
+            hits += 1
+
+            return status
+
+        del entries[md5]
+
+    if app.config.MISSING_BEATMAP_SHARED:
+        if value := await app.state.services.redis.get(missing_key(md5)):
+            status = RankedStatus(int(value))
+            remember(md5, status)
+            hits += 1
+
+            return status
+
+    misses += 1
+    return None
+
+
+async def add(md5: str, status: RankedStatus) -> None:
+    remember(md5, status)
+
+    if app.config.MISSING_BEATMAP_SHARED:
+        await app.state.services.redis.set(
+            missing_key(md5),
+            status.value,
+            ex=ttl(status),
+        )
+
+
+def discard(md5: str) -> None:
+    entries.pop(md5, None)
+
+
+async def forget(md5s: list[str]) -> None:
+    """Stops every worker from reporting beatmaps that have turned up as missing."""
+
+    for md5 in md5s:
+        discard(md5)
+
+    if app.config.MISSING_BEATMAP_SHARED:
+        await app.state.services.redis.delete(*map(missing_key, md5s))
+
+    await app.state.services.redis.publish("beatmap-found", orjson.dumps(md5s))
+
+
+def stats() -> dict[str, Any]:
+    return {
+        "entries": len(entries),
+        "max_entries": app.config.MISSING_BEATMAP_CACHE_SIZE,
+        "shared": app.config.MISSING_BEATMAP_SHARED,
+        "hits": hits,
+        "misses": misses,
+        "evictions": evictions,
+    }
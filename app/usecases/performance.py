@@ -1,24 +1,72 @@
 from __future__ import annotations
 
+from collections import OrderedDict
 from pathlib import Path
 
 from aisuru_pp_py import Calculator
 from aisuru_pp_py import ScoreParams
 
+import app.config
+import app.state
 from app.objects.score import Score
 
+# parsed beatmaps, per process (the pp pool's workers each have their own)
+calculators: OrderedDict[str, Calculator] = OrderedDict()  # {md5: Calculator}
 
-def calculate_score(score: Score, osu_file_path: Path) -> None:
-    calculator = Calculator(str(osu_file_path))
+# counted in the web worker, from what the pool reports back
+calculator_hits = 0
+calculator_misses = 0
+
+
+def get_calculator(osu_file_path: str, md5: str) -> tuple[Calculator, bool]:
+    if calculator := calculators.get(md5):
+        calculators.move_to_end(md5)
+        return calculator, True
+
+    calculator = calculators[md5] = Calculator(osu_file_path)
+    if len(calculators) > app.config.PP_CALCULATOR_CACHE_SIZE:
+        calculators.popitem(last=False)
+
+    return calculator, False
+
+
+def calculate_pp(
+    osu_file_path: str,
+    md5: str,
+    mods: int,
+    acc: float,
+    nmiss: int,
+    combo: int,
+) -> tuple[float, float, bool]:
+    calculator, cached = get_calculator(osu_file_path, md5)
 
     score_params = ScoreParams(
-        mods=score.mods.value,
-        acc=score.acc,
-        nMisses=score.nmiss,
-        combo=score.max_combo,
+        mods=mods,
+        acc=acc,
+        nMisses=nmiss,
+        combo=combo,
     )
 
     (result,) = calculator.calculate(score_params)
 
-    score.pp = result.pp
-    score.sr = result.stars
+    return result.pp, result.stars, cached
+
+
+async def calculate_score(score: Score, osu_file_path: Path) -> None:
+    global calculator_hits, calculator_misses
+
+    score.pp, score.sr, cached = await app.state.executor.run(
+        "pp",
+        calculate_pp,
+        str(osu_file_path),
+        score.map_md5,
+        score.mods.value,
+        score.acc,
+        score.nmiss,
+        score.max_combo,
+    )
+
+    if cached:
+        calculator_hits += 1
+    else:
+        calculator_misses += 1
@@ -0,0 +1,110 @@
+from __future__ import annotations
+
+import asyncio
+import fcntl
+import os
+import threading
+from pathlib import Path
+from typing import Optional
+
+import app.config
+from app.objects.replay_index import RECORD
+from app.objects.replay_index import ReplayIndex
+from app.objects.replay_index import ReplayLocation
+
+DATA_PATH = Path.cwd() / "data"
+REPLAYS_PATH = DATA_PATH / "replays"
+SEGMENTS_PATH = REPLAYS_PATH / "segments"
+
+INDEX_FILE = REPLAYS_PATH / "index.bin"
+LOCK_FILE = REPLAYS_PATH / "segments.lock"
+
+for path in (DATA_PATH, REPLAYS_PATH, SEGMENTS_PATH):
+    if not path.exists():
+        path.mkdir(parents=True)
+
+index = ReplayIndex()
+index_lock = threading.Lock()
+
+active_segment = 0
+
+
+def segment_path(segment: int) -> Path:
+    return SEGMENTS_PATH / f"{segment:08d}.seg"
+
+
+def load_index() -> None:
+    """Maps any index records appended since the last load (by any worker)."""
+
+    global index
+
+    with index_lock:
+        # swapped whole, so readers on the event loop never see it half-updated
+        index = index.extended(INDEX_FILE)
+
+
+def append(score_id: int, replay_data: bytes) -> ReplayLocation:
+    """Appends a replay to the active segment and records it in the index.
+
+    Blocking; segment and index writes are serialised across
+    workers with an exclusive flock on LOCK_FILE."""
+
+    global active_segment
+
+    with LOCK_FILE.open("ab") as lock_file:
+        fcntl.flock(lock_file, fcntl.LOCK_EX)
+
+        try:
+            # another worker may have rolled over to a new segment
+            while segment_path(active_segment + 1).exists():
+                active_segment += 1
+
+            segment_file = segment_path(active_segment)
+            if segment_file.exists():
+                segment_size = segment_file.stat().st_size
+
+                if (
+                    segment_size
+                    and segment_size + len(replay_data) > app.config.REPLAY_SEGMENT_SIZE
+                ):
+                    active_segment += 1
+                    segment_file = segment_path(active_segment)
+
+            with segment_file.open("ab") as segment:
+                offset = segment.tell()
+                segment.write(replay_data)
+
+            location = ReplayLocation(active_segment, offset, len(replay_data))
+
+            with INDEX_FILE.open("ab") as index_file:
+                # drop a record left torn by a crash mid-write
+                if torn := index_file.tell() % RECORD.size:
+                    index_file.truncate(index_file.tell() - torn)
+                    index_file.seek(0, os.SEEK_END)
+
+                index_file.write(RECORD.pack(score_id, *location))
+        finally:
+            fcntl.flock(lock_file, fcntl.LOCK_UN)
+
+    return location
+
+
+async def initialise() -> None:
+    loop = asyncio.get_running_loop()
+    await loop.run_in_executor(None, load_index)
+
+
+async def save(score_id: int, replay_data: bytes) -> None:
+    loop = asyncio.get_running_loop()
+    await loop.run_in_executor(None, append, score_id, replay_data)
+
+
+async def locate(score_id: int) -> Optional[ReplayLocation]:
+    if location := index.find(score_id):
+        return location
+
+    # the replay may have been written since, by any worker
+    loop = asyncio.get_running_loop()
+    await loop.run_in_executor(None, load_index)
+
+    return index.find(score_id)
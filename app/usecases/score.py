@@ -93,9 +93,9 @@ def calculate_accuracy(score: Score) -> float:
 
 def calculate_status(score: Score) -> None:
     if score.old_best:
+        # the old best is demoted in the database when this one is saved
         if score.pp > score.old_best.pp:
             score.status = ScoreStatus.BEST
-            score.old_best.status = ScoreStatus.SUBMITTED
         else:
             score.status = ScoreStatus.SUBMITTED
     else:
@@ -1,7 +1,10 @@
 from __future__ import annotations
 
+from typing import Optional
+
 import orjson
 import pymongo
+from motor.motor_asyncio import AsyncIOMotorClientSession
 
 import app.state
 from app.constants.mode import Mode
@@ -41,11 +44,17 @@ async def fetch(user_id: int, country: str, mode: Mode) -> Stats:
     )
 
 
-async def save(stats: Stats, mode: Mode, user_id: int) -> None:
+async def save(
+    stats: Stats,
+    mode: Mode,
+    user_id: int,
+    session: Optional[AsyncIOMotorClientSession] = None,
+) -> None:
     stats_collection = app.state.services.database.ustats
     await stats_collection.update_one(
         {"user_id": user_id, "mode": mode.value},
         {"$set": stats.dict()},
+        session=session,
     )
 
 
@@ -88,7 +97,12 @@ async def update_rank(stats: Stats, mode: Mode, user_id: int, country: str) -> N
 BONUS_PP_LIMIT = 25397
 
 
-async def recalc(stats: Stats, mode: Mode, user_id: int) -> None:
+async def recalc(
+    stats: Stats,
+    mode: Mode,
+    user_id: int,
+    session: Optional[AsyncIOMotorClientSession] = None,
+) -> None:
     scores_collection = app.state.services.database.scores
     scores = [
         score
@@ -100,6 +114,7 @@ async def recalc(stats: Stats, mode: Mode, user_id: int) -> None:
                     "status": 2,
                     "pp": {"$gt": 0},
                 },
+                session=session,
             )
             .sort("pp", pymongo.DESCENDING)
             .limit(BONUS_PP_LIMIT)
@@ -111,6 +126,7 @@ async def recalc(stats: Stats, mode: Mode, user_id: int) -> None:
         beatmap["md5"]
         async for beatmap in maps_collection.find(
             {"md5": {"$in": [score["map_md5"] for score in scores]}},
+            session=session,
         )
         if RankedStatus(beatmap["status"])
         in (RankedStatus.RANKED, RankedStatus.APPROVED)
@@ -5,12 +5,11 @@ from typing import Awaitable
 from typing import Callable
 from typing import Optional
 
-from aiohttp import ClientSession
-from aiohttp import TCPConnector
 from fastapi import HTTPException
 from fastapi import status
 
 import app.config
+import app.state
 from app.constants.privileges import Privileges
 from app.constants.status import Status
 from app.objects.geolocation import Geolocation
@@ -18,29 +17,30 @@ from app.objects.user import User
 
 
 async def get_user(name: str, password_md5: str) -> Optional[User]:
-    async with ClientSession(connector=TCPConnector(verify_ssl=False)) as session:
-        async with session.get(
-            f"http://127.0.0.1:9823/user-auth",
-            headers={"Host": f"cho_api.{app.config.SERVER_DOMAIN}"},
-            params={
-                "name": name,
-                "password": password_md5,
-                "key": str(app.config.API_SECRET),
-            },
-        ) as resp:
-            if not resp:
-                return None
-
-            json = await resp.json()
-            if json["status"] != "ok":
-                return None
-
-            json["user"]["status"] = Status.from_dict(json["user"]["status"])
-            json["user"]["privileges"] = Privileges(json["user"]["privileges"])
-            json["user"]["geolocation"] = Geolocation.from_dict(
-                json["user"]["geolocation"],
-            )
-            return User(**json["user"])
+    async with app.state.http.get(
+        "cho",
+        f"http://127.0.0.1:9823/user-auth",
+        headers={"Host": f"cho_api.{app.config.SERVER_DOMAIN}"},
+        params={
+            "name": name,
+            "password": password_md5,
+            "key": str(app.config.API_SECRET),
+        },
+        ssl=False,
+    ) as resp:
+        if not resp:
+            return None
+
+        json = await resp.json()
+        if json["status"] != "ok":
+            return None
+
+    json["user"]["status"] = Status.from_dict(json["user"]["status"])
+    json["user"]["privileges"] = Privileges(json["user"]["privileges"])
+    json["user"]["geolocation"] = Geolocation.from_dict(
+        json["user"]["geolocation"],
+    )
+    return User(**json["user"])
 
 
 def authenticate_user(
@@ -0,0 +1,675 @@
+"""In-memory stand-ins for the services web talks to.
+
+Only the parts of the motor, aioredis, cho and osu! api surfaces
+that web actually uses are implemented."""
+from __future__ import annotations
+
+import asyncio
+import copy
+import hashlib
+import itertools
+import random
+from typing import Any
+from typing import Iterable
+from typing import Optional
+
+import orjson
+from aiohttp import web
+from bson import ObjectId
+from pymongo import DeleteMany
+from pymongo import DeleteOne
+from pymongo import InsertOne
+from pymongo import ReturnDocument
+from pymongo import UpdateMany
+from pymongo import UpdateOne
+
+Document = dict[str, Any]
+
+
+def get_field(document: Document, key: str) -> Any:
+    value: Any = document
+    for part in key.split("."):
+        if not isinstance(value, dict):
+            return None
+
+        value = value.get(part)
+
+    return value
+
+
+def matches_condition(value: Any, condition: Any) -> bool:
+    if not isinstance(condition, dict) or not any(
+        key.startswith("$") for key in condition
+    ):
+        if isinstance(value, list) and not isinstance(condition, list):
+            return condition in value
+
+        return value == condition
+
+    for operator, operand in condition.items():
+        if operator == "$in":
+            if value not in operand:
+                return False
+        elif operator == "$nin":
+            if value in operand:
+                return False
+        elif operator == "$ne":
+            if value == operand:
+                return False
+        elif operator == "$exists":
+            if (value is not None) != operand:
+                return False
+        elif value is None:
+            return False
+        elif operator == "$gt":
+            if not value > operand:
+                return False
+        elif operator == "$gte":
+            if not value >= operand:
+                return False
+        elif operator == "$lt":
+            if not value < operand:
+                return False
+        elif operator == "$lte":
+            if not value <= operand:
+                return False
+        else:
+            raise NotImplementedError(f"query operator {operator}")
+
+    return True
+
+
+def matches(document: Document, query: Optional[Document]) -> bool:
+    for key, condition in (query or {}).items():
+        if key == "$or":
+            if not any(matches(document, sub_query) for sub_query in condition):
+                return False
+        elif key == "$and":
+            if not all(matches(document, sub_query) for sub_query in condition):
+                return False
+        elif not matches_condition(get_field(document, key), condition):
+            return False
+
+    return True
+
+
+def project(document: Document, projection: Optional[Document]) -> Document:
+    if not projection:
+        return copy.deepcopy(document)
+
+    included = {key for key, value in projection.items() if value and key != "_id"}
+    if included:
+        result = {}
+        for key in included:
+            value = projection[key]
+
+            # aggregation style computed fields, {"name": "$user.name"}
+            if isinstance(value, str) and value.startswith("$"):
+                result[key] = get_field(document, value[1:])
+            elif key in document:
+                result[key] = document[key]
+
+        if projection.get("_id", 1) and "_id" in document:
+            result["_id"] = document["_id"]
+    else:
+        result = {
+            key: value for key, value in document.items() if key not in projection
+        }
+
+    return copy.deepcopy(result)
+
+
+def apply_update(document: Document, update: Document, inserting: bool = False) -> None:
+    for operator, fields in update.items():
+        for key, value in fields.items():
+            if operator == "$set":
+                document[key] = copy.deepcopy(value)
+            elif operator == "$setOnInsert":
+                if inserting:
+                    document[key] = copy.deepcopy(value)
+            elif operator == "$inc":
+                document[key] = document.get(key, 0) + value
+            elif operator == "$max":
+                if key not in document or value > document[key]:
+                    document[key] = value
+            elif operator == "$addToSet":
+                values = document.setdefault(key, [])
+                if value not in values:
+                    values.append(value)
+            elif operator == "$unset":
+                document.pop(key, None)
+            else:
+                raise NotImplementedError(f"update operator {operator}")
+
+
+def sort_documents(
+    documents: Iterable[Document],
+    sort: list[tuple[str, int]],
+) -> list[Document]:
+    documents = list(documents)
+
+    # stable sorts, least significant key first
+    for field, direction in reversed(sort):
+        documents.sort(
+            key=lambda document: (
+                get_field(document, field) is not None,
+                get_field(document, field),
+            ),
+            reverse=direction < 0,
+        )
+
+    return documents
+
+
+class FakeCursor:
+    def __init__(self, documents: Iterable[Document]) -> None:
+        self.documents = list(documents)
+
+    def sort(self, key: Any, direction: int = 1) -> FakeCursor:
+        sort = key if isinstance(key, list) else [(key, direction)]
+        self.documents = sort_documents(self.documents, sort)
+        return self
+
+    def limit(self, count: int) -> FakeCursor:
+        if count:
+            self.documents = self.documents[:count]
+
+        return self
+
+    def __aiter__(self):
+        return self.iterate()
+
+    async def iterate(self):
+        for document in self.documents:
+            yield document
+
+    async def to_list(self, length: Optional[int] = None) -> list[Document]:
+        return self.documents[:length] if length else list(self.documents)
+
+
+class FakeCollection:
+    def __init__(self, database: FakeDatabase, name: str) -> None:
+        self.database = database
+        self.name = name
+        self.documents: list[Document] = []
+
+    def matching(self, query: Optional[Document]) -> Iterable[Document]:
+        return (document for document in self.documents if matches(document, query))
+
+    async def create_index(self, *args: Any, **kwargs: Any) -> str:
+        return "index"
+
+    async def count_documents(self, query: Document, **kwargs: Any) -> int:
+        return sum(1 for _ in self.matching(query))
+
+    async def find_one(
+        self,
+        query: Optional[Document] = None,
+        projection: Optional[Document] = None,
+        sort: Optional[list[tuple[str, int]]] = None,
+        **kwargs: Any,
+    ) -> Optional[Document]:
+        documents = self.matching(query)
+        if sort:
+            documents = sort_documents(documents, sort)
+
+        for document in documents:
+            return project(document, projection)
+
+        return None
+
+    def find(
+        self,
+        query: Optional[Document] = None,
+        projection: Optional[Document] = None,
+        **kwargs: Any,
+    ) -> FakeCursor:
+        return FakeCursor(
+            project(document, projection) for document in self.matching(query)
+        )
+
+    def aggregate(self, pipeline: list[Document], **kwargs: Any) -> FakeCursor:
+        # stages build new documents rather than changing them in place,
+        # so copying can wait until the end
+        documents = list(self.documents)
+
+        for stage in pipeline:
+            ((operator, argument),) = stage.items()
+
+            if operator == "$match":
+                documents = [
+                    document for document in documents if matches(document, argument)
+                ]
+            elif operator == "$project":
+                documents = [project(document, argument) for document in documents]
+            elif operator == "$lookup":
+                foreign: dict[Any, list[Document]] = {}
+                for other in self.database[argument["from"]].documents:
+                    foreign.setdefault(other.get(argument["foreignField"]), []).append(
+                        other,
+                    )
+
+                documents = [
+                    {
+                        **document,
+                        argument["as"]: foreign.get(
+                            document.get(argument["localField"]),
+                            [],
+                        ),
+                    }
+                    for document in documents
+                ]
+            elif operator == "$unwind":
+                path = argument[1:]
+                documents = [
+                    {**document, path: value}
+                    for document in documents
+                    for value in document.get(path) or ()
+                ]
+            elif operator == "$sort":
+                documents = sort_documents(documents, list(argument.items()))
+            elif operator == "$limit":
+                documents = documents[:argument]
+            else:
+                raise NotImplementedError(f"aggregation stage {operator}")
+
+        return FakeCursor(copy.deepcopy(documents))
+
+    def insert(self, document: Document) -> None:
+        document.setdefault("_id", ObjectId())
+        self.documents.append(copy.deepcopy(document))
+
+    async def insert_one(self, document: Document, **kwargs: Any) -> None:
+        self.insert(document)
+
+    async def insert_many(self, documents: list[Document], **kwargs: Any) -> None:
+        for document in documents:
+            self.insert(document)
+
+    def update(
+        self,
+        query: Document,
+        update: Document,
+        upsert: bool = False,
+        many: bool = False,
+    ) -> Optional[Document]:
+        updated = None
+
+        for document in self.matching(query):
+            apply_update(document, update)
+            updated = document
+
+            if not many:
+                break
+
+        if updated is None and upsert:
+            updated = {
+                key: value
+                for key, value in query.items()
+                if not key.startswith("$") and not isinstance(value, dict)
+            }
+            apply_update(updated, update, inserting=True)
+            self.insert(updated)
+            updated = self.documents[-1]
+
+        return updated
+
+    async def update_one(
+        self,
+        query: Document,
+        update: Document,
+        upsert: bool = False,
+        **kwargs: Any,
+    ) -> None:
+        self.update(query, update, upsert)
+
+    async def update_many(
+        self,
+        query: Document,
+        update: Document,
+        upsert: bool = False,
+        **kwargs: Any,
+    ) -> None:
+        self.update(query, update, upsert, many=True)
+
+    async def find_one_and_update(
+        self,
+        query: Document,
+        update: Document,
+        upsert: bool = False,
+        return_document: bool = ReturnDocument.BEFORE,
+        **kwargs: Any,
+    ) -> Optional[Document]:
+        before = await self.find_one(query)
+        after = self.update(query, update, upsert)
+
+        if return_document == ReturnDocument.AFTER:
+            return copy.deepcopy(after)
+
+        return before
+
+    async def delete_many(self, query: Document, **kwargs: Any) -> None:
+        self.documents = [
+            document for document in self.documents if not matches(document, query)
+        ]
+
+    async def bulk_write(self, requests: list[Any], **kwargs: Any) -> None:
+        for request in requests:
+            if isinstance(request, InsertOne):
+                self.insert(request._doc)
+            elif isinstance(request, UpdateOne):
+                self.update(request._filter, request._doc, request._upsert)
+            elif isinstance(request, UpdateMany):
+                self.update(request._filter, request._doc, request._upsert, True)
+            elif isinstance(request, (DeleteOne, DeleteMany)):
+                await self.delete_many(request._filter)
+            else:
+                raise NotImplementedError(f"bulk operation {request!r}")
+
+
+class FakeDatabase:
+    def __init__(self) -> None:
+        self.collections: dict[str, FakeCollection] = {}
+
+    def __getitem__(self, name: str) -> FakeCollection:
+        if not (collection := self.collections.get(name)):
+            collection = self.collections[name] = FakeCollection(self, name)
+
+        return collection
+
+    def __getattr__(self, name: str) -> FakeCollection:
+        if name.startswith("_"):
+            raise AttributeError(name)
+
+        return self[name]
+
+
+class FakePubSub:
+    async def subscribe(self, *channels: str) -> None:
+        pass
+
+    async def get_message(
+        self,
+        ignore_subscribe_messages: bool = False,
+        timeout: float = 0.0,
+    ) -> None:
+        await asyncio.sleep(timeout)
+
+
+class FakeRedis:
+    def __init__(self) -> None:
+        self.values: dict[str, bytes] = {}
+        self.sorted_sets: dict[str, dict[str, float]] = {}
+        self.published: list[tuple[str, bytes]] = []
+
+    @staticmethod
+    def encode(value: Any) -> bytes:
+        if isinstance(value, bytes):
+            return value
+
+        return str(value).encode()
+
+    async def initialize(self) -> FakeRedis:
+        return self
+
+    async def close(self) -> None:
+        pass
+
+    def pubsub(self) -> FakePubSub:
+        return FakePubSub()
+
+    async def publish(self, channel: str, message: Any) -> int:
+        self.published.append((channel, self.encode(message)))
+        return 0
+
+    async def get(self, key: str) -> Optional[bytes]:
+        return self.values.get(key)
+
+    async def set(
+        self,
+        key: str,
+        value: Any,
+        ex: Optional[int] = None,
+        nx: bool = False,
+    ) -> Optional[bool]:
+        if nx and key in self.values:
+            return None
+
+        self.values[key] = self.encode(value)
+        return True
+
+    async def delete(self, *keys: str) -> int:
+        return sum(self.values.pop(key, None) is not None for key in keys)
+
+    async def exists(self, *keys: str) -> int:
+        return sum(key in self.values for key in keys)
+
+    async def incrby(self, key: str, amount: int = 1) -> int:
+        value = int(self.values.get(key, b"0")) + amount
+        self.values[key] = self.encode(value)
+        return value
+
+    async def incr(self, key: str) -> int:
+        return await self.incrby(key)
+
+    async def eval(self, script: str, numkeys: int, *keys_and_args: Any) -> Any:
+        # there's no lua here, only the scripts web runs are understood
+        import app.usecases.leaderboard
+
+        keys, args = keys_and_args[:numkeys], keys_and_args[numkeys:]
+
+        if script == app.usecases.leaderboard.PUBLISH_SCORE_SCRIPT:
+            (sequence_key,), (channel, update) = keys, args
+
+            sequence = await self.incr(sequence_key)
+            await self.publish(
+                channel,
+                b'{"sequence":%d,' % sequence + self.encode(update)[1:],
+            )
+
+            return sequence
+
+        raise NotImplementedError("script")
+
+    async def zadd(self, key: str, mapping: dict[Any, float]) -> int:
+        sorted_set = self.sorted_sets.setdefault(key, {})
+        for member, score in mapping.items():
+            sorted_set[str(member)] = score
+
+        return len(mapping)
+
+    async def zrevrank(self, key: str, member: Any) -> Optional[int]:
+        sorted_set = self.sorted_sets.get(key, {})
+        if (score := sorted_set.get(str(member))) is None:
+            return None
+
+        return sum(1 for other in sorted_set.values() if other > score)
+
+
+def make_osu_file(title: str, hit_objects: int) -> bytes:
+    lines = [
+        "osu file format v14",
+        "",
+        "[General]",
+        "AudioFilename: audio.mp3",
+        "Mode: 0",
+        "",
+        "[Metadata]",
+        f"Title:{title}",
+        "Artist:bench",
+        "Creator:bench",
+        "Version:bench",
+        "",
+        "[Difficulty]",
+        "HPDrainRate:5",
+        "CircleSize:4",
+        "OverallDifficulty:8",
+        "ApproachRate:9",
+        "SliderMultiplier:1.4",
+        "SliderTickRate:1",
+        "",
+        "[TimingPoints]",
+        "0,300,4,2,0,100,1,0",
+        "",
+        "[HitObjects]",
+    ]
+
+    rng = random.Random(title)
+    for idx in range(hit_objects):
+        x, y = rng.randrange(0, 512), rng.randrange(0, 384)
+        lines.append(f"{x},{y},{1000 + idx * 150},{5 if idx == 0 else 1},0,0:0:0:0:")
+
+    return ("\r\n".join(lines) + "\r\n").encode()
+
+
+class FakeBeatmap:
+    def __init__(self, map_id: int, set_id: int, hit_objects: int) -> None:
+        self.id = map_id
+        self.set_id = set_id
+        self.hit_objects = hit_objects
+
+        self.osu_file = make_osu_file(f"bench {map_id}", hit_objects)
+        self.md5 = hashlib.md5(self.osu_file).hexdigest()
+
+    def osu_api_json(self) -> dict[str, Any]:
+        return {
+            "file_md5": self.md5,
+            "beatmap_id": str(self.id),
+            "beatmapset_id": str(self.set_id),
+            "artist": "bench",
+            "title": f"bench {self.id}",
+            "version": "bench",
+            "creator": "bench",
+            "last_update": "2022-01-01 00:00:00",
+            "total_length": str(self.hit_objects * 150 // 1000),
+            "max_combo": str(self.hit_objects),
+            "approved": "1",
+            "mode": "0",
+            "bpm": "200",
+            "diff_size": "4",
+            "diff_overall": "8",
+            "diff_approach": "9",
+            "diff_drain": "5",
+            "difficultyrating": "5.0",
+        }
+
+
+def cho_user(user_id: int, country: str = "xx") -> dict[str, Any]:
+    return {
+        "id": user_id,
+        "name": f"bench{user_id}",
+        "status": {
+            "action": 0,
+            "info_text": "",
+            "map_md5": "",
+            "mods": 0,
+            "mode": 0,
+            "map_id": 0,
+        },
+        "login_time": 0,
+        "latest_activity": 0,
+        "geolocation": {
+            "long": 0.0,
+            "lat": 0.0,
+            "country": {"code": 244, "acronym": country},
+            "ip": "127.0.0.1",
+        },
+        "privileges": 3,  # normal | verified
+        "friends": [],
+    }
+
+
+def user_document(user_id: int, country: str = "xx") -> Document:
+    return {
+        "id": user_id,
+        "name": f"bench{user_id}",
+        "safe_name": f"bench{user_id}",
+        "privileges": 3,
+        "country": country,
+        "friends": [],
+    }
+
+
+def stats_documents(user_id: int) -> list[Document]:
+    return [
+        {
+            "user_id": user_id,
+            "mode": mode,
+            "total_score": 0,
+            "ranked_score": 0,
+            "accuracy": 0.0,
+            "pp": 0,
+            "max_combo": 0,
+            "total_hits": 0,
+            "playcount": 0,
+            "playtime": 0,
+        }
+        for mode in range(8)
+    ]
+
+
+class StubUpstreams:
+    """Serves cho's /user-auth and the bits of the osu! api web fetches."""
+
+    def __init__(self) -> None:
+        self.beatmaps: dict[int, FakeBeatmap] = {}
+        self.requests = itertools.count()
+        self.runners: list[web.AppRunner] = []
+
+    def add_beatmap(self, beatmap: FakeBeatmap) -> None:
+        self.beatmaps[beatmap.id] = beatmap
+
+    async def user_auth(self, request: web.Request) -> web.Response:
+        next(self.requests)
+
+        name = request.query["name"]
+        if not name.startswith("bench"):
+            return web.json_response({"status": "error"})
+
+        user_id = int(name[len("bench") :])
+        return web.json_response({"status": "ok", "user": cho_user(user_id)})
+
+    async def get_beatmaps(self, request: web.Request) -> web.Response:
+        next(self.requests)
+
+        if "h" in request.query:
+            found = [b for b in self.beatmaps.values() if b.md5 == request.query["h"]]
+        elif "b" in request.query:
+            found = [
+                b for b in self.beatmaps.values() if b.id == int(request.query["b"])
+            ]
+        else:
+            set_id = int(request.query["s"])
+            found = [b for b in self.beatmaps.values() if b.set_id == set_id]
+
+        return web.Response(
+            body=orjson.dumps([beatmap.osu_api_json() for beatmap in found]),
+            content_type="application/json",
+        )
+
+    async def osu_file(self, request: web.Request) -> web.Response:
+        next(self.requests)
+
+        if not (beatmap := self.beatmaps.get(int(request.match_info["map_id"]))):
+            return web.Response(status=404)
+
+        return web.Response(body=beatmap.osu_file)
+
+    async def start(self, cho_port: int, osu_api_port: int) -> None:
+        cho = web.Application()
+        cho.router.add_get("/user-auth", self.user_auth)
+
+        osu_api = web.Application()
+        osu_api.router.add_get("/api/get_beatmaps", self.get_beatmaps)
+        osu_api.router.add_get("/osu/{map_id}", self.osu_file)
+
+        for application, port in ((cho, cho_port), (osu_api, osu_api_port)):
+            runner = web.AppRunner(application, access_log=None)
+            await runner.setup()
+            await web.TCPSite(runner, "127.0.0.1", port).start()
+
+            self.runners.append(runner)
+
+    async def stop(self) -> None:
+        for runner in self.runners:
+            await runner.cleanup()
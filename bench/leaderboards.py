@@ -0,0 +1,365 @@
+#!/usr/bin/env python3.9
+"""Offline benchmark for /web/osu-osz2-getscores.php.
+
+Builds synthetic leaderboards in the in-memory stand-ins from bench/fakes.py
+and calls the real endpoint handler on them, skipping HTTP and cho auth so
+only the leaderboard path itself is measured. Cold loads include the
+stand-in store's own (slow) aggregation, so compare them between branches
+rather than against production.
+
+    $ python3.9 bench/leaderboards.py --sizes 100 10000 100000 --json lb.json
+"""
+from __future__ import annotations
+
+import argparse
+import asyncio
+import contextlib
+import itertools
+import os
+import random
+import statistics
+import sys
+import tempfile
+import time
+from dataclasses import dataclass
+from dataclasses import field
+from datetime import datetime
+from pathlib import Path
+from typing import Any
+
+import orjson
+
+REPO_PATH = Path(__file__).resolve().parent.parent
+sys.path.insert(0, str(REPO_PATH))
+
+from bench.fakes import FakeBeatmap
+from bench.fakes import FakeDatabase
+from bench.fakes import FakeRedis
+from bench.fakes import cho_user
+from bench.fakes import user_document
+from bench.submission import prepare_environment
+
+COUNTRIES = ("xx", "us", "de", "jp", "br", "pl", "kr", "gb")
+MODS = (0, 8, 16, 24, 64, 72)  # nomod, HD, HR, HDHR, DT, HDDT
+FRIENDS = 100
+
+REQUESTING_USER_ID = 1
+REQUEST_MODS = 8  # HD
+
+
+@dataclass
+class CaseResult:
+    size: int
+    name: str
+    latencies_ns: list[int] = field(default_factory=list)
+    elapsed_ns: int = 0
+
+    def percentile(self, percent: float) -> float:
+        if not self.latencies_ns:
+            return 0.0
+
+        ordered = sorted(self.latencies_ns)
+        return ordered[min(int(len(ordered) * percent / 100), len(ordered) - 1)]
+
+    def summary(self) -> dict[str, Any]:
+        return {
+            "size": self.size,
+            "case": self.name,
+            "count": len(self.latencies_ns),
+            "p50_ms": self.percentile(50) / 1e6,
+            "p95_ms": self.percentile(95) / 1e6,
+            "p99_ms": self.percentile(99) / 1e6,
+            "mean_ms": (
+                statistics.fmean(self.latencies_ns) / 1e6 if self.latencies_ns else 0.0
+            ),
+            "per_second": (
+                len(self.latencies_ns) / (self.elapsed_ns / 1e9)
+                if self.elapsed_ns
+                else 0.0
+            ),
+        }
+
+
+def score_document(
+    score_id: int,
+    user_id: int,
+    map_md5: str,
+    rng: random.Random,
+) -> dict[str, Any]:
+    nmiss = rng.randrange(0, 20)
+
+    return {
+        "id": score_id,
+        "user_id": user_id,
+        "map_md5": map_md5,
+        "mode": 0,
+        "status": 2,  # best
+        "mods": rng.choice(MODS),
+        "pp": rng.uniform(10, 500),
+        "score": rng.randrange(100_000, 10_000_000),
+        "max_combo": rng.randrange(100, 1000),
+        "acc": rng.uniform(80, 100),
+        "n300": 1000 - nmiss,
+        "n100": 0,
+        "n50": 0,
+        "nmiss": nmiss,
+        "ngeki": 0,
+        "nkatu": 0,
+        "perfect": nmiss == 0,
+        "time": datetime(2022, 1, 1).isoformat(),
+    }
+
+
+def seed(database: Any, sizes: list[int], beatmaps: dict[int, FakeBeatmap]) -> None:
+    rng = random.Random(0)
+
+    for user_id in range(1, max(sizes) + 1):
+        country = COUNTRIES[user_id % len(COUNTRIES)]
+        database.users.insert(user_document(user_id, country))
+
+    score_ids = itertools.count(1)
+    for size, beatmap in beatmaps.items():
+        # every user has a score on every map, including the one requesting
+        for user_id in range(1, size + 1):
+            database.scores.insert(
+                score_document(next(score_ids), user_id, beatmap.md5, rng),
+            )
+
+
+def requesting_user(sizes: list[int]) -> Any:
+    from app.constants.privileges import Privileges
+    from app.constants.status import Status
+    from app.objects.geolocation import Geolocation
+    from app.objects.user import User
+
+    user_json = cho_user(REQUESTING_USER_ID, COUNTRIES[REQUESTING_USER_ID])
+    user_json["status"] = Status.from_dict(user_json["status"])
+    user_json["privileges"] = Privileges(user_json["privileges"])
+    user_json["geolocation"] = Geolocation.from_dict(user_json["geolocation"])
+    user_json["friends"] = random.Random(1).sample(
+        range(2, max(sizes) + 1),
+        min(FRIENDS, max(sizes) - 1),
+    )
+
+    return User(**user_json)
+
+
+async def get_scores(user: Any, beatmap: Any, lb_type: int, mods: int) -> bytes:
+    import app.api.leaderboards
+
+    return await app.api.leaderboards.get_leaderboard(
+        user=user,
+        requesting_from_editor_song_select=False,
+        leaderboard_version=4,
+        leaderboard_type_arg=lb_type,
+        map_md5=beatmap.md5,
+        map_filename=beatmap.filename,
+        mode_arg=0,
+        map_set_id=-1,  # don't go through the set lookups
+        mods_arg=mods,
+        map_package_hash="",
+        aqn_files_found=False,
+    )
+
+
+async def run_requests(
+    result: CaseResult,
+    count: int,
+    request: Any,
+    before_each: Any = None,
+) -> CaseResult:
+    start = time.perf_counter_ns()
+
+    for _ in range(count):
+        if before_each is not None:
+            before_each()
+
+        request_start = time.perf_counter_ns()
+        await request()
+        result.latencies_ns.append(time.perf_counter_ns() - request_start)
+
+    result.elapsed_ns = time.perf_counter_ns() - start
+    return result
+
+
+async def concurrent_writes(
+    size: int,
+    beatmap: Any,
+    user: Any,
+    writers: int,
+    writes: int,
+) -> tuple[CaseResult, CaseResult]:
+    """Times `add_score` from several submitters while song select keeps reading."""
+
+    import app.usecases
+    from app.constants.mode import Mode
+    from app.objects.leaderboard import LeaderboardScore
+
+    leaderboard = await app.usecases.leaderboard.fetch(beatmap, Mode.STD)
+
+    adds = CaseResult(size, "add_score")
+    reads = CaseResult(size, "top_during_writes")
+
+    rng = random.Random(2)
+    score_ids = itertools.count(100_000_000)
+    writing = True
+
+    async def writer(writer_id: int) -> None:
+        for idx in range(writes):
+            # mostly improved bests, sometimes a new player
+            if idx % 4:
+                user_id = rng.randrange(2, size + 1)
+            else:
+                user_id = 10_000_000 + writer_id * writes + idx
+
+            row = score_document(next(score_ids), user_id, beatmap.md5, rng)
+            score = LeaderboardScore.from_row(
+                row
+                | {
+                    "username": f"bench{user_id}",
+                    "user_priv": 3,
+                    "user_country": COUNTRIES[user_id % len(COUNTRIES)],
+                },
+            )
+
+            start = time.perf_counter_ns()
+            app.usecases.leaderboard.add_score(leaderboard, score)
+            adds.latencies_ns.append(time.perf_counter_ns() - start)
+
+            # let the other submitters and readers in between writes
+            await asyncio.sleep(0)
+
+    async def reader() -> None:
+        while writing:
+            start = time.perf_counter_ns()
+            await get_scores(user, beatmap, lb_type=1, mods=REQUEST_MODS)
+            reads.latencies_ns.append(time.perf_counter_ns() - start)
+
+            await asyncio.sleep(0)
+
+    start = time.perf_counter_ns()
+
+    reader_task = asyncio.create_task(reader())
+    await asyncio.gather(*(writer(writer_id) for writer_id in range(writers)))
+    writing = False
+    await reader_task
+
+    adds.elapsed_ns = reads.elapsed_ns = time.perf_counter_ns() - start
+    return adds, reads
+
+
+async def run(args: argparse.Namespace) -> list[dict[str, Any]]:
+    import app.state
+    import app.usecases
+    from app.api.leaderboards import LeaderboardType
+    from app.constants.mode import Mode
+    from app.constants.mods import Mods
+
+    database = FakeDatabase()
+    app.state.services.database = database
+    app.state.services.redis = FakeRedis()
+
+    fake_beatmaps = {
+        size: FakeBeatmap(1000 + idx, 1000 + idx, hit_objects=10)
+        for idx, size in enumerate(args.sizes)
+    }
+
+    print("Seeding leaderboards...", file=sys.stderr)
+    seed(database, args.sizes, fake_beatmaps)
+
+    # requests with a different mode or mods than the user's update their status
+    user = requesting_user(args.sizes)
+    user.status.mods = Mods(REQUEST_MODS)
+
+    results = []
+    for size, fake_beatmap in fake_beatmaps.items():
+        print(f"Running {size} scores...", file=sys.stderr)
+
+        beatmap = app.usecases.beatmap.parse_from_osu_api(
+            [fake_beatmap.osu_api_json()],
+        )[0]
+        await app.usecases.beatmap.save_to_database(beatmap)
+        beatmap = await app.usecases.beatmap.fetch_by_md5(beatmap.md5)
+
+        async def top_scores() -> bytes:
+            return await get_scores(user, beatmap, LeaderboardType.TOP, REQUEST_MODS)
+
+        def drop() -> None:
+            app.usecases.leaderboard.drop(beatmap, Mode.STD)
+
+        cold = await run_requests(
+            CaseResult(size, "cold"),
+            args.cold_requests,
+            top_scores,
+            before_each=drop,
+        )
+        results.append(cold.summary())
+
+        for lb_type in LeaderboardType:
+            # make sure it's loaded
+            await get_scores(user, beatmap, lb_type, REQUEST_MODS)
+
+            async def warm_scores() -> bytes:
+                return await get_scores(user, beatmap, lb_type, REQUEST_MODS)
+
+            warm = await run_requests(
+                CaseResult(size, f"warm_{lb_type.name.lower()}"),
+                args.requests,
+                warm_scores,
+            )
+            results.append(warm.summary())
+
+        adds, reads = await concurrent_writes(
+            size,
+            beatmap,
+            user,
+            args.writers,
+            args.writes,
+        )
+        results.extend((adds.summary(), reads.summary()))
+
+    return results
+
+
+def main(argv: list[str]) -> int:
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument(
+        "--sizes",
+        type=int,
+        nargs="+",
+        default=[100, 1_000, 10_000, 100_000],
+        help="scores on each synthetic leaderboard",
+    )
+    parser.add_argument("--requests", type=int, default=200)
+    parser.add_argument("--cold-requests", type=int, default=5)
+    parser.add_argument("--writers", type=int, default=8)
+    parser.add_argument("--writes", type=int, default=200, help="per writer")
+    parser.add_argument("--json", type=Path, help="also write results here")
+    args = parser.parse_args(argv)
+
+    with tempfile.TemporaryDirectory(prefix="aisuru-bench-") as workdir:
+        prepare_environment(Path(workdir), cpu_pool_size=0)
+
+        # the endpoint logs every request it serves
+        with open(os.devnull, "w") as devnull, contextlib.redirect_stdout(devnull):
+            results = asyncio.run(run(args))
+
+    print(
+        f"{'size':>8}  {'case':<20}{'n':>7}{'p50 ms':>10}"
+        f"{'p95 ms':>10}{'p99 ms':>10}{'per s':>11}",
+    )
+    for result in results:
+        print(
+            f"{result['size']:>8}  {result['case']:<20}{result['count']:>7}"
+            f"{result['p50_ms']:>10.3f}{result['p95_ms']:>10.3f}"
+            f"{result['p99_ms']:>10.3f}{result['per_second']:>11.1f}",
+        )
+
+    if args.json:
+        args.json.write_bytes(orjson.dumps(results, option=orjson.OPT_INDENT_2))
+
+    return 0
+
+
+if __name__ == "__main__":
+    raise SystemExit(main(sys.argv[1:]))
@@ -0,0 +1,392 @@
+#!/usr/bin/env python3.9
+"""Offline end-to-end benchmark for /web/osu-submit-modular-selector.php.
+
+Runs the real app in-process against in-memory stand-ins for mongo,
+redis, cho's /user-auth and the osu! api (see bench/fakes.py).
+
+    $ python3.9 bench/submission.py --submissions 500 --concurrency 8
+"""
+from __future__ import annotations
+
+import argparse
+import asyncio
+import hashlib
+import os
+import secrets
+import statistics
+import sys
+import tempfile
+import time
+from base64 import b64encode
+from dataclasses import dataclass
+from dataclasses import field
+from pathlib import Path
+from typing import Any
+from typing import Callable
+
+import orjson
+
+REPO_PATH = Path(__file__).resolve().parent.parent
+sys.path.insert(0, str(REPO_PATH))
+
+from bench.fakes import FakeBeatmap
+from bench.fakes import FakeDatabase
+from bench.fakes import FakeRedis
+from bench.fakes import StubUpstreams
+from bench.fakes import stats_documents
+from bench.fakes import user_document
+
+SERVER_DOMAIN = "bench.local"
+CHO_PORT = 9823  # hardcoded in app.utils.get_user
+OSU_API_PORT = 9825
+
+OSU_VERSION = "20220406"
+HIT_OBJECTS = 1000
+
+
+def prepare_environment(workdir: Path, cpu_pool_size: int) -> None:
+    """Points the app's config and data directory somewhere disposable.
+
+    Must run before anything from `app` is imported."""
+
+    os.environ.update(
+        {
+            "MONGODB_DSN": "mongodb://127.0.0.1:1",
+            "REDIS_DSN": "redis://127.0.0.1:1",
+            "SERVER_DOMAIN": SERVER_DOMAIN,
+            "SERVER_PORT": "0",
+            "DEBUG": "False",
+            "API_SECRET": "bench",
+            "OSU_API_KEY": "bench",
+            "MIRROR_URL": "http://127.0.0.1:1",
+            "INGAME_REGISTRATION": "False",
+            "MONGODB_TRANSACTIONS": "False",
+            "CPU_POOL_SIZE": str(cpu_pool_size),
+        },
+    )
+
+    # the geolocation database is opened relative to the working directory
+    (workdir / "ext").symlink_to(REPO_PATH / "ext")
+    os.chdir(workdir)
+
+
+@dataclass
+class Submission:
+    user_id: int
+    form: dict[str, Any]
+    replay: bytes
+    expected: Callable[[bytes], bool]
+
+
+def encrypt_score(score_fields: list[str]) -> dict[str, Any]:
+    """Encrypts a score the way the osu! client does, see `decrypt_score_data`."""
+
+    from py3rijndael import Pkcs7Padding
+    from py3rijndael import RijndaelCbc
+
+    iv = secrets.token_bytes(32)
+    aes = RijndaelCbc(
+        key=f"osu!-scoreburgr---------{OSU_VERSION}".encode(),
+        iv=iv,
+        padding=Pkcs7Padding(32),
+        block_size=32,
+    )
+
+    return {
+        "score": b64encode(aes.encrypt(":".join(score_fields).encode())).decode(),
+        "s": b64encode(aes.encrypt(secrets.token_hex(16).encode())).decode(),
+        "iv": b64encode(iv).decode(),
+    }
+
+
+def returned_charts(body: bytes) -> bool:
+    return body.startswith(b"beatmapId:")
+
+
+def rejected(body: bytes) -> bool:
+    return body == b"error: no"
+
+
+def make_submission(
+    beatmap: FakeBeatmap,
+    user_id: int,
+    combo: int,
+    passed: bool,
+) -> Submission:
+    nmiss = 0 if passed else 10
+    n300 = beatmap.hit_objects - nmiss
+
+    score_fields = [
+        beatmap.md5,
+        f"bench{user_id}",
+        secrets.token_hex(16),  # client checksum, unique per play
+        str(n300),
+        "0",  # n100
+        "0",  # n50
+        "0",  # ngeki
+        "0",  # nkatu
+        str(nmiss),
+        str(combo * 1000),  # score
+        str(combo),
+        str(passed and combo == beatmap.hit_objects),  # perfect
+        "S" if passed else "F",
+        "0",  # mods
+        str(passed),
+        "0",  # mode
+        time.strftime("%y%m%d%H%M%S"),
+        OSU_VERSION,  # trailing spaces here would be client flags
+    ]
+
+    form = {
+        "x": "0",
+        "ft": "0" if passed else "30000",
+        "fs": b64encode(b"bench").decode(),
+        "bmk": beatmap.md5,
+        "c1": "bench|bench",
+        "st": "150000",
+        "pass": hashlib.md5(b"bench").hexdigest(),
+        "osuver": OSU_VERSION,
+        **encrypt_score(score_fields),
+    }
+
+    expected = returned_charts if passed else rejected
+
+    return Submission(user_id, form, secrets.token_bytes(24 * 1024), expected)
+
+
+def first_play(beatmap: FakeBeatmap, count: int) -> list[Submission]:
+    # a different user every time, so there's never an old best
+    return [
+        make_submission(beatmap, 100_000 + idx, HIT_OBJECTS // 2, passed=True)
+        for idx in range(count)
+    ]
+
+
+def improved_best(beatmap: FakeBeatmap, count: int, users: int) -> list[Submission]:
+    # every play beats the user's previous best on combo (and so pp)
+    return [
+        make_submission(
+            beatmap,
+            200_000 + (idx % users),
+            min(100 + idx // users, HIT_OBJECTS),
+            passed=True,
+        )
+        for idx in range(count)
+    ]
+
+
+def failed_play(beatmap: FakeBeatmap, count: int) -> list[Submission]:
+    return [
+        make_submission(beatmap, 300_000 + idx, 50, passed=False)
+        for idx in range(count)
+    ]
+
+
+@dataclass
+class ScenarioResult:
+    name: str
+    latencies_ns: list[int] = field(default_factory=list)
+    errors: int = 0
+    elapsed_ns: int = 0
+
+    def percentile(self, percent: float) -> float:
+        if not self.latencies_ns:
+            return 0.0
+
+        ordered = sorted(self.latencies_ns)
+        return ordered[min(int(len(ordered) * percent / 100), len(ordered) - 1)]
+
+    def summary(self) -> dict[str, Any]:
+        return {
+            "scenario": self.name,
+            "submissions": len(self.latencies_ns),
+            "errors": self.errors,
+            "p50_ms": self.percentile(50) / 1e6,
+            "p95_ms": self.percentile(95) / 1e6,
+            "p99_ms": self.percentile(99) / 1e6,
+            "mean_ms": (
+                statistics.fmean(self.latencies_ns) / 1e6 if self.latencies_ns else 0.0
+            ),
+            "submissions_per_second": (
+                len(self.latencies_ns) / (self.elapsed_ns / 1e9)
+                if self.elapsed_ns
+                else 0.0
+            ),
+        }
+
+
+async def submit(client: Any, submission: Submission) -> tuple[int, bool]:
+    start = time.perf_counter_ns()
+
+    response = await client.post(
+        "/web/osu-submit-modular-selector.php",
+        headers={"token": "bench"},
+        data=submission.form,
+        files=[("score", ("replay", submission.replay, "application/octet-stream"))],
+    )
+
+    elapsed = time.perf_counter_ns() - start
+    ok = response.status_code == 200 and submission.expected(response.content)
+    return elapsed, ok
+
+
+async def run_scenario(
+    client: Any,
+    name: str,
+    submissions: list[Submission],
+    concurrency: int,
+    warmup: int,
+) -> ScenarioResult:
+    result = ScenarioResult(name)
+
+    for submission in submissions[:warmup]:
+        await submit(client, submission)
+
+    # a user's plays always go to the same client, in order
+    lanes: list[list[Submission]] = [[] for _ in range(concurrency)]
+    for submission in submissions[warmup:]:
+        lanes[submission.user_id % concurrency].append(submission)
+
+    async def run_lane(lane: list[Submission]) -> None:
+        for submission in lane:
+            elapsed, ok = await submit(client, submission)
+
+            result.latencies_ns.append(elapsed)
+            if not ok:
+                result.errors += 1
+
+    start = time.perf_counter_ns()
+    await asyncio.gather(*(run_lane(lane) for lane in lanes))
+    result.elapsed_ns = time.perf_counter_ns() - start
+
+    return result
+
+
+def seed_users(database: Any, submissions: list[Submission]) -> None:
+    for user_id in sorted({submission.user_id for submission in submissions}):
+        database.users.insert(user_document(user_id))
+
+        for document in stats_documents(user_id):
+            database.ustats.insert(document)
+
+
+async def run(args: argparse.Namespace) -> list[dict[str, Any]]:
+    import httpx
+
+    import app.init_api
+    import app.state
+    import app.usecases
+
+    database = FakeDatabase()
+    app.state.services.database = database
+    app.state.services.redis = FakeRedis()
+
+    upstreams = StubUpstreams()
+    await upstreams.start(CHO_PORT, OSU_API_PORT)
+
+    osu_api_url = f"http://127.0.0.1:{OSU_API_PORT}"
+    app.usecases.beatmap.GET_BEATMAP_URL = f"{osu_api_url}/api/get_beatmaps"
+    app.usecases.beatmap_file.OSU_FILE_URL = f"{osu_api_url}/osu/{{}}"
+
+    beatmaps = {
+        name: FakeBeatmap(1000 + idx, 1000, HIT_OBJECTS)
+        for idx, name in enumerate(("first_play", "improved_best", "failed_play"))
+    }
+    for beatmap in beatmaps.values():
+        upstreams.add_beatmap(beatmap)
+
+    print("Encrypting score payloads...", file=sys.stderr)
+
+    count = args.submissions + args.warmup
+    scenarios = {
+        "first_play": first_play(beatmaps["first_play"], count),
+        "improved_best": improved_best(
+            beatmaps["improved_best"],
+            count,
+            users=args.concurrency * 4,
+        ),
+        "failed_play": failed_play(beatmaps["failed_play"], count),
+    }
+
+    for submissions in scenarios.values():
+        seed_users(database, submissions)
+
+    await app.init_api.start_subsystems()
+
+    results = []
+    transport = httpx.ASGITransport(app=app.init_api.asgi_app)
+    async with httpx.AsyncClient(
+        transport=transport,
+        base_url=f"http://osu.{SERVER_DOMAIN}",
+        timeout=None,
+    ) as client:
+        for name in args.scenarios:
+            print(f"Running {name}...", file=sys.stderr)
+
+            app.state.metrics.histograms.clear()
+
+            result = await run_scenario(
+                client,
+                name,
+                scenarios[name],
+                args.concurrency,
+                args.warmup,
+            )
+            results.append(
+                result.summary()
+                | {
+                    "stages": {
+                        stage: {
+                            key: value
+                            for key, value in histogram.summary().items()
+                            if key != "buckets_ms"
+                        }
+                        for stage, histogram in app.state.metrics.histograms.items()
+                    },
+                },
+            )
+
+    await app.init_api.stop_subsystems()
+    await upstreams.stop()
+
+    return results
+
+
+def main(argv: list[str]) -> int:
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("--submissions", type=int, default=200)
+    parser.add_argument("--concurrency", type=int, default=4)
+    parser.add_argument("--warmup", type=int, default=5)
+    parser.add_argument("--cpu-pool-size", type=int, default=2)
+    parser.add_argument(
+        "--scenarios",
+        nargs="+",
+        choices=("first_play", "improved_best", "failed_play"),
+        default=["first_play", "improved_best", "failed_play"],
+    )
+    parser.add_argument("--json", type=Path, help="also write results here")
+    args = parser.parse_args(argv)
+
+    with tempfile.TemporaryDirectory(prefix="aisuru-bench-") as workdir:
+        prepare_environment(Path(workdir), args.cpu_pool_size)
+        results = asyncio.run(run(args))
+
+    print(
+        f"{'scenario':<16}{'n':>7}{'errors':>8}{'p50 ms':>10}"
+        f"{'p95 ms':>10}{'p99 ms':>10}{'subs/s':>10}",
+    )
+    for result in results:
+        print(
+            f"{result['scenario']:<16}{result['submissions']:>7}{result['errors']:>8}"
+            f"{result['p50_ms']:>10.2f}{result['p95_ms']:>10.2f}"
+            f"{result['p99_ms']:>10.2f}{result['submissions_per_second']:>10.1f}",
+        )
+
+    if args.json:
+        args.json.write_bytes(orjson.dumps(results, option=orjson.OPT_INDENT_2))
+
+    return 0
+
+
+if __name__ == "__main__":
+    raise SystemExit(main(sys.argv[1:]))
@@ -0,0 +1,52 @@
+#!/usr/bin/env python3.9
+from __future__ import annotations
+
+import argparse
+import os
+import sys
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), ".."))
+
+import app.usecases.replay
+import log
+
+
+def main(argv: list[str]) -> int:
+    parser = argparse.ArgumentParser(
+        description="Pack data/replays/{score_id}.osr files into replay segments.",
+    )
+    parser.add_argument(
+        "--delete",
+        action="store_true",
+        help="delete each .osr file once it has been packed",
+    )
+    args = parser.parse_args(argv)
+
+    app.usecases.replay.load_index()
+
+    replay_files = sorted(
+        app.usecases.replay.REPLAYS_PATH.glob("*.osr"),
+        key=lambda path: int(path.stem),
+    )
+    log.info(f"Found {len(replay_files)} replay files to pack.")
+
+    packed = 0
+    for replay_file in replay_files:
+        score_id = int(replay_file.stem)
+
+        if score_id not in app.usecases.replay.index:
+            app.usecases.replay.append(score_id, replay_file.read_bytes())
+            packed += 1
+
+        if args.delete:
+            replay_file.unlink()
+
+    log.info(
+        f"Packed {packed} replays into "
+        f"{app.usecases.replay.active_segment + 1} segments.",
+    )
+    return 0
+
+
+if __name__ == "__main__":
+    raise SystemExit(main(sys.argv[1:]))